@@ -14,6 +14,11 @@ REQUEST_TIMEOUT_SECONDS = 3600  # 60 minutes
 MAX_DEPTH_VARIANCE = 6
 MAX_DEPTH_VARIANCE_METBK = 17
 METADATA_CACHE_SECONDS = 600
+# Partition metadata records are cached per stream for this many seconds, for at most this many streams
+PARTITION_METADATA_CACHE_SECONDS = 60
+PARTITION_METADATA_CACHE_SIZE = 1000
+# Number of streams whose partition metadata is fetched concurrently when counting particles
+PARTITION_METADATA_FETCH_WORKERS = 8
 PARAMETER_LOGGING = '/opendap_export/stream_engine'
 DPA_VERSION_VARIABLE = "version"
 INTERNAL_OUTPUT_EXCLUDE_LIST = ['bin', ]
@@ -26,6 +31,22 @@ CONFIG_DIR = os.path.dirname(__file__)
 SAN_BASE_DIRECTORY = '/opt/ooi/SAN/'
 # When loading data back into cassandra should we allow writing to an already present databin.
 SAN_CASS_OVERWRITE = True
+# Count new rows with a lightweight transaction per row when loading data back into cassandra.
+# Otherwise rows are written in unlogged batches and counted against the primary keys already in the bin.
+SAN_ONLOAD_LWT = False
+# Maximum rows and estimated bytes per unlogged batch and number of batches in flight when loading
+# data back into cassandra. Keep SAN_ONLOAD_BATCH_BYTES below the cluster's batch_size_fail_threshold_in_kb.
+SAN_ONLOAD_BATCH_SIZE = 20
+SAN_ONLOAD_BATCH_BYTES = 40 * 1024
+SAN_ONLOAD_CONCURRENCY = 16
+# Offloaded files are listed in a manifest per reference designator with their deployment, row count and
+# first/last time. Every Nth time is kept so readers only load the rows which overlap the request.
+SAN_MANIFEST_INDEX_ROWS = 10000
+# Number of parsed manifests cached per worker
+SAN_MANIFEST_CACHE_SIZE = 100
+# Sampled rows are read from the netCDF files in blocks of this many rows (or the storage chunk size
+# when the file is chunked), each block is read once no matter how many of its rows are selected
+SAN_READ_BLOCK_ROWS = 4096
 # 'san' or 'cass': If data is present in a time bin on both the SAN and Cassandra this option chooses
 # which value to take if the number of entries match.  Otherwise the location with the most data is chosen.
 PREFERRED_DATA_LOCATION = 'cass'
@@ -39,8 +60,67 @@ CASSANDRA_CONTACT_POINTS = ['127.0.0.1']
 CASSANDRA_KEYSPACE = 'ooi'
 CASSANDRA_CONNECT_TIMEOUT = 60
 CASSANDRA_FETCH_SIZE = 1000
+# Target size of a single result page, stream queries size their pages from the estimated row width
+CASSANDRA_TARGET_PAGE_BYTES = 1024 ** 2
+# Bounds on the number of rows per page when sizing pages per stream
+CASSANDRA_MIN_FETCH_SIZE = 100
+CASSANDRA_MAX_FETCH_SIZE = 20000
+# Fraction of queries executed with server side tracing enabled, 0 disables tracing
+CASSANDRA_TRACE_SAMPLE_RATE = 0.0
+# Traces of sampled queries taking at least this long are logged and reported by /metrics
+CASSANDRA_SLOW_QUERY_SECONDS = 5
+# Adaptive limit on the concurrent requests in flight from each worker, shared by all concurrent queries
+CASSANDRA_CONCURRENCY_INITIAL = 32
+CASSANDRA_CONCURRENCY_MIN = 4
+CASSANDRA_CONCURRENCY_MAX = 128
+# Factor applied to the concurrency limit on timeouts and overload errors
+CASSANDRA_CONCURRENCY_BACKOFF = 0.5
+# Responses slower than this multiple of the average latency do not raise the concurrency limit
+CASSANDRA_CONCURRENCY_LATENCY_RATIO = 2.0
+# Send a duplicate request for idempotent bin reads which have not responded within the hedge delay
+CASSANDRA_HEDGED_READS = False
+# The hedge delay is this percentile of the recent time to first page of the same statement
+CASSANDRA_HEDGE_PERCENTILE = 95
+# Statements are not hedged until this many recent executions have been recorded
+CASSANDRA_HEDGE_MIN_SAMPLES = 50
+# Lower bound on the hedge delay in seconds
+CASSANDRA_HEDGE_MIN_DELAY = 0.005
+# Attach the Cassandra query statistics for a request to its provenance when provenance is requested
+QUERY_STATISTICS_IN_PROVENANCE = True
 CASSANDRA_DEFAULT_TIMEOUT = 60
 CASSANDRA_QUERY_CONSISTENCY = 'LOCAL_QUORUM'
+# Maximum number of bins queried concurrently when fetching all data in a time range
+CASSANDRA_MAX_CONCURRENT_BINS = 8
+# Consistency level (e.g. 'LOCAL_ONE') for reading bins which have not received data for
+# CASSANDRA_SETTLED_READ_SECONDS, other bins are read at CASSANDRA_QUERY_CONSISTENCY.
+# None reads every bin at CASSANDRA_QUERY_CONSISTENCY. Requires CASSANDRA_WRITE_MARKER_DIR
+CASSANDRA_SETTLED_READ_CONSISTENCY = None
+CASSANDRA_SETTLED_READ_SECONDS = 7 * 24 * 3600
+# Bins written by insert_dataset are read at CASSANDRA_QUERY_CONSISTENCY for this long after the write
+CASSANDRA_WRITE_GRACE_SECONDS = 24 * 3600
+# Directory shared by all workers where insert_dataset records the bins it wrote
+CASSANDRA_WRITE_MARKER_DIR = None
+# Bins holding more particles than this are read as time slices in parallel
+CASSANDRA_SLICE_PARTITION_ROWS = 1000000
+# Approximate number of particles read by each time slice
+CASSANDRA_SLICE_ROWS = 250000
+# Maximum number of time slices read concurrently and the number of times a failed slice is retried
+CASSANDRA_MAX_CONCURRENT_SLICES = 4
+CASSANDRA_SLICE_RETRIES = 2
+# Maximum number of prepared statements kept per worker, least recently used statements are evicted
+CASSANDRA_STATEMENT_CACHE_SIZE = 500
+# Number of result pages fetched ahead of the page being decoded
+CASSANDRA_PREFETCH_PAGES = 2
+# Number of L0 provenance records cached per worker, and the file used to keep them across worker restarts
+L0_PROVENANCE_CACHE_SIZE = 100000
+L0_PROVENANCE_CACHE_FILE = '/local/l0_provenance_cache.json'
+# Local cache of decoded settled bins, set BIN_CACHE_DIR to a directory (e.g. /local/bin_cache) to enable
+BIN_CACHE_DIR = None
+BIN_CACHE_MAX_BYTES = 50 * 1024 ** 3
+# Rescan the bin cache directory for entries written by other workers after this many seconds
+BIN_CACHE_RESCAN_SECONDS = 600
+# Bins which have received data within this many seconds are not cached
+BIN_CACHE_SETTLE_SECONDS = 3600
 
 
 ############################
@@ -176,6 +256,13 @@ MAX_RETRY_COUNT = 3
 MAX_AGGREGATION_SIZE = 500e6
 # Maximum time spent in aggregation, in seconds
 AGGREGATION_TIMEOUT_SECONDS = 7200
+# Process asynchronous (netcdf-fs, csv-fs) requests one time window at a time to bound memory usage
+ASYNC_CHUNKED_EXECUTION = False
+# Approximate maximum number of primary stream particles fetched and processed per window
+ASYNC_CHUNK_PARTICLES = 2000000
+# Seconds of primary stream data read on either side of each window for derived products and QC
+# which use neighbouring particles, trimmed before the window is written
+ASYNC_CHUNK_OVERLAP_SECONDS = 3600
 
 
 ############################
@@ -194,12 +281,31 @@ UI_FULL_SAMPLE_LIMIT = 5000
 # set a hard limit for the maximum size a limited query can be.  All data can be accessed using an async query.
 UI_HARD_LIMIT = 20000
 QC_RESULTS_STORAGE_SYSTEM = 'none'  # 'log' to write qc results to a file, 'cass' to write qc results to a database
+# Rows per unlogged batch and number of batches in flight when writing qc results to cassandra
+QC_RESULTS_BATCH_SIZE = 100
+QC_RESULTS_CONCURRENCY = 16
 # Number of cassandra rows used to the correct deployment for padding of streams which provide
 # cal coefficients and other needed data
 LOOKBACK_QUERY_LIMIT = 100
 MAX_BIN_SIZE_MIN = 20160
 # Where to start unbounded queries 2010-01-01T00:00:00.000Z
 UNBOUND_QUERY_START = 3471292800
+# Answer limited queries from locally stored per-bin decimation pyramids when available,
+# enabling requires DECIMATION_CACHE_DIR to be set to a local directory (e.g. /local/decimation)
+DECIMATION_ENABLED = False
+DECIMATION_CACHE_DIR = None
+# Number of time buckets per bin at each pyramid level, the first particle in each bucket is kept
+DECIMATION_LEVELS = [100, 1000, 10000]
+# Bins which have received data within this many seconds are not decimated
+DECIMATION_SETTLE_SECONDS = 3600
+# Maximum number of background pyramid builds per worker
+DECIMATION_BUILD_WORKERS = 1
+# Seconds after which a build marker left by another worker is considered abandoned
+DECIMATION_BUILD_TIMEOUT = 1800
+# Seconds to wait before retrying a bin whose pyramid failed to build or store
+DECIMATION_RETRY_SECONDS = 3600
+# Number of pyramids held in memory per worker
+DECIMATION_MEMORY_CACHE_SIZE = 256
 
 
 ############################
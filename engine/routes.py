@@ -10,6 +10,8 @@ from flask import request, Response, jsonify, send_file
 
 import util.aggregation
 import util.calc
+import util.cass
+import util.metadata_service
 from engine import app
 from util.common import (StreamEngineException, TimedOutException, MissingDataException,
                          MissingTimeException, ntp_to_datestring, StreamKey, InvalidPathException)
@@ -20,7 +22,7 @@ log = logging.getLogger(__name__)
 
 @app.errorhandler(Exception)
 def handle_exception(error):
-    request_id = request.get_json().get('requestUUID')
+    request_id = (request.get_json(silent=True) or {}).get('requestUUID')
     if isinstance(error, StreamEngineException):
         error_dict = error.to_dict()
         error_dict['requestUUID'] = request_id
@@ -36,9 +38,19 @@ def handle_exception(error):
     return response, 500
 
 
+@app.before_request
+def begin_request_scope():
+    util.metadata_service.begin_request_scope()
+
+
+@app.teardown_request
+def end_request_scope(error=None):
+    util.metadata_service.end_request_scope()
+
+
 @app.before_request
 def log_request():
-    data = request.get_json()
+    data = request.get_json(silent=True) or {}
     request_id = data.get('requestUUID')
     streams = data.get('streams')
     if log.isEnabledFor(logging.DEBUG):
@@ -416,6 +428,15 @@ def onload_netcdf():
         return Response('"{:s}"'.format(resp), mimetype='text/plain')
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Return the Cassandra query statistics (per statement shape latency, rows, pages, bytes,
+    errors and timeouts) along with the cache statistics of this worker
+    """
+    return jsonify(util.cass.get_metrics())
+
+
 @app.route('/needs', methods=['POST'])
 @set_timeout()
 def needs():
@@ -198,6 +198,7 @@ proc_name = 'stream_engine'
 def post_fork(server, worker):
     server.log.info("Worker spawned (pid: %s)", worker.pid)
     from util.cass import _init
+    from util.common import load_preload_catalog
     from preload_database.database import create_engine_from_url, create_scoped_session
     from ooi_data.postgres.model import MetadataBase
     with worker_lock:
@@ -207,3 +208,4 @@ def post_fork(server, worker):
         engine = create_engine_from_url(None)
         Session = create_scoped_session(engine)
         MetadataBase.query = Session.query_property()
+    load_preload_catalog()
@@ -1,6 +1,6 @@
-#############################################################################################################
-# Disable the @timed_cache() decorator on the util.metadata_service.stream.build_stream_dictionary() method #
-#############################################################################################################
+#####################################################################################################################
+# Disable the @timed_cache() and @refreshing_cache() decorators (util.metadata_service.stream.get_stream_inventory) #
+#####################################################################################################################
 import util.common
 from functools import wraps
 
@@ -14,3 +14,4 @@ def mock_timed_cache(unused):
     return wrapper
 
 util.common.timed_cache = mock_timed_cache
+util.common.refreshing_cache = mock_timed_cache
@@ -0,0 +1,74 @@
+import global_test_setup
+
+import shutil
+import tempfile
+import unittest
+import uuid
+
+import mock
+import numpy as np
+
+from util import bin_cache
+
+
+class BinCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.config = mock.patch.dict(bin_cache.app.config, {'BIN_CACHE_DIR': self.cache_dir,
+                                                             'BIN_CACHE_MAX_BYTES': 10 * 1024 ** 2,
+                                                             'BIN_CACHE_RESCAN_SECONDS': 600})
+        self.config.start()
+        self.index = mock.patch.object(bin_cache, '_index', bin_cache._EntryIndex())
+        self.index.start()
+        self.sk = mock.Mock(method='recovered_host', stream_name='ctdpf_ckl_wfp_instrument_recovered')
+        self.sk.as_three_part_refdes.return_value = 'CP02PMUO-WFP01-03-CTDPFK000'
+        self.columns = {
+            'time': np.arange(100, dtype=np.float64),
+            'deployment': np.ones(100, dtype=np.int32),
+            'id': np.array([uuid.uuid4() for _ in range(100)], dtype=object),
+        }
+
+    def tearDown(self):
+        self.index.stop()
+        self.config.stop()
+        shutil.rmtree(self.cache_dir)
+
+    def test_round_trip(self):
+        bin_cache.store_columns(self.sk, 10, 100, 99.0, self.columns)
+        data = bin_cache.get_columns(self.sk, 10, 100, 99.0, ['time', 'id'])
+        self.assertEqual(set(data), {'time', 'id'})
+        np.testing.assert_array_equal(data['time'], self.columns['time'])
+        np.testing.assert_array_equal(data['id'], self.columns['id'])
+
+    def test_validation(self):
+        bin_cache.store_columns(self.sk, 10, 100, 99.0, {'time': self.columns['time']})
+        # different count or last time, or a column which has not been cached
+        self.assertIsNone(bin_cache.get_columns(self.sk, 10, 101, 99.0, ['time']))
+        self.assertIsNone(bin_cache.get_columns(self.sk, 10, 100, 100.0, ['time']))
+        self.assertIsNone(bin_cache.get_columns(self.sk, 10, 100, 99.0, ['time', 'id']))
+
+        # columns are added to a matching entry
+        bin_cache.store_columns(self.sk, 10, 100, 99.0, {'id': self.columns['id']})
+        self.assertIsNotNone(bin_cache.get_columns(self.sk, 10, 100, 99.0, ['time', 'id']))
+
+    def test_evict(self):
+        with mock.patch.dict(bin_cache.app.config, {'BIN_CACHE_MAX_BYTES': 1500}):
+            bin_cache.store_columns(self.sk, 1, 100, 99.0, {'time': self.columns['time']})
+            bin_cache.store_columns(self.sk, 2, 100, 99.0, {'time': self.columns['time']})
+        # the first entry is evicted to make room for the second
+        self.assertIsNone(bin_cache.get_columns(self.sk, 1, 100, 99.0, ['time']))
+        self.assertIsNotNone(bin_cache.get_columns(self.sk, 2, 100, 99.0, ['time']))
+
+    def test_evict_seeded_index(self):
+        bin_cache.store_columns(self.sk, 1, 100, 99.0, {'time': self.columns['time']})
+        bin_cache.store_columns(self.sk, 2, 100, 99.0, {'time': self.columns['time']})
+
+        # a new worker seeds its index from the entries already on disk, least recently read first
+        with mock.patch.object(bin_cache, '_index', bin_cache._EntryIndex()):
+            bin_cache.get_columns(self.sk, 1, 100, 99.0, ['time'])
+            with mock.patch.dict(bin_cache.app.config, {'BIN_CACHE_MAX_BYTES': 2500}):
+                bin_cache.store_columns(self.sk, 3, 100, 99.0, {'time': self.columns['time']})
+            self.assertEqual(len(bin_cache._index.entries), 2)
+        self.assertIsNotNone(bin_cache.get_columns(self.sk, 1, 100, 99.0, ['time']))
+        self.assertIsNone(bin_cache.get_columns(self.sk, 2, 100, 99.0, ['time']))
+        self.assertIsNotNone(bin_cache.get_columns(self.sk, 3, 100, 99.0, ['time']))
@@ -40,7 +40,7 @@ def get_available_time_range(sk):
 
 
 def get_stream_metadata():
-    return [row[1:6] for row in metadata.itertuples()]
+    return [row[1:6] + row[7:9] for row in metadata.itertuples()]
 
 
 @mock.patch('util.metadata_service.stream.get_available_time_range', new=get_available_time_range)
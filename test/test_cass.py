@@ -0,0 +1,260 @@
+import global_test_setup
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import mock
+import ntplib
+import numpy as np
+from cassandra import ConsistencyLevel
+
+from util import cass
+from util.cass import plan_sample_queries
+from util.common import StreamKey, TimeRange
+
+
+class CassTest(unittest.TestCase):
+    def test_plan_sample_queries(self):
+        # bin: (count, first, last), there is a gap between bins 2 and 3
+        bin_information = {1: (10, 0, 100), 2: (10, 100, 150), 3: (10, 300, 400)}
+        queries = plan_sample_queries(TimeRange(0, 400), 9, [3, 1, 2], bin_information)
+
+        # times within a bin query that bin, times at or after the end of a bin (150, 200, 250 and 400)
+        # collapse to one query for the last particle of that bin, the stop time is always queried
+        self.assertEqual(queries, [(1, 0.0, 1), (1, 50.0, 1), (2, 100.0, 1), (3, 300.0, 1), (3, 350.0, 1),
+                                   (2, 150.0, 1), (3, 400.0, 1), (3, 400, 1)])
+
+    @mock.patch('util.cass.SessionManager')
+    def test_lookback_without_deployments(self, session_manager):
+        # no deployments to pad means no read at all
+        self.assertIsNone(cass.get_cass_lookback_dataset('sk', 100.0, 7, [], None))
+        self.assertFalse(session_manager.method_calls)
+
+    def test_prepare_fetch_size(self):
+        session = mock.Mock()
+        prepared = session.prepare.return_value
+        prepared.fetch_size = None
+        with mock.patch.object(cass.SessionManager, '_SessionManager__session', session, create=True), \
+                mock.patch.object(cass.SessionManager, '_prepared_statement_cache', {}):
+            query = 'select time from ctdpf_sbe43_sample where subsite=? and node=? and sensor=? and bin=? and method=?'
+            small = cass.SessionManager.prepare(query, fetch_size=100)
+            large = cass.SessionManager.prepare(query, fetch_size=5000)
+            self.assertIs(cass.SessionManager.prepare(query), prepared)
+            self.assertEqual(session.prepare.call_count, 1)
+
+            # the shared prepared statement is untouched, each execution binds its own fetch size
+            statement, args = cass.SessionManager._bind_sized(small, (1, 2, 3, 4, 5))
+            self.assertIsNone(prepared.fetch_size)
+            self.assertIsNone(args)
+            prepared.bind.assert_called_with((1, 2, 3, 4, 5))
+            self.assertEqual(statement.fetch_size, 100)
+            self.assertEqual(large.bind((1, 2, 3, 4, 5)).fetch_size, 5000)
+            self.assertEqual(cass.SessionManager._bind_sized(prepared, (1,)), (prepared, (1,)))
+
+    def test_l0_provenance_cache_file(self):
+        cache_dir = tempfile.mkdtemp()
+        path = os.path.join(cache_dir, 'provenance.json')
+        record = {'file_name': 'file.dat', 'parser_name': 'parser', 'parser_version': '1.0'}
+        try:
+            cass.l0_provenance_cache['6a0b2fa8-2ba3-4b4b-8a47-1c3d2e8b4e11'] = record
+            cass.save_l0_provenance_cache(path)
+            cass.l0_provenance_cache.clear()
+
+            cass.load_l0_provenance_cache(path)
+            self.assertEqual(cass.l0_provenance_cache['6a0b2fa8-2ba3-4b4b-8a47-1c3d2e8b4e11'], record)
+        finally:
+            cass.l0_provenance_cache.clear()
+            shutil.rmtree(cache_dir)
+
+    def test_stream_fetch_size(self):
+        stream = mock.Mock(parameters=range(10))
+        stream.name = 'test_stream'
+        stream_key = mock.Mock(stream=stream)
+        config = cass.engine.app.config
+        with mock.patch.dict(cass.SIZE_ESTIMATES, {'test_stream': 1000.0}), mock.patch.dict(cass.fetch_sizes, clear=True):
+            # full rows, 1000 bytes each
+            self.assertEqual(cass.stream_fetch_size(stream_key),
+                             int(config['CASSANDRA_TARGET_PAGE_BYTES'] / 1000.0))
+            # selecting fewer columns allows more rows per page, bounded by the maximum
+            self.assertEqual(cass.stream_fetch_size(stream_key, ['time']),
+                             min(config['CASSANDRA_MAX_FETCH_SIZE'], int(config['CASSANDRA_TARGET_PAGE_BYTES'] / 100.0)))
+
+    def test_hedged_read(self):
+        class FakeFuture(object):
+            def add_callbacks(self, callback, errback, callback_args=(), errback_args=()):
+                self.callback = lambda rows: callback(rows, *callback_args)
+
+        futures = []
+        session = mock.Mock()
+        session.execute_async.side_effect = lambda *args, **kwargs: futures.append(FakeFuture()) or futures[-1]
+        observation = cass.query_metrics.Observation('select a from hedged', 'hedged')
+        received = []
+
+        cass.query_metrics.reset()
+        hedged = cass.HedgedRead(session, 'select a from hedged', (), 0.01, observation)
+        hedged.add_callbacks(callback=received.append, errback=None)
+        # the delay elapses and a second request is sent, which responds first
+        hedged._hedge()
+        futures[1].callback([(1,)])
+        futures[0].callback([(2,)])
+
+        self.assertEqual(received, [[(1,)]])
+        totals = cass.query_metrics.totals()[('hedged', 'select a from hedged')]
+        self.assertEqual(totals['hedges'], 1)
+        self.assertEqual(totals['hedges_won'], 1)
+
+    def test_execute_concurrent_pages(self):
+        class PagedFuture(object):
+            def __init__(self, pages):
+                self.pages = pages
+                self.index = 0
+                self.callbacks = []
+
+            @property
+            def has_more_pages(self):
+                return self.index < len(self.pages) - 1
+
+            def add_callbacks(self, callback, errback, callback_args=(), errback_args=()):
+                # the first page has already arrived
+                self.callbacks.append((callback, callback_args))
+                callback(self.pages[self.index], *callback_args)
+
+            def start_fetching_next_page(self):
+                self.index += 1
+                for callback, args in list(self.callbacks):
+                    callback(self.pages[self.index], *args)
+
+        results = [[[(1,), (2,)], [(3,)]], [[(4,)]]]
+        session = mock.Mock()
+        session.execute_async.side_effect = lambda *args, **kwargs: PagedFuture(results.pop(0))
+
+        cass.query_metrics.reset()
+        with mock.patch.object(cass.SessionManager, '_SessionManager__session', session, create=True):
+            rows = cass.SessionManager.execute_concurrent([('select a from paged', (1,)),
+                                                           ('select a from paged', (2,))])
+        self.assertEqual(rows, [(True, [(1,), (2,), (3,)]), (True, [(4,)])])
+        totals = cass.query_metrics.totals()[('paged', 'select a from paged')]
+        self.assertEqual(totals['executions'], 2)
+        self.assertEqual(totals['rows'], 4)
+        self.assertEqual(totals['pages'], 3)
+        self.assertEqual(cass.concurrency_limiter.stats()['in_flight'], 0)
+
+    def test_execute_paged_slot(self):
+        class PendingFuture(object):
+            has_more_pages = False
+
+            def __init__(self):
+                self.callbacks = []
+
+            def add_callbacks(self, callback, errback, callback_args=(), errback_args=()):
+                self.callbacks.append((callback, callback_args))
+
+            def respond(self, rows):
+                for callback, args in self.callbacks:
+                    callback(rows, *args)
+
+        future = PendingFuture()
+        session = mock.Mock()
+        session.execute_async.return_value = future
+        limiter = cass.ConcurrencyLimiter(4, 1, 8, 0.5, 2.0)
+        with mock.patch.object(cass.SessionManager, '_SessionManager__session', session, create=True), \
+                mock.patch.object(cass, 'concurrency_limiter', limiter):
+            reader = cass.SessionManager.execute_paged('select a from slotted', (1,))
+            # single paged reads are bounded by the limiter until the first page arrives
+            self.assertEqual(limiter.stats()['in_flight'], 1)
+            future.respond([(1,)])
+            self.assertEqual(limiter.stats()['in_flight'], 0)
+            self.assertEqual(list(reader), [[(1,)]])
+
+    def test_concurrency_limiter(self):
+        limiter = cass.ConcurrencyLimiter(10, 2, 12, 0.5, 2.0)
+        for _ in xrange(10):
+            limiter.acquire()
+        self.assertEqual(limiter.stats()['in_flight'], 10)
+
+        # stable latency raises the limit by about one per limit responses
+        for _ in xrange(10):
+            limiter.release(1.0)
+        self.assertEqual(limiter.stats()['limit'], 10)
+        limiter.acquire()
+        limiter.release(1.0)
+        self.assertEqual(limiter.stats()['limit'], 11)
+
+        # a burst of timeouts halves the limit once
+        for _ in xrange(3):
+            limiter.acquire()
+        for _ in xrange(3):
+            limiter.release(5.0, cass.query_metrics.OperationTimedOut())
+        self.assertEqual(limiter.stats()['limit'], 5)
+        self.assertEqual(limiter.stats()['decreases'], 1)
+        self.assertEqual(limiter.stats()['in_flight'], 0)
+
+    def test_plan_time_slices(self):
+        config = cass.engine.app.config
+        # small bins are read with a single query
+        self.assertEqual(cass.plan_time_slices(TimeRange(0, 100), (1000, 0, 100)), [TimeRange(0, 100)])
+
+        count = config['CASSANDRA_SLICE_ROWS'] * 4
+        with mock.patch.dict(config, {'CASSANDRA_SLICE_PARTITION_ROWS': count - 1}):
+            slices = cass.plan_time_slices(TimeRange(-10, 100), (count, 0, 100))
+            self.assertEqual(slices, [TimeRange(-10, 25), TimeRange(25, 50), TimeRange(50, 75), TimeRange(75, 100)])
+
+            # only the part of the bin within the time range is split
+            slices = cass.plan_time_slices(TimeRange(50, 100), (count, 0, 100))
+            self.assertEqual(slices, [TimeRange(50, 75), TimeRange(75, 100)])
+
+    @mock.patch('util.cass.execute_columnar_query')
+    @mock.patch('util.cass.execute_bin_columnar_query')
+    @mock.patch('util.cass.bin_cache')
+    def test_read_bin_columns_cache_fill(self, bin_cache, bin_query, range_query):
+        bin_cache.get_columns.return_value = None
+        bin_cache.is_settled.return_value = True
+        bin_query.return_value = {'time': np.arange(10, 20, dtype=np.float64)}
+        bin_info = (10, 10.0, 19.0)
+
+        # a request for part of a bin reads only its range and leaves the cache alone
+        cass.read_bin_columns('sk', ['time'], 1, TimeRange(12, 14), bin_info)
+        self.assertEqual(range_query.call_count, 1)
+        self.assertFalse(bin_query.called)
+        self.assertFalse(bin_cache.store_columns.called)
+
+        # a request covering the whole bin populates the cache
+        data = cass.read_bin_columns('sk', ['time'], 1, TimeRange(0, 100), bin_info)
+        bin_cache.store_columns.assert_called_once_with('sk', 1, 10, 19.0, bin_query.return_value)
+        np.testing.assert_array_equal(data['time'], np.arange(10, 20))
+
+    def test_plan_batches(self):
+        narrow = ('CE04OSPS', 1.0, 2, 'x' * 100)
+        wide = ('CE04OSPS', 1.0, 2, 'x' * 3000)
+        # narrow rows are limited by the row count, wide rows by the estimated size
+        self.assertEqual(cass.plan_batches([narrow] * 25, 10, 10000), [(0, 10), (10, 20), (20, 25)])
+        self.assertEqual(cass.plan_batches([narrow] * 3 + [wide] * 2, 10, 1000), [(0, 3), (3, 4), (4, 5)])
+        self.assertEqual(cass.plan_batches([], 10, 1000), [])
+
+    def test_bin_consistency(self):
+        now = ntplib.system_to_ntp_time(time.time())
+        settled = (10, now - 400 * 86400, now - 365 * 86400)
+        live = (10, now - 3600, now - 60)
+        sk = StreamKey('RS01SBPS', 'SF01A', '2A-CTDPFA102', 'streamed', 'ctdpf_sbe43_sample')
+        marker_dir = tempfile.mkdtemp()
+        try:
+            with mock.patch.object(cass, 'SETTLED_READ_CONSISTENCY', ConsistencyLevel.LOCAL_ONE):
+                # without a shared marker directory writes by other workers cannot be seen
+                with mock.patch.dict(cass.engine.app.config, {'CASSANDRA_WRITE_MARKER_DIR': None}):
+                    self.assertIsNone(cass.bin_consistency(sk, 1, settled))
+
+                with mock.patch.dict(cass.engine.app.config, {'CASSANDRA_WRITE_MARKER_DIR': marker_dir}):
+                    self.assertEqual(cass.bin_consistency(sk, 1, settled), ConsistencyLevel.LOCAL_ONE)
+                    self.assertIsNone(cass.bin_consistency(sk, 2, live))
+                    self.assertIsNone(cass.bin_consistency(sk, 3, None))
+
+                    # a bin onloaded by any worker is read at the default level during the grace window
+                    cass.record_bin_write(sk, 1)
+                    self.assertTrue(os.path.exists(cass._write_marker_path(sk, 1)))
+                    self.assertIsNone(cass.bin_consistency(sk, 1, settled))
+                    self.assertEqual(cass.bin_consistency(sk, 4, settled), ConsistencyLevel.LOCAL_ONE)
+        finally:
+            shutil.rmtree(marker_dir)
@@ -9,6 +9,7 @@ from datetime import datetime
 import util.common as common
 from ooi_data.postgres.model import MetadataBase
 from preload_database.database import create_engine_from_url, create_scoped_session
+from sqlalchemy.orm import object_session
 
 
 TEST_DIR = os.path.dirname(__file__)
@@ -119,3 +120,24 @@ class CommonTest(unittest.TestCase):
         sk2 = common.StreamKey(subsite2, node2, sensor2, method2, stream)
         self.assertTrue(sk1.is_mobile)
         self.assertFalse(sk2.is_mobile)
+
+    def test_preload_catalog(self):
+        stream = common.get_stream('nutnr_a_sample')
+        self.assertIs(common.stream_cache['nutnr_a_sample'], stream)
+        self.assertIs(common.get_stream('nutnr_a_sample'), stream)
+        self.assertIs(common.StreamKey(1, 2, 3, 4, 'nutnr_a_sample').stream, stream)
+        self.assertIsNone(common.get_stream('not_a_stream'))
+
+        # catalog entries are fully loaded and detached from the session
+        self.assertIsNone(object_session(stream))
+        self.assertTrue(all(object_session(p) is None for p in stream.parameters))
+        self.assertTrue(stream.derived is not None and stream.source_streams is not None)
+
+        # records reached through the stream are registered, a later lookup returns the same instance
+        self.assertIs(common.get_stream_by_id(stream.id), stream)
+        for p in stream.parameters:
+            self.assertIs(common.get_parameter(p.id), p)
+
+        parameter = common.get_parameter(13)
+        self.assertEqual(parameter.id, 13)
+        self.assertIs(common.get_parameter(13), parameter)
@@ -12,7 +12,7 @@ import numpy as np
 from preload_database.database import create_engine_from_url, create_scoped_session
 from ooi_data.postgres.model import Stream, Parameter, MetadataBase
 from util.common import StreamKey
-from util.datamodel import to_xray_dataset, _get_fill_value, _replace_values
+from util.datamodel import to_xray_dataset, _get_fill_value, _replace_values, ColumnBuilder
 
 TEST_DIR = os.path.dirname(__file__)
 DATA_DIR = os.path.join(TEST_DIR, 'data')
@@ -54,6 +54,28 @@ class DataModelTest(TestCase):
         found = self.find_int64_vars(ds)
         self.assertEqual(found, set())
 
+    def test_columnar_matches_rows(self):
+        echo_fn = 'echo_sounding.nc'
+        echo_sk = StreamKey('RS01SLBS', 'LJ01A', '05-HPIESA101', 'streamed', 'echo_sounding')
+        echo_ds = xr.open_dataset(os.path.join(DATA_DIR, echo_fn), decode_times=False)
+
+        echo_df = echo_ds.to_dataframe()
+        cols = list(echo_df.columns)
+        rows = list(echo_df.itertuples(index=False))
+
+        # decode in two pages with an undersized hint to exercise growing the arrays
+        builder = ColumnBuilder(cols, echo_sk, size_hint=10)
+        builder.add_page(rows[:len(rows) / 2])
+        builder.add_page(rows[len(rows) / 2:])
+
+        row_ds = to_xray_dataset(cols, rows, echo_sk, None)
+        col_ds = to_xray_dataset(cols, builder.columns(), echo_sk, None)
+
+        self.assertEqual(set(row_ds.data_vars), set(col_ds.data_vars))
+        for var in row_ds.data_vars:
+            self.assertEqual(row_ds[var].dtype, col_ds[var].dtype)
+            np.testing.assert_array_equal(row_ds[var].values, col_ds[var].values)
+
     def test_shared_dimensions(self):
         adcp_fn = 'deployment0000_RS03AXBS-LJ03A-10-ADCPTE301-streamed-adcp_velocity_beam.nc'
         adcp_sk = StreamKey('RS03AXBS', 'LJ03A', '10-ADCPTE301', 'streamed', 'adcp_velocity_beam')
@@ -0,0 +1,91 @@
+import global_test_setup
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+import numpy as np
+
+from util import decimation
+from util.common import TimeRange
+
+
+class DecimationTest(unittest.TestCase):
+    def setUp(self):
+        self.times = np.arange(1000, 2000, dtype=np.float64)
+        self.columns = {
+            'time': self.times,
+            'id': np.array([str(i) for i in range(self.times.size)], dtype=object),
+            'value': self.times * 2,
+        }
+        self.pyramid = decimation.build_pyramid(self.columns, self.times.size, self.times[0], self.times[-1])
+
+    def test_build_levels(self):
+        for buckets, indexes in self.pyramid.levels.iteritems():
+            self.assertLessEqual(indexes.size, buckets)
+            times = self.pyramid.columns['time'][indexes]
+            self.assertTrue(np.all(np.diff(times) > 0))
+            self.assertEqual(times[0], self.times[0])
+
+    def test_select(self):
+        data = self.pyramid.select(TimeRange(1200, 1400), 50, ['time', 'value'])
+        self.assertEqual(set(data), {'time', 'value'})
+        self.assertLessEqual(data['time'].size, 50)
+        self.assertGreater(data['time'].size, 25)
+        self.assertTrue(np.all(data['time'] >= 1200))
+        self.assertTrue(np.all(data['time'] <= 1400))
+        np.testing.assert_array_equal(data['value'], data['time'] * 2)
+
+    def test_validate(self):
+        self.assertTrue(self.pyramid.is_valid(1000, 1999, ['time']))
+        self.assertFalse(self.pyramid.is_valid(1001, 1999, ['time']))
+        self.assertFalse(self.pyramid.is_valid(1000, 2000, ['time']))
+        self.assertFalse(self.pyramid.is_valid(1000, 1999, ['pressure']))
+
+    def test_store_and_load(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            sk = mock.Mock(method='telemetered', stream_name='ctdpf_sbe43_sample')
+            sk.as_three_part_refdes.return_value = 'CE04OSPS-SF01B-2A-CTDPFA107'
+            with mock.patch.dict(decimation.app.config, {'DECIMATION_CACHE_DIR': cache_dir}):
+                decimation.store_pyramid(sk, 5, self.pyramid)
+                decimation._pyramid_cache.clear()
+                self.assertTrue(os.path.exists(decimation._pyramid_path(sk, 5)))
+
+                pyramid = decimation.get_pyramid(sk, 5, 1000, 1999, ['time', 'id'])
+                self.assertIsNotNone(pyramid)
+                np.testing.assert_array_equal(pyramid.columns['id'], self.pyramid.columns['id'])
+                self.assertIsNone(decimation.get_pyramid(sk, 5, 1001, 1999, ['time']))
+                self.assertIsNone(decimation.get_pyramid(sk, 6, 1000, 1999, ['time']))
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_build_claims(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            sk = mock.Mock(method='telemetered', stream_name='ctdpf_sbe43_sample')
+            sk.as_three_part_refdes.return_value = 'CE04OSPS-SF01B-2A-CTDPFA107'
+            config = {'DECIMATION_CACHE_DIR': cache_dir, 'DECIMATION_BUILD_TIMEOUT': 1800,
+                      'DECIMATION_RETRY_SECONDS': 3600}
+            with mock.patch.dict(decimation.app.config, config):
+                self.assertTrue(decimation.start_build(sk, 5))
+                self.assertFalse(decimation.start_build(sk, 5))
+                # another worker process sees the build marker
+                with mock.patch.object(decimation, '_pending', set()):
+                    self.assertFalse(decimation.start_build(sk, 5))
+                    with mock.patch.dict(decimation.app.config, {'DECIMATION_BUILD_TIMEOUT': 0}):
+                        self.assertTrue(decimation.start_build(sk, 5))
+
+                # a failed build is not retried until DECIMATION_RETRY_SECONDS have passed
+                decimation.finish_build(sk, 5, failed=True)
+                self.assertFalse(decimation.start_build(sk, 5))
+                with mock.patch.dict(decimation.app.config, {'DECIMATION_RETRY_SECONDS': 0}):
+                    self.assertTrue(decimation.start_build(sk, 5))
+                decimation.finish_build(sk, 5)
+                self.assertFalse(os.path.exists(decimation._pyramid_path(sk, 5) + decimation.FAILED_SUFFIX))
+                self.assertTrue(decimation.start_build(sk, 5))
+                decimation.finish_build(sk, 5)
+        finally:
+            shutil.rmtree(cache_dir)
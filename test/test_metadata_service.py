@@ -78,6 +78,7 @@ class MetadataServiceTest(unittest.TestCase):
 
     def setUp(self):
         mock_metadata_service_api.test_clean_up()
+        util.metadata_service.clear_partition_metadata_cache()
 
     def __build_knockoff_stream_key(self):
         subsite = 'test_subsite'
@@ -195,6 +196,27 @@ class MetadataServiceTest(unittest.TestCase):
         actual_result = util.metadata_service.get_available_time_range(sk)
         self.assertEqual(actual_result, expected_result)
 
+    def test_stream_inventory(self):
+        ##############
+        # Test Setup #
+        ##############
+        for node_suffix in range(2):
+            for sensor_suffix in range(2):
+                for stream_suffix in range(2):
+                    self.__stream_test_setup(1.1, 2.2, 3, node_suffix=node_suffix, sensor_suffix=sensor_suffix,
+                                             stream_suffix=stream_suffix)
+        ########
+        # Test #
+        ########
+        inventory = util.metadata_service.get_stream_inventory()
+        self.assertEqual(sorted(inventory.designators),
+                         [('test_method', 'test_subsite', 'test_node0'), ('test_method', 'test_subsite', 'test_node1')])
+        self.assertEqual(inventory.sensors('test_method', 'test_subsite', 'test_node1', 'test_stream0'),
+                         ['test_sensor0', 'test_sensor1'])
+        self.assertEqual(inventory.sensors('test_method', 'test_subsite', 'test_node2', 'test_stream0'), [])
+        self.assertEqual(inventory.time_ranges[('test_subsite', 'test_node0', 'test_sensor1', 'test_method',
+                                                'test_stream1')], TimeRange(1.1, 2.2 + 1))
+
     #####################
     # Partition Methods #
     #####################
@@ -356,3 +378,52 @@ class MetadataServiceTest(unittest.TestCase):
         ########
         self.assertEqual(util.metadata_service.get_particle_count(sk, tr), count)
 
+    def test_get_particle_counts(self):
+        tr = TimeRange(10, 100)
+        sk0 = self.__partition_test_setup(10, CASS_LOCATION_NAME, 11, 19, 11, stream_suffix=0)
+        self.__partition_test_setup(20, SAN_LOCATION_NAME, 21, 29, 12, stream_suffix=0)
+        self.__partition_test_setup(200, CASS_LOCATION_NAME, 201, 209, 13, stream_suffix=0)
+        sk1 = self.__partition_test_setup(30, CASS_LOCATION_NAME, 31, 39, 14, stream_suffix=1)
+        sk2 = self.__partition_test_setup(40, CASS_LOCATION_NAME, 41, 49, 15, stream_suffix=2)
+
+        counts = util.metadata_service.get_particle_counts([sk0, sk1, sk2, sk0], tr)
+        self.assertEqual(set(counts), {sk0, sk1, sk2})
+        self.assertEqual(counts[sk0].count, 23)
+        self.assertEqual(counts[sk0].bins, [(10, CASS_LOCATION_NAME), (20, SAN_LOCATION_NAME)])
+        self.assertEqual(counts[sk0].stores, {CASS_LOCATION_NAME: 11, SAN_LOCATION_NAME: 12})
+        self.assertEqual(counts[sk1].count, 14)
+        self.assertEqual(counts[sk2].count, 15)
+        self.assertEqual(util.metadata_service.get_particle_counts([sk1], tr)[sk1].count, 14)
+
+    def test_partition_metadata_cache(self):
+        tr = TimeRange(0, 100)
+        sk = self.__partition_test_setup(10, CASS_LOCATION_NAME, 11, 19, 11)
+        self.assertEqual(util.metadata_service.get_particle_count(sk, tr), 11)
+
+        # records are cached until invalidated
+        self.__partition_test_setup(20, CASS_LOCATION_NAME, 21, 29, 12)
+        self.assertEqual(util.metadata_service.get_particle_count(sk, tr), 11)
+        util.metadata_service.invalidate_partition_metadata(sk)
+        self.assertEqual(util.metadata_service.get_particle_count(sk, tr), 23)
+
+        # a request keeps its view of the records even when the process cache is cleared
+        util.metadata_service.begin_request_scope()
+        try:
+            self.assertEqual(util.metadata_service.get_particle_count(sk, tr), 23)
+            self.__partition_test_setup(30, CASS_LOCATION_NAME, 31, 39, 13)
+            with util.metadata_service.partition._partition_cache_lock:
+                util.metadata_service.partition._partition_cache.clear()
+            self.assertEqual(util.metadata_service.get_particle_count(sk, tr), 23)
+        finally:
+            util.metadata_service.end_request_scope()
+        self.assertEqual(util.metadata_service.get_particle_count(sk, tr), 36)
+
+    def test_partition_index(self):
+        records = [{'bin': b, 'store': CASS_LOCATION_NAME, 'count': 1, 'first': first, 'last': last}
+                   for b, first, last in [(30, 31, 39), (0, 1, 50), (10, 11, 19), (20, 21, 29)]]
+        index = util.metadata_service.PartitionIndex(records)
+
+        # the long running first bin overlaps every range within it
+        self.assertItemsEqual([r.bin for r in index.overlapping(TimeRange(40, 45))], [0])
+        self.assertItemsEqual([r.bin for r in index.overlapping(TimeRange(20, 32))], [0, 20, 30])
+        self.assertEqual([r.bin for r in index.before(25, 2)], [20, 10])
@@ -0,0 +1,64 @@
+import global_test_setup
+
+import unittest
+
+from cassandra import OperationTimedOut
+
+from util import query_metrics
+
+
+class QueryMetricsTest(unittest.TestCase):
+    def setUp(self):
+        query_metrics.reset()
+
+    def test_statement_shape(self):
+        shape, table = query_metrics.statement_shape('select time, deployment from ctdbp_no_sample\n'
+                                                     '  where subsite=? and node=?')
+        self.assertEqual(shape, 'select time, deployment from ctdbp_no_sample where subsite=? and node=?')
+        self.assertEqual(table, 'ctdbp_no_sample')
+
+        _, table = query_metrics.statement_shape('insert into ooi.qc_results (subsite) values (?)')
+        self.assertEqual(table, 'qc_results')
+
+    def test_record_and_difference(self):
+        query_metrics.record('select a from t', 't', 0.002, 10, 1, 1000)
+        before = query_metrics.totals()
+
+        query_metrics.record('select a from t', 't', 0.2, 5000, 3, 500000)
+        query_metrics.record('select a from t', 't', 12, 0, 0, 0, OperationTimedOut())
+        query_metrics.record('select b from u', 'u', 0.01, 1, 1, 0, ValueError())
+
+        stats = {s['table']: s for s in query_metrics.snapshot()}
+        self.assertEqual(stats['t']['executions'], 3)
+        self.assertEqual(stats['t']['rows'], 5010)
+        self.assertEqual(stats['t']['timeouts'], 1)
+        self.assertEqual(stats['t']['histograms']['latency']['0.0025'], 1)
+        self.assertEqual(stats['t']['histograms']['latency']['+Inf'], 0)
+        self.assertEqual(stats['t']['histograms']['rows']['10000'], 1)
+        self.assertEqual(stats['u']['errors'], 1)
+        self.assertEqual(stats['u']['timeouts'], 0)
+
+        delta = {s['table']: s for s in query_metrics.difference(before)}
+        self.assertEqual(delta['t']['executions'], 2)
+        self.assertEqual(delta['t']['rows'], 5000)
+        self.assertEqual(delta['t']['pages'], 3)
+        self.assertEqual(delta['u']['executions'], 1)
+
+    def test_observation(self):
+        observation = query_metrics.Observation('select a from t', 't', row_bytes=10)
+        observation.add_page(100)
+        observation.add_page(50)
+        observation.finish()
+        # finishing twice records once
+        observation.finish()
+
+        stats = query_metrics.snapshot()[0]
+        self.assertEqual(stats['executions'], 1)
+        self.assertEqual(stats['pages'], 2)
+        self.assertEqual(stats['estimated_bytes'], 1500)
+
+    def test_latency_percentile(self):
+        for latency in range(1, 101):
+            query_metrics.record('select a from t', 't', latency / 1000.0, 1, 1, 0, first_page=latency / 1000.0)
+        self.assertIsNone(query_metrics.latency_percentile('select a from t', 't', 95, 200))
+        self.assertAlmostEqual(query_metrics.latency_percentile('select a from t', 't', 95, 50), 0.09505)
@@ -0,0 +1,91 @@
+import global_test_setup
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+import numpy as np
+import xarray as xr
+
+from util import san
+from util.common import TimeRange
+
+
+class SanManifestTest(unittest.TestCase):
+    def setUp(self):
+        self.san_dir = tempfile.mkdtemp()
+        self.config = mock.patch.dict(san.app.config, {'SAN_BASE_DIRECTORY': self.san_dir,
+                                                       'SAN_MANIFEST_INDEX_ROWS': 10,
+                                                       'SAN_READ_BLOCK_ROWS': 8})
+        self.config.start()
+        self.sk = mock.Mock(subsite='CP02PMUO', node='WFP01', sensor='03-CTDPFK000', method='recovered_host',
+                            stream_name='ctdpf_ckl_wfp_instrument_recovered')
+        self.data_bin = 3600000000
+
+    def tearDown(self):
+        self.config.stop()
+        shutil.rmtree(self.san_dir)
+
+    def write_file(self, deployment, times):
+        nc_directory = san.get_SAN_directories(self.sk).format(self.data_bin)
+        if not os.path.exists(nc_directory):
+            os.makedirs(nc_directory)
+        path = san.get_nc_filename(self.sk, nc_directory, deployment)
+        xr.Dataset({'time': ('index', times), 'pressure': ('index', times * 2)}).to_netcdf(path=path)
+        return path
+
+    def test_row_bounds(self):
+        entry = {'count': 95, 'index_rows': 10, 'index': range(0, 95, 10)}
+        self.assertEqual(san._row_bounds(entry, TimeRange(25, 44)), (20, 50))
+        self.assertEqual(san._row_bounds(entry, TimeRange(-10, 200)), (0, 95))
+        self.assertEqual(san._row_bounds({'path': 'unindexed.nc'}, TimeRange(25, 44)), (0, None))
+
+    def test_manifest(self):
+        self.write_file(1, np.arange(100, dtype=np.float64))
+        self.write_file(2, np.arange(200, 250, dtype=np.float64))
+        san.update_manifest(self.sk, self.data_bin)
+
+        ref_des_dir = san.get_SAN_directories(self.sk, split=True)[0]
+        entries = san.get_manifest(ref_des_dir)['bins']['recovered_host'][str(self.data_bin)]
+        self.assertEqual(sorted((e['deployment'], e['count'], e['first'], e['last']) for e in entries),
+                         [(1, 100, 0.0, 99.0), (2, 50, 200.0, 249.0)])
+
+        # files offloaded later are added to the existing entry
+        self.write_file(2, np.arange(250, 260, dtype=np.float64))
+        san.update_manifest(self.sk, self.data_bin)
+        deployments = san.get_deployment_directories(self.sk, self.data_bin)
+        self.assertEqual([name for name, _, _ in deployments], ['deployment_0001', 'deployment_0002'])
+        self.assertEqual(len(deployments[1][2]), 2)
+
+        _, direct, files = deployments[0]
+        data = san.get_deployment_data(direct, self.sk.stream_name, -1, TimeRange(25, 44), files=files)
+        np.testing.assert_array_equal(data.time.values, np.arange(25, 45))
+        np.testing.assert_array_equal(data.pressure.values, np.arange(25, 45) * 2)
+        self.assertIsNone(san.get_deployment_data(direct, self.sk.stream_name, -1, TimeRange(150, 160), files=files))
+
+        # without a manifest the deployment directory is listed
+        data = san.get_deployment_data(direct, self.sk.stream_name, -1, TimeRange(25, 44))
+        np.testing.assert_array_equal(data.time.values, np.arange(25, 45))
+
+    def test_read_rows(self):
+        variable = xr.DataArray(np.arange(100).reshape(50, 2), dims=('obs', 'dim'))
+        for selection in ([3, 4, 5], [0, 7, 8, 30, 49], [1, 1, 2, 40]):
+            selection = np.array(selection)
+            np.testing.assert_array_equal(san._read_rows(variable, selection), variable.values[selection])
+
+    def test_projected_sample(self):
+        self.write_file(1, np.arange(100, dtype=np.float64))
+        san.update_manifest(self.sk, self.data_bin)
+        _, direct, files = san.get_deployment_directories(self.sk, self.data_bin)[0]
+
+        data = san.get_deployment_data(direct, self.sk.stream_name, 5, TimeRange(10, 90), files=files,
+                                       columns=['conductivity'])
+        self.assertIn('time', data)
+        self.assertNotIn('pressure', data)
+        np.testing.assert_array_equal(data.time.values, [10, 30, 50, 70, 90])
+
+        data = san.get_deployment_data(direct, self.sk.stream_name, 5, TimeRange(10, 90), files=files,
+                                       columns=['pressure'])
+        np.testing.assert_array_equal(data.pressure.values, [20, 60, 100, 140, 180])
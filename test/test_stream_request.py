@@ -4,6 +4,8 @@ import global_test_setup
 import json
 import logging
 import os
+import shutil
+import tempfile
 import unittest
 import httplib
 import ast
@@ -15,16 +17,21 @@ import xarray as xr
 import math
 
 from preload_database.database import create_engine_from_url, create_scoped_session
-from ooi_data.postgres.model import Parameter, MetadataBase
+from ooi_data.postgres.model import MetadataBase
 from util.asset_management import AssetEvents
-from util.common import StreamKey, TimeRange, StreamEngineException, InvalidParameterException, read_size_config
-from util.csvresponse import CsvGenerator
+from util.common import (StreamKey, TimeRange, StreamEngineException, InvalidParameterException, read_size_config,
+                         get_parameter)
+from util.csvresponse import CsvGenerator, ChunkedCsvWriter
 from util.jsonresponse import JsonResponse
 from util.netcdf_generator import NetcdfGenerator
 from util.netcdf_utils import rename_glider_lat_lon
 from util.stream_dataset import StreamDataset
 from util.stream_request import StreamRequest, SIZE_ESTIMATES
-from util.calc import execute_stream_request, validate
+from util.calc import (execute_stream_request, validate, plan_request_chunks, execute_chunked_stream_request,
+                       RequestParameters)
+from util.cass import get_full_cass_dataset, SessionManager, REQUIRED_QUERY_COLUMNS
+from util.location_metadata import LocationMetadata
+from util.metadata_service import ParticleCount
 
 TEST_DIR = os.path.dirname(__file__)
 DATA_DIR = os.path.join(TEST_DIR, 'data')
@@ -50,7 +57,7 @@ def get_available_time_range(sk):
 
 
 def get_stream_metadata():
-    return [row[1:6] for row in metadata.itertuples()]
+    return [row[1:6] + row[7:9] for row in metadata.itertuples()]
 
 
 @mock.patch('util.metadata_service.stream.get_available_time_range', new=get_available_time_range)
@@ -129,6 +136,33 @@ class StreamRequestTest(unittest.TestCase):
         # if internal only, no external stream should exist in stream_parameters
         self.assertEqual(set(sr.stream_parameters), {sk})
 
+    def test_query_columns(self):
+        sk = StreamKey('RS03AXBS', 'LJ03A', '12-CTDPFB301', 'streamed', 'ctdpf_optode_sample')
+        tr = TimeRange(3617736678.149051, 3661524609.0570827)
+        sr = StreamRequest(sk, [911], {}, tr, {}, request_id='UNIT')
+        # practical salinity (PD911) is computed from the L1 conductivity, temperature and pressure,
+        # which are computed from the L0 counts
+        expected = {'practical_salinity', 'seawater_conductivity', 'seawater_temperature', 'seawater_pressure',
+                    'conductivity', 'temperature', 'pressure', 'pressure_temp'}
+        self.assertEqual(sr.stream_columns[sk] - REQUIRED_QUERY_COLUMNS, expected)
+
+        # only the stored L0 columns are selected from cassandra, with the columns every read needs
+        table_columns = ['subsite', 'node', 'sensor', 'bin', 'method', 'time', 'deployment', 'id', 'provenance']
+        table_columns += [p.name for p in sk.stream.parameters if not p.is_function]
+        cluster = mock.MagicMock()
+        keyspace = cluster.metadata.keyspaces.__getitem__.return_value
+        keyspace.tables.__getitem__.return_value.columns.keys.return_value = table_columns
+        read_bin_columns = lambda stream_key, cols, *args: {c: np.zeros(1) for c in cols}
+        with mock.patch.object(SessionManager, 'cluster', cluster, create=True), \
+                mock.patch.object(SessionManager, '_SessionManager__session', mock.Mock(), create=True), \
+                mock.patch('util.cass.read_bin_columns', side_effect=read_bin_columns), \
+                mock.patch('util.cass.to_xray_dataset') as to_xray_dataset:
+            get_full_cass_dataset(sk, tr, LocationMetadata({1: (1, tr.start, tr.stop)}),
+                                  columns=sr.stream_columns[sk])
+        self.assertEqual(set(to_xray_dataset.call_args[0][0]),
+                         {'time', 'deployment', 'id', 'provenance',
+                          'conductivity', 'temperature', 'pressure', 'pressure_temp'})
+
     def test_need_external(self):
         # nutnr_a_sample requests PD908 and PD911
         tr = TimeRange(3617736678.149051, 3661524609.0570827)
@@ -228,6 +262,28 @@ class StreamRequestTest(unittest.TestCase):
                                'salinity_corrected_nitrate_qc_results']
         self.assert_parameters_in_datasets(sr.datasets[self.nut_sk].datasets, expected_parameters)
 
+    @mock.patch('util.qc_executor.QcResultsWriter')
+    def test_qc_results_storage(self, writer_class):
+        writer = writer_class.return_value
+        writer.finish.return_value = {'written': 10, 'failed': 5, 'errors': ['timeout']}
+        sr = self.create_nut_sr()
+        for dataset in sr.datasets[self.nut_sk].datasets.itervalues():
+            dataset['id'] = ('obs', ['00000000-0000-0000-0000-%012d' % i for i in xrange(dataset.time.size)])
+            dataset['bin'] = ('obs', np.zeros(dataset.time.size, dtype=np.int64))
+        sr.calculate_derived_products()
+
+        with mock.patch.dict('util.qc_executor.app.config', {'QC_RESULTS_STORAGE_SYSTEM': 'cass'}):
+            sr.execute_qc()
+
+        writer_class.assert_called_once_with('UNIT')
+        pk = {'subsite': self.nut_sk.subsite, 'node': self.nut_sk.node,
+              'sensor': self.nut_sk.sensor, 'stream': self.nut_sk.stream_name}
+        written = {args[5]: args[1] for args, _ in writer.write.call_args_list}
+        self.assertEqual(written.get('salinity_corrected_nitrate'), pk)
+        self.assertEqual(writer.finish.call_count, 1)
+        self.assertEqual(sr.datasets[self.nut_sk].provenance_metadata.messages,
+                         ['Failed to store 5 of 15 QC results: timeout'])
+
     def test_metbk_hourly_needs(self):
         hourly_sk = StreamKey('CP01CNSM', 'SBD11', '06-METBKA000', 'telemetered', 'metbk_hourly')
         met_sk = StreamKey('CP01CNSM', 'SBD11', '06-METBKA000', 'telemetered', 'metbk_a_dcl_instrument')
@@ -428,17 +484,133 @@ class StreamRequestTest(unittest.TestCase):
 
                 sr = execute_stream_request(validate(input_data))
                 self.assertIn(self.echo_sk, sr.external_includes)
-                expected = {Parameter.query.get(2575)}
+                expected = {get_parameter(2575)}
                 self.assertEqual(expected, sr.external_includes[self.echo_sk])
 
                 self.assertIn(self.nut_sk, sr.external_includes)
-                expected = Parameter.query.get(2327)
+                expected = get_parameter(2327)
                 self.assertIn(expected, sr.external_includes[self.nut_sk])
-                expected = Parameter.query.get(2328)
+                expected = get_parameter(2328)
                 self.assertIn(expected, sr.external_includes[self.nut_sk])
-                expected = Parameter.query.get(2329)
+                expected = get_parameter(2329)
                 self.assertIn(expected, sr.external_includes[self.nut_sk])
 
+    def test_plan_request_chunks(self):
+        input_data = json.load(open(os.path.join(DATA_DIR, 'multiple_stream_request.json')))
+        input_data['start'] = 0
+        input_data['stop'] = 1000
+        # windows are cut at the start of each bin which would overflow the window
+        cass = LocationMetadata({1: (10, 1, 100), 2: (10, 100.1, 200), 3: (10, 300, 400), 4: (10, 500, 600)})
+        san = LocationMetadata({})
+
+        def get_location_metadata(stream_key, time_range):
+            return cass, san, []
+
+        with mock.patch('util.calc.get_location_metadata', new=get_location_metadata):
+            with mock.patch.dict('util.calc.app.config', {'ASYNC_CHUNK_PARTICLES': 20}):
+                chunks = plan_request_chunks(validate(input_data))
+
+        self.assertEqual(chunks, [TimeRange(0, 300), TimeRange(300, 1000)])
+
+    def test_plan_request_chunks_high_rate(self):
+        input_data = json.load(open(os.path.join(DATA_DIR, 'multiple_stream_request.json')))
+        input_data['start'] = 0
+        input_data['stop'] = 1000
+        # a continuous stream with more particles per bin than fit in a window
+        cass = LocationMetadata({1: (30, 0, 99.9), 2: (30, 100, 199.9), 3: (5, 200, 299.9)})
+        san = LocationMetadata({})
+
+        def get_location_metadata(stream_key, time_range):
+            return cass, san, []
+
+        with mock.patch('util.calc.get_location_metadata', new=get_location_metadata):
+            with mock.patch.dict('util.calc.app.config', {'ASYNC_CHUNK_PARTICLES': 10}):
+                chunks = plan_request_chunks(validate(input_data))
+
+        boundaries = [chunk.start for chunk in chunks[1:]]
+        np.testing.assert_allclose(boundaries, [33.3, 66.6, 100, 133.3, 166.6, 200])
+        self.assertEqual(chunks[0].start, 0)
+        self.assertEqual(chunks[-1].stop, 1000)
+        for previous, chunk in zip(chunks, chunks[1:]):
+            self.assertEqual(previous.stop, chunk.start)
+
+    def test_chunked_matches_unchunked(self):
+        nutnr_ds = xr.open_dataset(os.path.join(DATA_DIR, 'nutnr_a_sample.nc'), decode_times=False)
+        ctdpf_ds = xr.open_dataset(os.path.join(DATA_DIR, 'ctdpf_sbe43_sample.nc'), decode_times=False)
+        qc = json.load(open(os.path.join(DATA_DIR, 'qc.json')))
+        test = self
+
+        def fetch_raw_data(sr):
+            nut_times = nutnr_ds.time.values
+            mask = (nut_times >= sr.time_range.start) & (nut_times <= sr.time_range.stop)
+            nut = nutnr_ds.isel(obs=np.flatnonzero(mask))
+            nut = nut[test.base_params + [p.name for p in sr.stream_parameters[test.nut_sk]]]
+            ctd = ctdpf_ds[test.base_params + [p.name for p in sr.stream_parameters[test.ctd_sk]]]
+            sr.datasets[test.ctd_sk] = StreamDataset(test.ctd_sk, sr.uflags, [test.nut_sk], sr.request_id)
+            sr.datasets[test.nut_sk] = StreamDataset(test.nut_sk, sr.uflags, [test.ctd_sk], sr.request_id)
+            sr.datasets[test.ctd_sk].events = test.ctd_events
+            sr.datasets[test.nut_sk].events = test.nut_events
+            # the supporting stream is padded, as the real fetch would
+            sr.datasets[test.ctd_sk]._insert_dataset(ctd)
+            sr.datasets[test.nut_sk]._insert_dataset(nut)
+
+        stream = {'subsite': self.nut_sk.subsite, 'node': self.nut_sk.node, 'sensor': self.nut_sk.sensor,
+                  'method': self.nut_sk.method, 'stream': self.nut_sk.stream_name, 'parameters': [18]}
+        times = nutnr_ds.time.values
+        start, stop = times[0], times[-1]
+        request_parameters = RequestParameters('UNIT', [stream], {}, {}, start, stop, None, False, False,
+                                               qc, False, {}, True)
+        # three windows cut between particles
+        cuts = [times[times.size / 3], times[2 * times.size / 3]]
+        chunks = [TimeRange(start, cuts[0]), TimeRange(cuts[0], cuts[1]), TimeRange(cuts[1], stop)]
+
+        def primary(sr):
+            return xr.concat([sr.datasets[self.nut_sk].datasets[d] for d in sorted(sr.datasets[self.nut_sk].datasets)],
+                             dim='obs')
+
+        with mock.patch('util.stream_request.StreamRequest.fetch_raw_data', new=fetch_raw_data), \
+                mock.patch('util.stream_request.StreamRequest._collapse_times'), \
+                mock.patch('util.calc.plan_request_chunks', return_value=chunks), \
+                mock.patch.dict('util.calc.app.config', {'ASYNC_CHUNK_OVERLAP_SECONDS': stop - start}):
+            unchunked = primary(execute_stream_request(request_parameters))
+            windows = [primary(sr) for sr in execute_chunked_stream_request(request_parameters)]
+
+        self.assertEqual(len(windows), 3)
+        chunked = xr.concat(windows, dim='obs')
+        np.testing.assert_array_equal(chunked.time.values, unchunked.time.values)
+        for name in ['salinity_corrected_nitrate', 'salinity_corrected_nitrate_qc_executed',
+                     'salinity_corrected_nitrate_qc_results']:
+            np.testing.assert_array_equal(chunked[name].values, unchunked[name].values)
+
+    def test_chunked_csv_writer(self):
+        sk = mock.Mock()
+        sk.as_dashed_refdes.return_value = 'RS01-NODE-SENSOR'
+
+        def window(times, columns):
+            data = {name: ('obs', np.asarray(times, dtype=np.float64)) for name in columns}
+            ds = xr.Dataset(data, coords={'obs': np.arange(len(times))})
+            stream_dataset = mock.Mock(datasets={1: ds})
+            return mock.Mock(stream_key=sk, datasets={sk: stream_dataset})
+
+        async_dir = tempfile.mkdtemp()
+        try:
+            with mock.patch.dict('util.csvresponse.app.config', {'LOCAL_ASYNC_DIR': async_dir}):
+                writer = ChunkedCsvWriter('request', ',')
+                writer.append(window([3700000000, 3700000001], ['time', 'pressure']))
+                writer.append(window([3700000002, 3700000003, 3700000004], ['time', 'pressure', 'extra']))
+                writer.append(window([3700000005], ['time', 'pressure', 'extra']))
+                file_paths = ast.literal_eval(json.loads(writer.finish())['message'])
+            self.assertEqual(len(os.listdir(os.path.join(async_dir, 'request'))), 1)
+            frame = pd.read_csv(file_paths[0])
+            # columns which only appear in later windows are kept, empty for the earlier rows
+            self.assertEqual(sorted(frame.columns), ['extra', 'obs', 'pressure', 'time'])
+            self.assertEqual(list(frame.obs), [0, 1, 2, 3, 4, 5])
+            np.testing.assert_array_equal(frame.pressure.values, np.arange(3700000000, 3700000006))
+            self.assertTrue(np.isnan(frame.extra.values[:2]).all())
+            np.testing.assert_array_equal(frame.extra.values[2:], np.arange(3700000002, 3700000006))
+        finally:
+            shutil.rmtree(async_dir)
+
     def test_execute_stream_request_multiple_streams_invalid_input(self):
         input_data = json.load(open(os.path.join(DATA_DIR, 'multiple_stream_request_no_parameter.json')))
 
@@ -462,7 +634,7 @@ class StreamRequestTest(unittest.TestCase):
         nut_sr.interpolate_from_stream_request(echo_sr)
 
         self.assertIn(self.echo_sk, nut_sr.external_includes)
-        expected = {Parameter.query.get(3786)}
+        expected = {get_parameter(3786)}
         self.assertEqual(expected, nut_sr.external_includes[self.echo_sk])
 
         expected_name = 'echo_sounding-hpies_temperature'
@@ -477,9 +649,9 @@ class StreamRequestTest(unittest.TestCase):
     def test_compute_request_size_default(self):
         count = 100
 
-        def get_particle_count(stream, time_range):
-            return count
-        with mock.patch('util.metadata_service.get_particle_count', new=get_particle_count):
+        def get_particle_counts(streams, time_range):
+            return {stream: ParticleCount(count, [], {}) for stream in streams}
+        with mock.patch('util.metadata_service.get_particle_counts', new=get_particle_counts):
             nut_sr = self.create_nut_sr()
             se = {}  # empty estimates should give default of 1000 for bytes/particle
             size_est = nut_sr.compute_request_size(se)
@@ -490,13 +662,17 @@ class StreamRequestTest(unittest.TestCase):
         nutnr_count = 10
         ctdpf_count = 100
 
-        def get_particle_count(stream, time_range):
+        def get_particle_count(stream):
             if stream.stream_name == 'nutnr_a_sample':
                 return 10
             if stream.stream_name == 'ctdpf_sbe43_sample':
                 return 100
             return 0
-        with mock.patch('util.metadata_service.get_particle_count', new=get_particle_count):
+
+        def get_particle_counts(streams, time_range):
+            return {stream: ParticleCount(get_particle_count(stream), [], {})
+                    for stream in streams}
+        with mock.patch('util.metadata_service.get_particle_counts', new=get_particle_counts):
             nut_sr = self.create_nut_sr()
             se = SIZE_ESTIMATES
             size_est = nut_sr.compute_request_size(se)
@@ -0,0 +1,213 @@
+"""
+Local read-through cache of decoded Cassandra bins.
+
+Each cached bin is a directory holding one .npy file per column and a meta.json recording the partition
+metadata count and last time the columns were read against. Numeric columns are memory mapped (copy on
+write) on read. Entries are only written for settled bins, a bin which has changed since it was cached no
+longer matches its partition metadata and is replaced on the next read. The least recently used entries
+are evicted once the cache grows beyond BIN_CACHE_MAX_BYTES. Entry sizes are tracked in an in-memory index,
+seeded from the cache directory on first use and rescanned every BIN_CACHE_RESCAN_SECONDS to pick up
+entries stored or removed by other workers.
+"""
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+from threading import Lock
+
+import ntplib
+import numpy as np
+
+from engine import app
+
+log = logging.getLogger(__name__)
+
+META_FILE = 'meta.json'
+
+_lock = Lock()
+_stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+
+
+class _EntryIndex(object):
+    """
+    Size of each cache entry in least recently used order
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        self.total = 0
+        self.scanned = None
+
+    def _scan(self, root):
+        entries = []
+        for path, _, files in os.walk(root):
+            if META_FILE not in files:
+                continue
+            try:
+                entries.append((os.path.getmtime(os.path.join(path, META_FILE)), path, _entry_size(path)))
+            except OSError:
+                # removed by another worker
+                continue
+        self.entries = OrderedDict((path, size) for _, path, size in sorted(entries))
+        self.total = sum(self.entries.itervalues())
+        self.scanned = time.time()
+
+    def _ensure_scanned(self):
+        if self.scanned is None or time.time() - self.scanned > app.config['BIN_CACHE_RESCAN_SECONDS']:
+            self._scan(app.config['BIN_CACHE_DIR'])
+
+    def touch(self, path):
+        with self.lock:
+            if path in self.entries:
+                self.entries[path] = self.entries.pop(path)
+
+    def update(self, path, size):
+        with self.lock:
+            self._ensure_scanned()
+            self.total += size - self.entries.pop(path, 0)
+            self.entries[path] = size
+
+    def pop_over(self, max_bytes):
+        """
+        Remove the least recently used entries from the index until it is below max_bytes
+        :return: list of the removed entry paths
+        """
+        removed = []
+        with self.lock:
+            self._ensure_scanned()
+            while self.total > max_bytes and self.entries:
+                path, size = self.entries.popitem(last=False)
+                self.total -= size
+                removed.append(path)
+        return removed
+
+
+_index = _EntryIndex()
+
+
+def enabled():
+    return bool(app.config['BIN_CACHE_DIR'])
+
+
+def get_stats():
+    with _lock:
+        stats = dict(_stats)
+    total = stats['hits'] + stats['misses']
+    stats['hit_rate'] = float(stats['hits']) / total if total else 0.0
+    return stats
+
+
+def _count(name, value=1):
+    with _lock:
+        _stats[name] += value
+
+
+def is_settled(last):
+    """
+    Only bins which have not received data for BIN_CACHE_SETTLE_SECONDS are cached
+    """
+    now = ntplib.system_to_ntp_time(time.time())
+    return now - last > app.config['BIN_CACHE_SETTLE_SECONDS']
+
+
+def _entry_path(stream_key, data_bin):
+    return os.path.join(app.config['BIN_CACHE_DIR'], stream_key.as_three_part_refdes(),
+                        stream_key.method, stream_key.stream_name, str(data_bin))
+
+
+def _read_meta(path):
+    try:
+        with open(os.path.join(path, META_FILE)) as fh:
+            return json.load(fh)
+    except (IOError, ValueError):
+        return None
+
+
+def _entry_size(path):
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+
+def _write_atomic(directory, name, writer):
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            writer(fh)
+        os.rename(temp_path, os.path.join(directory, name))
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+
+def get_columns(stream_key, data_bin, count, last, cols):
+    """
+    Return the cached columns for a bin if the entry matches the supplied partition metadata
+    :return: dictionary of column name to numpy array or None
+    """
+    path = _entry_path(stream_key, data_bin)
+    meta = _read_meta(path)
+    if meta is None or meta['count'] != count or meta['last'] != last or not set(cols).issubset(meta['columns']):
+        _count('misses')
+        return None
+
+    columns = {}
+    try:
+        for col in cols:
+            filename = os.path.join(path, col + '.npy')
+            mmap_mode = None if meta['columns'][col] == 'O' else 'c'
+            columns[col] = np.load(filename, mmap_mode=mmap_mode)
+    except (IOError, ValueError) as e:
+        log.warn('Unable to read cached bin %s: %s', path, e)
+        _count('misses')
+        return None
+
+    # touch the metadata to record the access for eviction
+    try:
+        os.utime(os.path.join(path, META_FILE), None)
+    except OSError:
+        pass
+    _index.touch(path)
+    _count('hits')
+    return columns
+
+
+def store_columns(stream_key, data_bin, count, last, columns):
+    """
+    Store the decoded columns of a complete bin. Columns are added to an existing entry
+    for the same partition metadata, otherwise the entry is replaced.
+    """
+    path = _entry_path(stream_key, data_bin)
+    try:
+        meta = _read_meta(path)
+        if meta is not None and (meta['count'] != count or meta['last'] != last):
+            shutil.rmtree(path, ignore_errors=True)
+            meta = None
+        if meta is None:
+            meta = {'count': count, 'last': last, 'columns': {}}
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        for col, values in columns.iteritems():
+            if col in meta['columns']:
+                continue
+            values = np.asarray(values)
+            _write_atomic(path, col + '.npy', lambda fh: np.save(fh, values))
+            meta['columns'][col] = values.dtype.kind
+        _write_atomic(path, META_FILE, lambda fh: json.dump(meta, fh))
+        _index.update(path, _entry_size(path))
+    except (IOError, OSError) as e:
+        log.warn('Unable to store cached bin %s: %s', path, e)
+        return
+    _count('stores')
+    evict()
+
+
+def evict():
+    """
+    Remove the least recently used entries until the cache is below BIN_CACHE_MAX_BYTES
+    """
+    for path in _index.pop_over(app.config['BIN_CACHE_MAX_BYTES']):
+        shutil.rmtree(path, ignore_errors=True)
+        _count('evictions')
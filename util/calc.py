@@ -1,4 +1,6 @@
+import json
 import logging
+import math
 import os
 from collections import namedtuple
 from functools import wraps
@@ -10,10 +12,11 @@ import ntplib
 
 import util.stream_request
 from jsonresponse import JsonResponse
-from ooi_data.postgres.model import Stream, Parameter
 from util.common import (StreamKey, TimeRange, MalformedRequestException, InvalidStreamException,
-                         InvalidParameterException, UIHardLimitExceededException)
-from util.csvresponse import CsvGenerator
+                         InvalidParameterException, UIHardLimitExceededException, MissingDataException,
+                         get_stream, get_parameter)
+from util.csvresponse import CsvGenerator, ChunkedCsvWriter
+from util.metadata_service import get_location_metadata
 from util.netcdf_generator import NetcdfGenerator
 from engine import app
 
@@ -30,7 +33,7 @@ RequestParameters = namedtuple('RequestParameters', ['id', 'streams', 'coefficie
                                                      'execute_dpa'])
 
 
-def execute_stream_request(request_parameters, needs_only=False):
+def execute_stream_request(request_parameters, needs_only=False, window=None):
     stream_request = []
 
     for index, stream in enumerate(request_parameters.streams):
@@ -48,7 +51,8 @@ def execute_stream_request(request_parameters, needs_only=False):
             strict_range=request_parameters.strict_range,
             request_id=request_parameters.id,
             collapse_times=collapse_times,
-            execute_dpa=request_parameters.execute_dpa))
+            execute_dpa=request_parameters.execute_dpa,
+            window=window if index == 0 else None))
 
         if not needs_only:
             stream_request[index].fetch_raw_data()
@@ -56,6 +60,7 @@ def execute_stream_request(request_parameters, needs_only=False):
                 stream_request[index].calculate_derived_products()
                 stream_request[index].import_extra_externals()
             stream_request[index].execute_qc()
+            stream_request[index].trim_to_window()
             stream_request[index].insert_provenance()
         else:
             # If needs_only is true we only want to process the first stream, for now
@@ -67,6 +72,88 @@ def execute_stream_request(request_parameters, needs_only=False):
     return stream_request[0]
 
 
+def plan_request_chunks(request_parameters):
+    """
+    Split the time range of an asynchronous request into windows holding roughly
+    ASYNC_CHUNK_PARTICLES particles of the primary stream. Windows are cut at bin
+    boundaries, bins holding more than ASYNC_CHUNK_PARTICLES are cut assuming an even
+    particle rate. Windows are half-open, see execute_chunked_stream_request.
+    :return: list of TimeRange
+    """
+    time_range = TimeRange(request_parameters.start, request_parameters.stop)
+    stream_key = StreamKey.from_dict(request_parameters.streams[0])
+    if request_parameters.limit or stream_key.is_virtual:
+        return [time_range]
+
+    cass_locations, san_locations, _ = get_location_metadata(stream_key, time_range)
+    bins = cass_locations.bin_information.values() + san_locations.bin_information.values()
+    bins.sort(key=lambda x: x[1])
+
+    chunk_size = app.config['ASYNC_CHUNK_PARTICLES']
+    boundaries = []
+    accumulated = 0
+    for count, first, last in bins:
+        if accumulated and accumulated + count > chunk_size:
+            boundaries.append(first)
+            accumulated = 0
+        if count > chunk_size and last > first:
+            pieces = int(math.ceil(float(count) / chunk_size))
+            step = (last - first) / float(pieces)
+            boundaries.extend(first + step * i for i in xrange(1, pieces))
+            accumulated = count - (pieces - 1) * chunk_size
+        else:
+            accumulated += count
+
+    chunks = []
+    start = time_range.start
+    for boundary in boundaries:
+        if start < boundary < time_range.stop:
+            chunks.append(TimeRange(start, boundary))
+            start = boundary
+    chunks.append(TimeRange(start, time_range.stop))
+    return chunks
+
+
+def execute_chunked_stream_request(request_parameters):
+    """
+    Generator which fully processes the request one time window at a time, yielding the
+    StreamRequest for each window which returned data. Each window reads ASYNC_CHUNK_OVERLAP_SECONDS
+    of additional primary stream data on either side so derived products and QC tests which use
+    neighbouring particles see the same data as an unchunked request. The margin is trimmed after
+    QC, primary stream particles are kept in [start, stop) of their window so each particle is
+    returned once.
+    """
+    chunks = plan_request_chunks(request_parameters)
+    if len(chunks) > 1:
+        log.info('<%s> Processing request in %d time windows', request_parameters.id, len(chunks))
+
+    margin = app.config['ASYNC_CHUNK_OVERLAP_SECONDS']
+    error = None
+    found = False
+    for index, chunk in enumerate(chunks):
+        first = index == 0
+        last = index == len(chunks) - 1
+        # the outer edges of the request are left as an unchunked request would read them
+        chunk_parameters = request_parameters._replace(start=chunk.start if first else chunk.start - margin,
+                                                       stop=chunk.stop if last else chunk.stop + margin)
+        window = TimeRange(float('-inf') if first else chunk.start, float('inf') if last else chunk.stop)
+        try:
+            stream_request = execute_stream_request(chunk_parameters, window=window)
+        except MissingDataException as e:
+            log.info('<%s> No data in time window %s: %s', request_parameters.id, chunk, e.message)
+            error = e
+            continue
+        found = True
+        yield stream_request
+
+    if not found and error is not None:
+        raise error
+
+
+def use_chunked_execution(request_parameters):
+    return app.config['ASYNC_CHUNKED_EXECUTION'] and not request_parameters.limit
+
+
 def time_request(func):
     @wraps(func)
     def inner(*args, **kwargs):
@@ -98,7 +185,17 @@ def get_particles(input_data, url):
 def get_netcdf(input_data, url):
     disk_path = input_data.get('directory', 'unknown')
     classic = input_data.get('classic', False)
-    stream_request = execute_stream_request(validate(input_data))
+    request_parameters = validate(input_data)
+    if disk_path is not None and use_chunked_execution(request_parameters):
+        stream_name = request_parameters.streams[0]['stream']
+        file_paths = []
+        for stream_request in execute_chunked_stream_request(request_parameters):
+            file_paths.extend(NetcdfGenerator(stream_request, classic, disk_path).create_raw_files())
+            # release this window before the next one is fetched
+            del stream_request
+        return stream_name, json.dumps({'code': 200, 'message': str(file_paths)}, indent=2)
+
+    stream_request = execute_stream_request(request_parameters)
     return stream_request.stream_key.stream.name, NetcdfGenerator(stream_request, classic, disk_path).write()
 
 
@@ -110,7 +207,16 @@ def get_csv(input_data, url, delimiter=','):
 
 @time_request
 def get_csv_fs(input_data, url, base_path, delimiter=','):
-    stream_request = execute_stream_request(validate(input_data))
+    request_parameters = validate(input_data)
+    if use_chunked_execution(request_parameters):
+        writer = ChunkedCsvWriter(base_path, delimiter)
+        for stream_request in execute_chunked_stream_request(request_parameters):
+            writer.append(stream_request)
+            # release this window before the next one is fetched
+            del stream_request
+        return writer.finish()
+
+    stream_request = execute_stream_request(request_parameters)
     return CsvGenerator(stream_request, delimiter).to_csv_files(base_path)
 
 
@@ -180,7 +286,7 @@ def _validate_stream(stream, empty_param_check=False):
         raise MalformedRequestException('Missing stream information from request',
                                         payload={'request': stream})
 
-    preload_stream = Stream.query.filter(Stream.name == stream['stream']).first()
+    preload_stream = get_stream(stream['stream'])
     if preload_stream is None:
         raise InvalidStreamException('The requested stream does not exist in preload', payload={'stream': stream})
 
@@ -192,7 +298,7 @@ def _validate_stream(stream, empty_param_check=False):
 
     stream_parameters = [p.id for p in preload_stream.parameters]
     for pid in parameters:
-        p = Parameter.query.get(pid)
+        p = get_parameter(pid)
         if p is None:
             raise InvalidParameterException('The requested parameter does not exist in preload',
                                             payload={'id': pid})
@@ -1,26 +1,58 @@
+import atexit
+import json
 import logging
+import math
+import os
+import random
+import tempfile
 import time
 import uuid
 from collections import deque, namedtuple
 from itertools import izip
 from multiprocessing import BoundedSemaphore
+from threading import Lock, Condition, Event, BoundedSemaphore as ThreadSemaphore
 
 import msgpack
+import ntplib
 import numpy
+import pandas as pd
+from cachetools import LRUCache
 from cassandra import ConsistencyLevel
 from cassandra.cluster import Cluster
-from cassandra.concurrent import execute_concurrent_with_args
-from cassandra.query import _clean_column_name, tuple_factory, BatchStatement
+from cassandra.policies import DCAwareRoundRobinPolicy, TokenAwarePolicy
+from cassandra.query import _clean_column_name, tuple_factory, BatchStatement, BatchType
+from concurrent.futures import ThreadPoolExecutor
 
 import engine
-from util.common import log_timing
-from util.datamodel import to_xray_dataset
+from util import bin_cache, decimation, query_metrics
+from util.common import log_timing, TimeRange, read_size_config
+from util.datamodel import to_xray_dataset, ColumnBuilder, concatenate_columns
+from util.location_metadata import LocationMetadata
 from util.metadata_service import (CASS_LOCATION_NAME, get_location_metadata_by_store, get_location_metadata,
-                                   metadata_service_api)
+                                   invalidate_partition_metadata, metadata_service_api)
 
 logging.getLogger('cassandra').setLevel(logging.WARNING)
 log = logging.getLogger(__name__)
-
+bin_executor = ThreadPoolExecutor(max_workers=engine.app.config['CASSANDRA_MAX_CONCURRENT_BINS'])
+decimation_executor = ThreadPoolExecutor(max_workers=engine.app.config['DECIMATION_BUILD_WORKERS'])
+# reads the time slices of oversized bins, separate from bin_executor which waits on the slices
+slice_executor = ThreadPoolExecutor(max_workers=engine.app.config['CASSANDRA_MAX_CONCURRENT_SLICES'])
+# fetches the server side trace of slow sampled queries
+trace_executor = ThreadPoolExecutor(max_workers=1)
+
+SETTLED_READ_CONSISTENCY = ConsistencyLevel.name_to_value.get(engine.app.config['CASSANDRA_SETTLED_READ_CONSISTENCY'])
+
+# Process wide cache of immutable L0 provenance records keyed by provenance UUID
+l0_provenance_cache = LRUCache(engine.app.config['L0_PROVENANCE_CACHE_SIZE'])
+l0_provenance_lock = Lock()
+
+# Estimated bytes per particle for each stream, used to size result pages
+SIZE_ESTIMATES = read_size_config(engine.app.config['SIZE_CONFIG'])
+# {(stream name, number of columns): rows per page}
+fetch_sizes = {}
+
+# Columns always selected, even when the query is limited to the parameters needed by a request
+REQUIRED_QUERY_COLUMNS = {'time', 'deployment', 'id', 'provenance'}
 l0_stream_columns = ['time', 'id', 'driver_class', 'driver_host', 'driver_module', 'driver_version', 'event_json']
 ProvTuple = namedtuple('provenance_tuple',
                        ['subsite', 'sensor', 'node', 'method', 'deployment', 'id', 'file_name', 'parser_name',
@@ -37,9 +69,287 @@ L0_STREAM_RANGE = """SELECT {:s} FROM streaming_l0_provenance
 WHERE refdes = ? AND method = ? and time >= ? and time <= ?""".format(', '.join(l0_stream_columns))
 
 
+class SizedStatement(object):
+    """
+    A shared prepared statement paired with the page size for one query. The fetch size is set on
+    the BoundStatement of each execution, the cached PreparedStatement is never modified.
+    """
+    def __init__(self, prepared_statement, fetch_size):
+        self.prepared_statement = prepared_statement
+        self.fetch_size = fetch_size
+
+    def __getattr__(self, name):
+        return getattr(self.prepared_statement, name)
+
+    def bind(self, values):
+        statement = self.prepared_statement.bind(values)
+        statement.fetch_size = self.fetch_size
+        return statement
+
+
+class PagedReader(object):
+    """
+    Iterate over the pages of a query result while the driver fetches the following pages.
+    Up to max_pages pages are held ahead of the consumer, the next page is requested from the
+    driver callback as soon as a page arrives so network time overlaps with decoding.
+    Pages are counted against the supplied query_metrics Observation.
+    :param future: ResponseFuture or HedgedRead of the executing query
+    """
+    def __init__(self, future, max_pages, observation, trace=False):
+        self._max_pages = max(1, max_pages)
+        self._pages = deque()
+        self._condition = Condition()
+        self._finished = False
+        self._paused = False
+        self._error = None
+        self._observation = observation
+        self._trace = trace
+        self._future = future
+        self._future.add_callbacks(callback=self._handle_page, errback=self._handle_error)
+
+    def add_callbacks(self, callback, errback, callback_args=(), errback_args=()):
+        """
+        Add callbacks to the underlying future, callbacks run for every page
+        """
+        self._future.add_callbacks(callback=callback, errback=errback, callback_args=callback_args,
+                                   errback_args=errback_args)
+
+    def _handle_page(self, rows):
+        # statements which return no rows (writes) complete with None
+        rows = rows or []
+        self._observation.add_page(len(rows))
+        with self._condition:
+            self._pages.append(rows)
+            if not self._future.has_more_pages:
+                self._finished = True
+                _finish_observation(self._observation,
+                                    get_trace=self._future.get_query_trace if self._trace else None)
+            elif len(self._pages) < self._max_pages:
+                self._future.start_fetching_next_page()
+            else:
+                # consumer is behind, resume fetching once it takes a page
+                self._paused = True
+            self._condition.notify()
+
+    def _handle_error(self, exc):
+        _finish_observation(self._observation, exc)
+        with self._condition:
+            self._error = exc
+            self._condition.notify()
+
+    def __iter__(self):
+        while True:
+            with self._condition:
+                while not self._pages and not self._finished and self._error is None:
+                    self._condition.wait()
+                if self._error is not None:
+                    raise self._error
+                if not self._pages:
+                    return
+                page = self._pages.popleft()
+                if self._paused:
+                    self._paused = False
+                    self._future.start_fetching_next_page()
+            yield page
+
+
+class HedgedRead(object):
+    """
+    Execute an idempotent read, sending a duplicate request if no response has arrived within the hedge
+    delay. The first response is used, any later pages are fetched from the request which answered first.
+    Provides the parts of the ResponseFuture interface used by SessionManager and PagedReader.
+    """
+    def __init__(self, session, statement, parameters, delay, observation, trace=False):
+        self._session = session
+        self._statement = statement
+        self._parameters = parameters
+        self._observation = observation
+        self._trace = trace
+        self._lock = Lock()
+        self._done = Event()
+        self._futures = []
+        self._failures = 0
+        self._winner = None
+        self._error = None
+        self._callbacks = []
+        self._timer = None
+        self._send()
+        self._timer = session.cluster.connection_class.create_timer(delay, self._hedge)
+
+    def _send(self):
+        future = self._session.execute_async(self._statement, self._parameters, trace=self._trace)
+        with self._lock:
+            self._futures.append(future)
+        future.add_callbacks(callback=self._handle_result, callback_args=(future,),
+                             errback=self._handle_error, errback_args=(future,))
+
+    def _hedge(self):
+        if self._done.is_set():
+            return
+        query_metrics.increment(self._observation.shape, self._observation.table, 'hedges')
+        self._send()
+
+    def _handle_result(self, rows, future):
+        with self._lock:
+            if self._winner is None:
+                self._winner = future
+                if future is not self._futures[0]:
+                    query_metrics.increment(self._observation.shape, self._observation.table, 'hedges_won')
+            elif future is not self._winner:
+                return
+            callbacks = [callback for callback, _ in self._callbacks]
+        self._finish()
+        for callback, args in callbacks:
+            callback(rows, *args)
+
+    def _handle_error(self, exc, future):
+        with self._lock:
+            if future is not self._winner:
+                self._failures += 1
+                # wait for any other outstanding request
+                if self._winner is not None or self._failures < len(self._futures):
+                    return
+            self._error = exc
+            errbacks = [errback for _, errback in self._callbacks]
+        self._finish()
+        for errback, args in errbacks:
+            errback(exc, *args)
+
+    def _finish(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._done.set()
+
+    def add_callbacks(self, callback, errback, callback_args=(), errback_args=()):
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(((callback, callback_args), (errback, errback_args)))
+                return
+        if self._error is not None:
+            errback(self._error, *errback_args)
+        else:
+            callback(self._winner.result().current_rows, *callback_args)
+
+    def result(self):
+        self._done.wait()
+        if self._error is not None:
+            raise self._error
+        return self._winner.result()
+
+    @property
+    def has_more_pages(self):
+        return self._winner.has_more_pages
+
+    def start_fetching_next_page(self):
+        self._winner.start_fetching_next_page()
+
+    def get_query_trace(self, *args, **kwargs):
+        return self._winner.get_query_trace(*args, **kwargs)
+
+
+class ConcurrencyLimiter(object):
+    """
+    Additive increase, multiplicative decrease limit on the number of concurrent requests in flight from this
+    worker. The limit grows by roughly one per limit successful responses while their latency stays within
+    latency_ratio of the moving average and is multiplied by backoff on timeouts and overload errors, at most
+    once per average latency so a burst of failures from one overload counts once.
+    """
+    def __init__(self, initial, minimum, maximum, backoff, latency_ratio):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.backoff = backoff
+        self.latency_ratio = latency_ratio
+        self.in_flight = 0
+        self.average_latency = None
+        self.decreases = 0
+        self._last_decrease = 0
+        self._condition = Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, latency, error=None):
+        with self._condition:
+            self.in_flight -= 1
+            if error is None:
+                if self.average_latency is None:
+                    self.average_latency = latency
+                stable = latency <= self.average_latency * self.latency_ratio
+                self.average_latency += 0.1 * (latency - self.average_latency)
+                if stable:
+                    self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            elif query_metrics.is_overload(error):
+                now = time.time()
+                if now - self._last_decrease > (self.average_latency or 0):
+                    self.limit = max(self.minimum, self.limit * self.backoff)
+                    self._last_decrease = now
+                    self.decreases += 1
+            self._condition.notify_all()
+
+    def stats(self):
+        with self._condition:
+            return {'limit': int(self.limit), 'in_flight': self.in_flight,
+                    'average_latency': self.average_latency, 'decreases': self.decreases}
+
+
+concurrency_limiter = ConcurrencyLimiter(engine.app.config['CASSANDRA_CONCURRENCY_INITIAL'],
+                                         engine.app.config['CASSANDRA_CONCURRENCY_MIN'],
+                                         engine.app.config['CASSANDRA_CONCURRENCY_MAX'],
+                                         engine.app.config['CASSANDRA_CONCURRENCY_BACKOFF'],
+                                         engine.app.config['CASSANDRA_CONCURRENCY_LATENCY_RATIO'])
+
+
+class RequestSlot(object):
+    """
+    Slot held by one request of a concurrent fan-out, taken from the shared concurrency_limiter and an
+    optional per fan-out semaphore. Released once, when the first response or an error arrives.
+    """
+    def __init__(self, semaphore=None):
+        self._semaphore = semaphore
+        if semaphore is not None:
+            semaphore.acquire()
+        concurrency_limiter.acquire()
+        self._start = time.time()
+        self._released = False
+
+    def release(self, error=None):
+        if self._released:
+            return
+        self._released = True
+        concurrency_limiter.release(time.time() - self._start, error)
+        if self._semaphore is not None:
+            self._semaphore.release()
+
+
+def _finish_observation(observation, error=None, get_trace=None):
+    """
+    Record a finished query, fetching the server side trace in the background if it was traced and slow
+    """
+    elapsed = observation.finish(error)
+    if get_trace is not None and error is None and elapsed >= engine.app.config['CASSANDRA_SLOW_QUERY_SECONDS']:
+        trace_executor.submit(_capture_trace, observation, get_trace)
+
+
+def _capture_trace(observation, get_trace):
+    try:
+        trace = get_trace()
+        query_metrics.add_slow_trace(observation.shape, observation.table, observation.elapsed, trace)
+    except Exception as e:
+        log.warn('Unable to fetch trace for slow query %s: %s', observation.shape, e)
+
+
 # noinspection PyUnresolvedReferences
 class SessionManager(object):
-    _prepared_statement_cache = {}
+    _prepared_statement_cache = LRUCache(engine.app.config['CASSANDRA_STATEMENT_CACHE_SIZE'])
+    _prepared_statement_lock = Lock()
+    _prepared_statement_hits = 0
+    _prepared_statement_misses = 0
+    # {statement shape: estimated bytes per row}
+    _row_bytes = {}
     _multiprocess_lock = BoundedSemaphore(4)
 
     @classmethod
@@ -61,30 +371,235 @@ class SessionManager(object):
             cls.__session.default_fetch_size = fetch_size
         if default_timeout is not None:
             cls.__session.default_timeout = default_timeout
-        cls._prepared_statement_cache = {}
+        cls._prepared_statement_cache = LRUCache(engine.app.config['CASSANDRA_STATEMENT_CACHE_SIZE'])
+        cls._prepared_statement_hits = 0
+        cls._prepared_statement_misses = 0
 
     @classmethod
-    def prepare(cls, statement):
-        if statement not in cls._prepared_statement_cache:
-            cls._prepared_statement_cache[statement] = cls.__session.prepare(statement)
-        return cls._prepared_statement_cache[statement]
+    def prepare(cls, statement, fetch_size=None):
+        """
+        Return a prepared statement for the supplied CQL. Statements must bind all partition key values
+        so that the cache is keyed only by table and query shape.
+        :param fetch_size: page size for this statement, see stream_fetch_size
+        :return: PreparedStatement or a SizedStatement when fetch_size is supplied
+        """
+        with cls._prepared_statement_lock:
+            prepared = cls._prepared_statement_cache.get(statement)
+            if prepared is not None:
+                cls._prepared_statement_hits += 1
+            else:
+                cls._prepared_statement_misses += 1
+
+        if prepared is None:
+            prepared = cls.__session.prepare(statement)
+            with cls._prepared_statement_lock:
+                cls._prepared_statement_cache[statement] = prepared
+        if fetch_size is not None:
+            return SizedStatement(prepared, fetch_size)
+        return prepared
+
+    @staticmethod
+    def _bind_sized(statement, parameters):
+        # bind a SizedStatement so its fetch size applies to this execution only
+        if isinstance(statement, SizedStatement):
+            return statement.bind(parameters), None
+        return statement, parameters
+
+    @classmethod
+    def prepared_statement_stats(cls):
+        with cls._prepared_statement_lock:
+            return {'size': cls._prepared_statement_cache.currsize,
+                    'maxsize': cls._prepared_statement_cache.maxsize,
+                    'hits': cls._prepared_statement_hits,
+                    'misses': cls._prepared_statement_misses}
 
     def close_pool(self):
         self.pool.close()
         self.pool.join()
 
     @classmethod
-    def get_query_columns(cls, table):
+    def get_query_columns(cls, table, needed=None):
+        """
+        :param table: stream table name
+        :param needed: optional collection of column names, limits the result to these
+                       columns plus REQUIRED_QUERY_COLUMNS
+        :return: list of column names to select, in table order
+        """
         # grab the column names from our metadata
         cols = cls.cluster.metadata.keyspaces[cls.__session.keyspace].tables[table].columns.keys()
         cols = map(_clean_column_name, cols)
         unneeded = ['subsite', 'node', 'sensor', 'method']
         cols = [c for c in cols if c not in unneeded]
+        if needed is not None:
+            needed = REQUIRED_QUERY_COLUMNS.union(needed)
+            cols = [c for c in cols if c in needed]
         return cols
 
     @classmethod
-    def execute(cls, *args, **kwargs):
-        return cls.__session.execute(*args, **kwargs)
+    def _observe(cls, statement, shape=None):
+        """
+        Start a query_metrics Observation for this statement
+        :param shape: CQL used to describe the statement in place of the statement itself, used for batches
+        """
+        shape, table = query_metrics.statement_shape(statement if shape is None else shape)
+        row_bytes = cls._row_bytes.get(shape)
+        if row_bytes is None:
+            row_bytes = cls._row_bytes[shape] = cls._estimate_row_bytes(statement, table)
+        return query_metrics.Observation(shape, table, row_bytes)
+
+    @classmethod
+    def _estimate_row_bytes(cls, statement, table):
+        """
+        Estimate the size of a result row from the stream size estimates and the fraction of
+        the table columns selected. Statements against other tables are not estimated.
+        """
+        prepared = getattr(statement, 'prepared_statement', statement)
+        result_metadata = getattr(prepared, 'result_metadata', None)
+        if table not in SIZE_ESTIMATES or not result_metadata:
+            return 0
+        table_metadata = cls.cluster.metadata.keyspaces[cls.__session.keyspace].tables.get(table)
+        if table_metadata is None:
+            return 0
+        return SIZE_ESTIMATES[table] * min(1.0, float(len(result_metadata)) / len(table_metadata.columns))
+
+    @staticmethod
+    def _sample_trace():
+        rate = engine.app.config['CASSANDRA_TRACE_SAMPLE_RATE']
+        return rate > 0 and random.random() < rate
+
+    @classmethod
+    def execute(cls, statement, parameters=None, **kwargs):
+        observation = cls._observe(statement)
+        trace = cls._sample_trace()
+        statement, parameters = cls._bind_sized(statement, parameters)
+        try:
+            result = cls.__session.execute(statement, parameters, trace=trace, **kwargs)
+        except Exception as e:
+            _finish_observation(observation, e)
+            raise
+        observation.add_page(len(result.current_rows))
+        _finish_observation(observation, get_trace=result.get_query_trace if trace else None)
+        return result
+
+    @classmethod
+    def _start(cls, statement, parameters, observation, trace, hedge):
+        """
+        Start executing a statement, hedged when requested, enabled and the statement has enough
+        recent executions to derive the hedge delay
+        """
+        statement, parameters = cls._bind_sized(statement, parameters)
+        config = engine.app.config
+        if hedge and config['CASSANDRA_HEDGED_READS']:
+            delay = query_metrics.latency_percentile(observation.shape, observation.table,
+                                                     config['CASSANDRA_HEDGE_PERCENTILE'],
+                                                     config['CASSANDRA_HEDGE_MIN_SAMPLES'])
+            if delay is not None:
+                delay = max(delay, config['CASSANDRA_HEDGE_MIN_DELAY'])
+                return HedgedRead(cls.__session, statement, parameters, delay, observation, trace)
+        return cls.__session.execute_async(statement, parameters, trace=trace)
+
+    @classmethod
+    def execute_async(cls, statement, parameters=None, shape=None, hedge=False):
+        """
+        Execute a query asynchronously, the first page of the result is recorded in the query metrics
+        :param hedge: statement is an idempotent read which may be sent twice, see HedgedRead
+        :return: ResponseFuture or HedgedRead
+        """
+        observation = cls._observe(statement, shape)
+        trace = cls._sample_trace()
+        future = cls._start(statement, parameters, observation, trace, hedge)
+        future.add_callbacks(callback=cls._async_finished, callback_args=(observation, future, trace),
+                             errback=lambda exc: _finish_observation(observation, exc))
+        return future
+
+    @staticmethod
+    def _async_finished(rows, observation, future, trace):
+        observation.add_page(len(rows) if rows else 0)
+        _finish_observation(observation, get_trace=future.get_query_trace if trace else None)
+
+    @classmethod
+    def execute_concurrent(cls, statements_and_parameters, concurrency=None, raise_on_first_error=True, shape=None,
+                           hedge=False):
+        """
+        Execute statements concurrently. Requests in flight are bounded by the worker's concurrency_limiter.
+        Every page of each result is fetched and recorded in the query metrics.
+        :param statements_and_parameters: iterable of (statement, parameters)
+        :param concurrency: optional additional bound for this fan-out
+        :param shape: see _observe
+        :param hedge: see execute_async
+        :return: list of (success, list of rows or exception) in statement order,
+                 as cassandra.concurrent.execute_concurrent
+        """
+        semaphore = ThreadSemaphore(concurrency) if concurrency else None
+        readers = []
+        for statement, parameters in statements_and_parameters:
+            readers.append(cls.execute_paged(statement, parameters, shape=shape, hedge=hedge,
+                                             slot=RequestSlot(semaphore)))
+
+        results = []
+        for reader in readers:
+            try:
+                rows = []
+                for page in reader:
+                    rows.extend(page)
+                results.append((True, rows))
+            except Exception as e:
+                if raise_on_first_error:
+                    raise
+                results.append((False, e))
+        return results
+
+    @classmethod
+    def execute_concurrent_with_args(cls, statement, parameters, concurrency=None, raise_on_first_error=True,
+                                     hedge=False):
+        return cls.execute_concurrent(((statement, p) for p in parameters), concurrency=concurrency,
+                                      raise_on_first_error=raise_on_first_error, hedge=hedge)
+
+    @classmethod
+    def execute_paged(cls, statement, parameters, prefetch=None, hedge=False, shape=None, slot=None):
+        """
+        Execute a query asynchronously and return a PagedReader over the result pages.
+        The query holds a slot from the worker's concurrency_limiter until the first page or an error arrives,
+        following pages are fetched by the reader.
+        :param prefetch: number of pages fetched ahead of the consumer
+        :param hedge: see execute_async, only the first page is hedged
+        :param shape: see _observe
+        :param slot: RequestSlot already taken by the caller, one is taken here when not supplied
+        """
+        if prefetch is None:
+            prefetch = engine.app.config['CASSANDRA_PREFETCH_PAGES']
+        if slot is None:
+            slot = RequestSlot()
+        try:
+            observation = cls._observe(statement, shape)
+            trace = cls._sample_trace()
+            future = cls._start(statement, parameters, observation, trace, hedge)
+            reader = PagedReader(future, prefetch, observation, trace=trace)
+        except Exception as e:
+            slot.release(e)
+            raise
+        reader.add_callbacks(callback=lambda _, slot: slot.release(), callback_args=(slot,),
+                             errback=lambda e, slot: slot.release(e), errback_args=(slot,))
+        return reader
+
+    @classmethod
+    def execute_rows(cls, statement, parameters, hedge=False):
+        """
+        Execute a query and return all rows, fetching pages ahead while earlier pages are collected
+        """
+        rows = []
+        for page in cls.execute_paged(statement, parameters, hedge=hedge):
+            rows.extend(page)
+        return rows
+
+    @classmethod
+    def execute_columnar(cls, statement, parameters, builder):
+        """
+        Execute a query and decode each result page directly into the supplied ColumnBuilder
+        """
+        for page in cls.execute_paged(statement, parameters):
+            builder.add_page(page)
+        return builder
 
     @classmethod
     def session(cls):
@@ -101,24 +616,138 @@ def _init():
     if consistency is None:
         log.warn('Unable to find consistency: %s defaulting to LOCAL_ONE', consistency_str)
         consistency = ConsistencyLevel.LOCAL_ONE
+    cluster_args = {}
+    if engine.app.config['CASSANDRA_HEDGED_READS']:
+        # spread requests over the replicas so a hedge is likely to reach a different node
+        cluster_args['load_balancing_policy'] = TokenAwarePolicy(DCAwareRoundRobinPolicy(), shuffle_replicas=True)
     cluster = Cluster(
             engine.app.config['CASSANDRA_CONTACT_POINTS'],
             control_connection_timeout=engine.app.config['CASSANDRA_CONNECT_TIMEOUT'],
             compression=True,
-            protocol_version=3)
+            protocol_version=3,
+            **cluster_args)
     SessionManager.create_pool(cluster,
                                engine.app.config['CASSANDRA_KEYSPACE'],
                                consistency_level=consistency,
                                fetch_size=engine.app.config['CASSANDRA_FETCH_SIZE'],
                                default_timeout=engine.app.config['CASSANDRA_DEFAULT_TIMEOUT'],
                                process_count=engine.app.config['POOL_SIZE'])
+    provenance_file = engine.app.config['L0_PROVENANCE_CACHE_FILE']
+    load_l0_provenance_cache(provenance_file)
+    atexit.register(save_l0_provenance_cache, provenance_file)
+
+
+def get_metrics():
+    """
+    Query statistics and cache statistics for this worker
+    """
+    return {'statements': query_metrics.snapshot(),
+            'slow_traces': query_metrics.get_slow_traces(),
+            'prepared_statements': SessionManager.prepared_statement_stats(),
+            'concurrency': concurrency_limiter.stats(),
+            'bin_cache': bin_cache.get_stats()}
+
+
+def stream_fetch_size(stream_key, cols=None):
+    """
+    Number of rows per page for queries against this stream. Pages are sized so a page holds roughly
+    CASSANDRA_TARGET_PAGE_BYTES, scaling the estimated particle size by the fraction of columns selected.
+    """
+    stream = stream_key.stream
+    num_cols = len(cols) if cols else None
+    key = (stream.name, num_cols)
+    fetch_size = fetch_sizes.get(key)
+    if fetch_size is None:
+        config = engine.app.config
+        row_bytes = SIZE_ESTIMATES.get(stream.name, config['PARTICLE_DENSITY'])
+        num_params = len(stream.parameters)
+        if num_cols and num_params:
+            row_bytes *= min(1.0, float(num_cols) / num_params)
+        fetch_size = int(config['CASSANDRA_TARGET_PAGE_BYTES'] / max(row_bytes, 1))
+        fetch_size = max(config['CASSANDRA_MIN_FETCH_SIZE'], min(config['CASSANDRA_MAX_FETCH_SIZE'], fetch_size))
+        fetch_sizes[key] = fetch_size
+    return fetch_size
+
+
+def bin_consistency(stream_key, data_bin, bin_info):
+    """
+    Consistency level for reading a bin. Bins which have not received data for CASSANDRA_SETTLED_READ_SECONDS
+    are read at CASSANDRA_SETTLED_READ_CONSISTENCY unless any worker wrote to them within the grace window.
+    Writes are recorded as marker files under CASSANDRA_WRITE_MARKER_DIR, without a shared directory every
+    bin is read at the default level.
+    :param bin_info: partition metadata (count, first, last) or None
+    :return: consistency level or None for the session default
+    """
+    config = engine.app.config
+    if SETTLED_READ_CONSISTENCY is None or bin_info is None or not config['CASSANDRA_WRITE_MARKER_DIR']:
+        return None
+    now = time.time()
+    if ntplib.system_to_ntp_time(now) - bin_info[2] < config['CASSANDRA_SETTLED_READ_SECONDS']:
+        return None
+    try:
+        written = os.path.getmtime(_write_marker_path(stream_key, data_bin))
+    except OSError:
+        written = None
+    if written is not None and now - written < config['CASSANDRA_WRITE_GRACE_SECONDS']:
+        return None
+    return SETTLED_READ_CONSISTENCY
+
+
+def _write_marker_path(stream_key, data_bin):
+    return os.path.join(engine.app.config['CASSANDRA_WRITE_MARKER_DIR'], stream_key.as_three_part_refdes(),
+                        stream_key.method, stream_key.stream_name, '{:d}'.format(data_bin))
+
+
+def record_bin_write(stream_key, data_bin):
+    """
+    Mark a bin as written so that every worker reads it at the default consistency level for the grace window
+    """
+    if not engine.app.config['CASSANDRA_WRITE_MARKER_DIR']:
+        return
+    path = _write_marker_path(stream_key, data_bin)
+    try:
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        with open(path, 'a'):
+            os.utime(path, None)
+    except (OSError, IOError) as e:
+        log.warn('Unable to record write of bin %d for %s: %s', data_bin, stream_key.as_refdes(), e)
+
+
+def _bind(query, args, consistency_level=None):
+    """
+    Bind a prepared statement when the session consistency level is overridden
+    :return: (statement, parameters) for SessionManager
+    """
+    if consistency_level is None:
+        return query, args
+    statement = query.bind(args)
+    statement.consistency_level = consistency_level
+    return statement, None
+
+
+def _partition_args(stream_key, data_bin, *args):
+    """
+    Build the bound values for a statement restricted by subsite, node, sensor, bin and method
+    followed by any additional clustering or limit values
+    """
+    return (stream_key.subsite, stream_key.node, stream_key.sensor, data_bin, stream_key.method) + args
 
 
 @log_timing(log)
-def get_cass_lookback_dataset(stream_key, start_time, data_bin, deployments, request_id):
+def get_cass_lookback_dataset(stream_key, start_time, data_bin, deployments, request_id, columns=None):
+    # nothing to pad, skip the read entirely
+    if not deployments:
+        return None
     # try to fetch the first n times to ensure we get a deployment value in there.
+    cols = SessionManager.get_query_columns(stream_key.stream.name, columns)
     cols, rows = fetch_with_func(query_n_before, stream_key,
-                                 [(data_bin, start_time, engine.app.config['LOOKBACK_QUERY_LIMIT'])])
+                                 [(data_bin, start_time, engine.app.config['LOOKBACK_QUERY_LIMIT'])], cols)
     needed = set(deployments)
     dep_idx = cols.index('deployment')
     ret_rows = []
@@ -132,14 +761,13 @@ def get_cass_lookback_dataset(stream_key, start_time, data_bin, deployments, req
 @log_timing(log)
 def query_bin_first(stream_key, bins, cols=None):
     # attempt to find one data point beyond the requested start/stop times
-    query = "select %s from %s where subsite='%s' and node='%s' and sensor='%s' and bin=? and method='%s' order by method, time limit 1" % \
-            (', '.join(cols), stream_key.stream.name, stream_key.subsite, stream_key.node,
-             stream_key.sensor, stream_key.method)
-    query = SessionManager.prepare(query)
+    query = "select %s from %s where subsite=? and node=? and sensor=? and bin=? and method=? order by method, time limit 1" % \
+            (', '.join(cols), stream_key.stream.name)
+    query = SessionManager.prepare(query, fetch_size=stream_fetch_size(stream_key, cols))
     result = []
     # prepare the arguments for cassandra. Each need to be in their own list
-    bins = [[x] for x in bins]
-    for success, rows in execute_concurrent_with_args(SessionManager.session(), query, bins, concurrency=50):
+    bins = [_partition_args(stream_key, x) for x in bins]
+    for success, rows in SessionManager.execute_concurrent_with_args(query, bins, hedge=True):
         if success:
             result.extend(list(rows))
     return result
@@ -147,12 +775,12 @@ def query_bin_first(stream_key, bins, cols=None):
 
 @log_timing(log)
 def query_first_after(stream_key, times_and_bins, cols):
-    query = "select %s from %s where subsite='%s' and node='%s' and sensor='%s' and bin=? and method='%s' and time >= ? ORDER BY method ASC, time ASC LIMIT 1" % \
-            (', '.join(cols), stream_key.stream.name, stream_key.subsite, stream_key.node, stream_key.sensor,
-             stream_key.method)
-    query = SessionManager.prepare(query)
+    query = "select %s from %s where subsite=? and node=? and sensor=? and bin=? and method=? and time >= ? ORDER BY method ASC, time ASC LIMIT 1" % \
+            (', '.join(cols), stream_key.stream.name)
+    query = SessionManager.prepare(query, fetch_size=stream_fetch_size(stream_key, cols))
+    times_and_bins = [_partition_args(stream_key, *args) for args in times_and_bins]
     result = []
-    for success, rows in execute_concurrent_with_args(SessionManager.session(), query, times_and_bins, concurrency=50):
+    for success, rows in SessionManager.execute_concurrent_with_args(query, times_and_bins, hedge=True):
         if success:
             result.extend(list(rows))
     return result
@@ -160,12 +788,12 @@ def query_first_after(stream_key, times_and_bins, cols):
 
 @log_timing(log)
 def query_n_before(stream_key, query_arguments, cols):
-    query = "select %s from %s where subsite='%s' and node='%s' and sensor='%s' and bin=? and method='%s' and time <= ? ORDER BY method DESC, time DESC LIMIT ?" % \
-            (', '.join(cols), stream_key.stream.name, stream_key.subsite, stream_key.node,
-             stream_key.sensor, stream_key.method)
-    query = SessionManager.prepare(query)
+    query = "select %s from %s where subsite=? and node=? and sensor=? and bin=? and method=? and time <= ? ORDER BY method DESC, time DESC LIMIT ?" % \
+            (', '.join(cols), stream_key.stream.name)
+    query = SessionManager.prepare(query, fetch_size=stream_fetch_size(stream_key, cols))
+    query_arguments = [_partition_args(stream_key, *args) for args in query_arguments]
     result = []
-    for success, rows in execute_concurrent_with_args(SessionManager.session(), query, query_arguments, concurrency=50):
+    for success, rows in SessionManager.execute_concurrent_with_args(query, query_arguments, hedge=True):
         if success:
             result.extend(list(rows))
     return result
@@ -173,24 +801,18 @@ def query_n_before(stream_key, query_arguments, cols):
 
 @log_timing(log)
 def query_full_bin(stream_key, bins_and_limit, cols):
-    query = "select %s from %s where subsite='%s' and node='%s' and sensor='%s' and bin=? and method='%s' and time >= ? and time <= ?" % \
-            (', '.join(cols), stream_key.stream.name, stream_key.subsite, stream_key.node,
-             stream_key.sensor, stream_key.method)
-    query = SessionManager.prepare(query)
+    query = "select %s from %s where subsite=? and node=? and sensor=? and bin=? and method=? and time >= ? and time <= ?" % \
+            (', '.join(cols), stream_key.stream.name)
+    query = SessionManager.prepare(query, fetch_size=stream_fetch_size(stream_key, cols))
+    bins_and_limit = [_partition_args(stream_key, *args) for args in bins_and_limit]
     result = []
-    for success, rows in execute_concurrent_with_args(SessionManager.session(), query, bins_and_limit, concurrency=50):
-        if success:
-            result.extend(list(rows))
+    # full bins span many pages, read each one with the paged reader
+    for rows in bin_executor.map(lambda args: SessionManager.execute_rows(query, args, hedge=True), bins_and_limit):
+        result.extend(rows)
     return result
 
 
-@log_timing(log)
-def fetch_l0_provenance(stream_key, provenance_values, deployment):
-    """
-    Fetch the l0_provenance entry for the passed information.
-    All of the necessary information should be stored as a tuple in the
-    provenance metadata store.
-    """
+def _l0_provenance_arguments(stream_key, provenance_values, deployment):
     # UUIDs are cast to strings so remove all 'None' values
     if stream_key.method.startswith('streamed'):
         deployment = 0
@@ -202,40 +824,144 @@ def fetch_l0_provenance(stream_key, provenance_values, deployment):
         except ValueError:
             pass
 
-    provenance_arguments = [
-        (stream_key.subsite, stream_key.node, stream_key.sensor,
-         stream_key.method, deployment, prov_id) for prov_id in prov_ids]
+    return [(stream_key.subsite, stream_key.node, stream_key.sensor,
+             stream_key.method, deployment, prov_id) for prov_id in prov_ids]
+
 
-    query = SessionManager.prepare(L0_DATASET)
-    results = execute_concurrent_with_args(SessionManager.session(), query, provenance_arguments)
-    records = [ProvTuple(*rows[0]) for success, rows in results if success and rows]
+@log_timing(log)
+def fetch_l0_provenance_many(lookups):
+    """
+    Fetch the l0_provenance entries for several streams and deployments at once.
+    Records are served from the process wide provenance cache, all misses are queried concurrently.
+    :param lookups: list of (stream_key, provenance_values, deployment)
+    :return: list of provenance dictionaries in the same order as lookups
+    """
+    arguments = [_l0_provenance_arguments(*lookup) for lookup in lookups]
+    missing = {}
+    with l0_provenance_lock:
+        for provenance_arguments in arguments:
+            for args in provenance_arguments:
+                key = str(args[-1])
+                if key not in l0_provenance_cache:
+                    missing[key] = args
+
+    if missing:
+        query = SessionManager.prepare(L0_DATASET)
+        results = SessionManager.execute_concurrent_with_args(query, missing.values(), hedge=True)
+        records = [ProvTuple(*rows[0]) for success, rows in results if success and rows]
+
+        if len(missing) != len(records):
+            log.warn("Could not find %d provenance entries", len(missing) - len(records))
+
+        with l0_provenance_lock:
+            for row in records:
+                l0_provenance_cache[str(row.id)] = {'file_name': row.file_name,
+                                                    'parser_name': row.parser_name,
+                                                    'parser_version': row.parser_version}
+
+    prov_dicts = []
+    with l0_provenance_lock:
+        for provenance_arguments in arguments:
+            prov_dict = {}
+            for args in provenance_arguments:
+                key = str(args[-1])
+                record = l0_provenance_cache.get(key)
+                if record is not None:
+                    prov_dict[key] = record
+            prov_dicts.append(prov_dict)
+    return prov_dicts
 
-    if len(provenance_arguments) != len(records):
-        log.warn("Could not find %d provenance entries", len(provenance_arguments) - len(records))
 
-    prov_dict = {
-        str(row.id): {'file_name': row.file_name,
-                      'parser_name': row.parser_name,
-                      'parser_version': row.parser_version}
-        for row in records}
-    return prov_dict
+def fetch_l0_provenance(stream_key, provenance_values, deployment):
+    """
+    Fetch the l0_provenance entry for the passed information.
+    All of the necessary information should be stored as a tuple in the
+    provenance metadata store.
+    """
+    return fetch_l0_provenance_many([(stream_key, provenance_values, deployment)])[0]
+
+
+def load_l0_provenance_cache(path):
+    """
+    Populate the provenance cache from a file written by save_l0_provenance_cache
+    """
+    if not path or not os.path.exists(path):
+        return
+    try:
+        with open(path) as fh:
+            records = json.load(fh)
+    except (IOError, ValueError) as e:
+        log.warn('Unable to read provenance cache %s: %s', path, e)
+        return
+    with l0_provenance_lock:
+        for key, record in records.iteritems():
+            l0_provenance_cache[key] = record
+    log.info('Loaded %d provenance records from %s', len(records), path)
+
+
+def save_l0_provenance_cache(path):
+    """
+    Write the provenance cache to disk so it survives worker restarts
+    """
+    if not path:
+        return
+    with l0_provenance_lock:
+        records = dict(l0_provenance_cache.items())
+    try:
+        directory = os.path.dirname(path)
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as fh:
+            json.dump(records, fh)
+        os.rename(temp_path, path)
+    except (IOError, OSError) as e:
+        log.warn('Unable to write provenance cache %s: %s', path, e)
 
 
 @log_timing(log)
-def fetch_nth_data(stream_key, time_range, num_points=1000, location_metadata=None, request_id=None):
+def fetch_nth_data(stream_key, time_range, num_points=1000, location_metadata=None, request_id=None, columns=None):
     """
     Given a time range, generate evenly spaced times over the specified interval. Fetch a single
     result from either side of each point in time.
     :param stream_key:
     :param time_range:
     :param num_points:
+    :param columns: optional set of columns needed by the request
     :return:
     """
-    cols = SessionManager.get_query_columns(stream_key.stream.name)
+    cols = SessionManager.get_query_columns(stream_key.stream.name, columns)
 
     if location_metadata is None:
         location_metadata, _, _ = get_location_metadata(stream_key, time_range)
 
+    decimated = {}
+    if decimation.enabled():
+        decimated, location_metadata, num_points = sample_decimated_bins(stream_key, time_range, num_points,
+                                                                         location_metadata, cols)
+
+    rows = []
+    if location_metadata.bin_list:
+        rows = _sample_bins(stream_key, time_range, num_points, location_metadata, cols, columns)
+    builder = ColumnBuilder(cols, stream_key, len(rows))
+    builder.add_page(rows)
+    data = concatenate_columns(cols, [decimated, builder.columns()])
+    if not data:
+        return None
+
+    # dedup on particle id, keeping the first occurrence, then order by time
+    size = len(data['id'])
+    keep = numpy.flatnonzero(~pd.Index(data['id']).duplicated())
+    keep = keep[numpy.argsort(data['time'][keep], kind='mergesort')]
+    data = {c: data[c][keep] for c in cols}
+    log.info("Removed %d duplicates from data", size - keep.size)
+    log.info("Returning %s rows from %s fetch", keep.size, stream_key.as_refdes())
+    return to_xray_dataset(cols, data, stream_key, request_id)
+
+
+def _sample_bins(stream_key, time_range, num_points, location_metadata, cols, columns):
+    """
+    Choose a sampling strategy for the bins in location_metadata based on the estimated data volume
+    :return: list of rows
+    """
     estimated_rate = location_metadata.particle_rate()
     estimated_particles = int(estimated_rate * time_range.secs())
     data_ratio = estimated_particles / num_points
@@ -246,36 +972,77 @@ def fetch_nth_data(stream_key, time_range, num_points=1000, location_metadata=No
         log.info(
                 "CASS: Estimated points (%d) / the requested  number (%d) is less than ratio %f.  Returning all points.",
                 estimated_particles, num_points, engine.app.config['UI_FULL_RETURN_RATIO'])
-        _, results = fetch_all_data(stream_key, time_range, location_metadata)
+        _, results = fetch_all_data(stream_key, time_range, location_metadata, columns=columns)
+        return results
     # We have a small amount of bins with data so we can read them all
     elif estimated_particles < engine.app.config['UI_FULL_SAMPLE_LIMIT'] \
             and data_ratio < engine.app.config['UI_FULL_SAMPLE_RATIO']:
         log.info("CASS: Reading all (%d) bins and then sampling.", len(location_metadata.bin_list))
         _, results = sample_full_bins(stream_key, time_range, num_points, location_metadata.bin_list, cols)
+        return results
     # We have a lot of bins so just grab the first from each of the bins
     elif len(location_metadata.bin_list) > num_points:
         log.info("CASS: More bins (%d) than requested points (%d). Selecting first particle from %d bins.",
                  len(location_metadata.bin_list), num_points, num_points)
         _, results = sample_n_bins(stream_key, time_range, num_points, location_metadata.bin_list, cols)
+        return results
     else:
         log.info("CASS: Sampling %d points across %d bins.", num_points, len(location_metadata.bin_list))
         _, results = sample_n_points(stream_key, time_range, num_points, location_metadata.bin_list,
                                      location_metadata.bin_information, cols)
+        return results
+
 
-    # dedup data before return values
-    size = len(results)
-    to_return = []
-    uuids = set()
-    uuid_index = cols.index('id')
-    for row in results:
-        my_uuid = row[uuid_index]
-        if my_uuid in uuids:
+def sample_decimated_bins(stream_key, time_range, num_points, location_metadata, cols):
+    """
+    Answer as much of a limited query as possible from the local decimation pyramids.
+    Bins without a valid pyramid are left to be queried, settled bins are scheduled to be decimated
+    in the background.
+    :return: (column dictionary of sampled particles, LocationMetadata of the remaining bins,
+              number of points to sample from the remaining bins)
+    """
+    span = time_range.secs()
+    decimated = []
+    remaining = {}
+    remaining_points = num_points
+    for data_bin in location_metadata.bin_list:
+        count, first, last = location_metadata.bin_information[data_bin]
+        pyramid = decimation.get_pyramid(stream_key, data_bin, count, last, cols)
+        if pyramid is None:
+            remaining[data_bin] = location_metadata.bin_information[data_bin]
+            if decimation.is_settled(last) and decimation.start_build(stream_key, data_bin):
+                decimation_executor.submit(build_decimation, stream_key, data_bin, count, first, last)
             continue
-        uuids.add(my_uuid)
-        to_return.append(row)
-    log.info("Removed %d duplicates from data", size - len(to_return))
-    log.info("Returning %s rows from %s fetch", len(to_return), stream_key.as_refdes())
-    return to_xray_dataset(cols, to_return, stream_key, request_id)
+        covered = min(last, time_range.stop) - max(first, time_range.start)
+        points = int(num_points * covered / span) if span > 0 and covered > 0 else 1
+        points = max(points, 1)
+        decimated.append(pyramid.select(time_range, points, cols))
+        remaining_points -= points
+
+    if decimated:
+        log.info("CASS: Sampled %d of %d bins from decimation pyramids", len(decimated),
+                 len(location_metadata.bin_list))
+        location_metadata = LocationMetadata(remaining)
+    return concatenate_columns(cols, decimated), location_metadata, max(remaining_points, 1)
+
+
+def build_decimation(stream_key, data_bin, count, first, last):
+    """
+    Read a complete bin and store its decimation pyramid
+    """
+    failed = False
+    try:
+        cols = SessionManager.get_query_columns(stream_key.stream.name)
+        columns = execute_columnar_query(stream_key, cols, data_bin, TimeRange(first, last), (count, first, last))
+        if len(columns['time']):
+            pyramid = decimation.build_pyramid(columns, count, first, last)
+            decimation.store_pyramid(stream_key, data_bin, pyramid)
+            log.info('Stored decimation pyramid for %s bin %d', stream_key.as_refdes(), data_bin)
+    except Exception as e:
+        log.exception('Unable to build decimation pyramid for %s bin %d: %s', stream_key.as_refdes(), data_bin, e)
+        failed = True
+    finally:
+        decimation.finish_build(stream_key, data_bin, failed)
 
 
 @log_timing(log)
@@ -288,8 +1055,7 @@ def sample_full_bins(stream_key, time_range, num_points, metadata_bins, cols=Non
         results = all_data
     else:
         indexes = numpy.linspace(0, len(all_data) - 1, num_points).astype(int)
-        selected_data = numpy.array(all_data)[indexes].tolist()
-        results = selected_data
+        results = [all_data[i] for i in indexes]
     return cols, results
 
 
@@ -312,8 +1078,6 @@ def sample_n_bins(stream_key, time_range, num_points, metadata_bins, cols=None):
     # Get the last data point
     _, rows = fetch_with_func(query_n_before, stream_key, [(lb, time_range.stop, 1)], cols=cols)
     results.extend(rows)
-    tindex = cols.index('time')
-    results = sorted(results, key=lambda dat: dat[tindex])
     return cols, results
 
 
@@ -324,40 +1088,39 @@ def sample_n_points(stream_key, time_range, num_points, metadata_bins, bin_infor
     cols, rows = fetch_with_func(query_first_after, stream_key, [(metadata_bins[0], time_range.start)], cols=cols)
     results.extend(rows)
 
-    # create a set to keep track of queries and avoid duplicates
-    queries = set()
-    # We want to know start and stop time of each bin that has data
-    metadata_bins = [(x, bin_information[x][1], bin_information[x][2]) for x in metadata_bins]
-    metadata_bins.sort()
-    bin_queue = deque(metadata_bins)
-    # Create our time array of sampling times
-    times = numpy.linspace(time_range.start, time_range.stop, num_points)
-    # Get the first bin that has data within the range
-    current = bin_queue.popleft()
-    for t in times:
-        # Are we currently within the range of data in the bin if so add a sampling point
-        if t < current[1]:
-            continue
-        if t < current[2]:
-            queries.add((current[0], t, 1))
-        else:
-            # can we roll over to the next one?
-            if len(bin_queue) > 0 and bin_queue[0][1] <= t:
-                current = bin_queue.popleft()
-                queries.add((current[0], t, 1))
-            # otherwise get the last sample from the last bin we had
-            else:
-                queries.add((current[0], current[2], 1))
-    times = list(queries)
-    times.append((metadata_bins[-1][0], time_range.stop, 1))
+    times = plan_sample_queries(time_range, num_points, metadata_bins, bin_information)
     _, lin_sampled = fetch_with_func(query_n_before, stream_key, times, cols)
     results.extend(lin_sampled)
-    # Sort the data
-    tindex = cols.index('time')
-    results = sorted(results, key=lambda dat: dat[tindex])
     return cols, results
 
 
+def plan_sample_queries(time_range, num_points, metadata_bins, bin_information):
+    """
+    Build the (bin, time, limit) arguments for query_n_before which sample num_points evenly spaced
+    times across the time range. Each time is assigned to the last bin starting at or before it,
+    times falling in a gap after a bin fetch the last particle of that bin.
+    """
+    bins = numpy.array(metadata_bins)
+    firsts = numpy.array([bin_information[b][1] for b in metadata_bins], dtype=numpy.float64)
+    lasts = numpy.array([bin_information[b][2] for b in metadata_bins], dtype=numpy.float64)
+    order = numpy.argsort(firsts, kind='mergesort')
+    bins, firsts, lasts = bins[order], firsts[order], lasts[order]
+
+    times = numpy.linspace(time_range.start, time_range.stop, num_points)
+    index = numpy.searchsorted(firsts, times, side='right') - 1
+    valid = index >= 0
+    times = times[valid]
+    index = index[valid]
+
+    inside = times < lasts[index]
+    gaps = numpy.unique(index[~inside])
+    query_bins = numpy.concatenate((bins[index[inside]], bins[gaps])).tolist()
+    query_times = numpy.concatenate((times[inside], lasts[gaps])).tolist()
+    queries = [(b, t, 1) for b, t in izip(query_bins, query_times)]
+    queries.append((bins[-1].item(), time_range.stop, 1))
+    return queries
+
+
 def fetch_with_func(f, stream_key, args, cols=None):
     if cols is None:
         cols = SessionManager.get_query_columns(stream_key.stream.name)
@@ -368,57 +1131,214 @@ def fetch_with_func(f, stream_key, args, cols=None):
 def fetch_bin(stream_key, time_bin):
     """
     Fetch an entire bin
+    :return: column names and a dictionary of column name to numpy array
     """
     cols = SessionManager.get_query_columns(stream_key.stream.name)
+    bin_meta = None
+    if bin_cache.enabled():
+        bin_meta = metadata_service_api.get_partition_metadata_record(
+            *(stream_key.as_tuple() + (time_bin, CASS_LOCATION_NAME))
+        )
+    if bin_meta is not None:
+        cached = bin_cache.get_columns(stream_key, time_bin, bin_meta['count'], bin_meta['last'], cols)
+        if cached is not None:
+            return cols, cached
 
+    bin_info = (bin_meta['count'], bin_meta['first'], bin_meta['last']) if bin_meta else None
+    data = execute_bin_columnar_query(stream_key, cols, time_bin, bin_info)
+    if bin_meta is not None and bin_cache.is_settled(bin_meta['last']):
+        bin_cache.store_columns(stream_key, time_bin, bin_meta['count'], bin_meta['last'], data)
+    return cols, data
+
+
+def execute_bin_columnar_query(stream_key, cols, time_bin, bin_info=None):
+    """
+    Read an entire bin straight into column arrays. Oversized bins are read in time slices between
+    the first and last time of the partition metadata, see plan_time_slices.
+    :param bin_info: optional partition metadata (count, first, last)
+    """
+    size_hint = 0
+    if bin_info is not None:
+        count, first, last = bin_info
+        if len(plan_time_slices(TimeRange(first, last), bin_info)) > 1:
+            return execute_columnar_query(stream_key, cols, time_bin, TimeRange(first, last), bin_info)
+        size_hint = count
     base = "select %s from %s where subsite=? and node=? and sensor=? and bin=? and method=?" \
            % (','.join(cols), stream_key.stream.name)
-    query = SessionManager.prepare(base)
-    return cols, list(SessionManager.execute(query, (stream_key.subsite,
-                                                     stream_key.node,
-                                                     stream_key.sensor,
-                                                     time_bin,
-                                                     stream_key.method)))
+    query = SessionManager.prepare(base, fetch_size=stream_fetch_size(stream_key, cols))
+    builder = ColumnBuilder(cols, stream_key, size_hint)
+    consistency_level = bin_consistency(stream_key, time_bin, bin_info)
+    statement, args = _bind(query, _partition_args(stream_key, time_bin), consistency_level)
+    SessionManager.execute_columnar(statement, args, builder)
+    return builder.columns()
+
+
+def read_bin_columns(stream_key, cols, time_bin, time_range, bin_info):
+    """
+    Read the particles of a bin within the time range as column arrays. Settled bins read completely
+    by a request are kept in the local bin cache, later reads are sliced from the cache.
+    :param bin_info: partition metadata (count, first, last)
+    """
+    count, first, last = bin_info
+    if bin_cache.enabled():
+        data = bin_cache.get_columns(stream_key, time_bin, count, last, cols)
+        if data is None and bin_cache.is_settled(last) and time_range.start <= first and time_range.stop >= last:
+            # only populate the cache when the request already covers the whole bin
+            data = execute_bin_columnar_query(stream_key, cols, time_bin, bin_info)
+            bin_cache.store_columns(stream_key, time_bin, count, last, data)
+        if data is not None:
+            # rows within a partition are ordered by time
+            times = data['time']
+            start = numpy.searchsorted(times, time_range.start, side='left')
+            stop = numpy.searchsorted(times, time_range.stop, side='right')
+            if start == 0 and stop == times.size:
+                return data
+            return {c: data[c][start:stop] for c in cols}
+    return execute_columnar_query(stream_key, cols, time_bin, time_range, bin_info)
 
 
 # Fetch all records in the time_range by querying for every time bin in the time_range
 @log_timing(log)
-def fetch_all_data(stream_key, time_range, location_metadata=None):
+def fetch_all_data(stream_key, time_range, location_metadata=None, columnar=False, columns=None):
     """
     Given a time range, Fetch all records from the starting hour to ending hour
     :param stream_key:
     :param time_range:
+    :param columnar: return a dictionary of column arrays instead of a list of rows
+    :param columns: optional set of columns needed by the request
     :return:
     """
     if location_metadata is None:
         location_metadata = get_location_metadata_by_store(stream_key, time_range, CASS_LOCATION_NAME)
-    cols = SessionManager.get_query_columns(stream_key.stream.name)
+    cols = SessionManager.get_query_columns(stream_key.stream.name, columns)
+
+    def fetch_one(bin_num):
+        bin_info = location_metadata.bin_information[bin_num]
+        if columnar:
+            return read_bin_columns(stream_key, cols, bin_num, time_range, bin_info)
+        return execute_unlimited_query(stream_key, cols, bin_num, time_range, bin_info)
+
+    # Each bin is read with its own paged query. The executor bounds the number of bins
+    # in flight and map() yields the results in bin_list order, keeping the rows sorted.
+    results = bin_executor.map(fetch_one, location_metadata.bin_list)
+    if columnar:
+        return cols, concatenate_columns(cols, list(results))
 
     rows = []
-    for bin_num in location_metadata.bin_list:
-        rows.extend(execute_unlimited_query(stream_key, cols, bin_num, time_range))
+    for bin_rows in results:
+        rows.extend(bin_rows)
 
     return cols, rows
 
 
 @log_timing(log)
-def get_full_cass_dataset(stream_key, time_range, location_metadata=None, request_id=None):
-    cols, rows = fetch_all_data(stream_key, time_range, location_metadata)
-    return to_xray_dataset(cols, rows, stream_key, request_id)
+def get_full_cass_dataset(stream_key, time_range, location_metadata=None, request_id=None, columns=None):
+    cols, data = fetch_all_data(stream_key, time_range, location_metadata, columnar=True, columns=columns)
+    return to_xray_dataset(cols, data, stream_key, request_id)
 
 
-@log_timing(log)
-def execute_unlimited_query(stream_key, cols, time_bin, time_range):
+def _unlimited_query(stream_key, cols, inclusive=True):
+    """
+    :param inclusive: include particles at the stop time, time slices other than the last exclude them
+    """
     base = ("select %s from %s where subsite=? and node=? and sensor=? and bin=? " +
-            "and method=? and time>=? and time<=?") % (','.join(cols), stream_key.stream.name)
-    query = SessionManager.prepare(base)
-    return list(SessionManager.execute(query, (stream_key.subsite,
-                                               stream_key.node,
-                                               stream_key.sensor,
-                                               time_bin,
-                                               stream_key.method,
-                                               time_range.start,
-                                               time_range.stop)))
+            "and method=? and time>=? and time%s?") % (','.join(cols), stream_key.stream.name,
+                                                       '<=' if inclusive else '<')
+    return SessionManager.prepare(base, fetch_size=stream_fetch_size(stream_key, cols))
+
+
+@log_timing(log)
+def execute_unlimited_query(stream_key, cols, time_bin, time_range, bin_info=None):
+    """
+    Read a bin within the time range as a list of rows, oversized bins are read as time slices
+    :param bin_info: optional partition metadata (count, first, last)
+    """
+    if bin_info is None or len(plan_time_slices(time_range, bin_info)) == 1:
+        return _read_time_slice(stream_key, cols, time_bin, time_range, columnar=False,
+                                consistency_level=bin_consistency(stream_key, time_bin, bin_info))
+    rows = []
+    for slice_rows in _read_time_slices(stream_key, cols, time_bin, time_range, bin_info, columnar=False):
+        rows.extend(slice_rows)
+    return rows
+
+
+def plan_time_slices(time_range, bin_info):
+    """
+    Split the part of a bin within the time range into sub-ranges of roughly CASSANDRA_SLICE_ROWS particles,
+    assuming the particles are spread evenly between the first and last time of the bin. Only bins holding
+    more than CASSANDRA_SLICE_PARTITION_ROWS particles are split.
+    :param bin_info: partition metadata (count, first, last)
+    :return: list of TimeRange, each excludes its stop time except the last
+    """
+    count, first, last = bin_info
+    start = max(time_range.start, first)
+    stop = min(time_range.stop, last)
+    config = engine.app.config
+    if count <= config['CASSANDRA_SLICE_PARTITION_ROWS'] or stop <= start or last <= first:
+        return [time_range]
+    num_slices = int(math.ceil(count * (stop - start) / (last - first) / config['CASSANDRA_SLICE_ROWS']))
+    if num_slices <= 1:
+        return [time_range]
+    bounds = [float(t) for t in numpy.linspace(start, stop, num_slices + 1)]
+    # keep the requested bounds, particles may lie outside the partition metadata range
+    bounds[0] = time_range.start
+    bounds[-1] = time_range.stop
+    return [TimeRange(bounds[i], bounds[i + 1]) for i in xrange(num_slices)]
+
+
+def _read_time_slice(stream_key, cols, time_bin, time_range, inclusive=True, size_hint=0, retries=0, columnar=True,
+                     consistency_level=None):
+    """
+    Read a single time range of a bin into column arrays, or a list of rows, retrying the range on failure
+    """
+    query = _unlimited_query(stream_key, cols, inclusive)
+    statement, args = _bind(query, _partition_args(stream_key, time_bin, time_range.start, time_range.stop),
+                            consistency_level)
+    for attempt in xrange(retries + 1):
+        try:
+            if not columnar:
+                return SessionManager.execute_rows(statement, args)
+            builder = ColumnBuilder(cols, stream_key, size_hint)
+            SessionManager.execute_columnar(statement, args, builder)
+            return builder.columns()
+        except Exception as e:
+            if attempt == retries:
+                raise
+            log.warn('Retrying %s bin %d slice %r after error: %s', stream_key.as_refdes(), time_bin, time_range, e)
+
+
+@log_timing(log)
+def execute_columnar_query(stream_key, cols, time_bin, time_range, bin_info=None):
+    """
+    Read a bin within the time range straight into column arrays. Given the partition metadata, oversized
+    bins are read as time slices in parallel and only failed slices are retried, see plan_time_slices.
+    :param bin_info: optional partition metadata (count, first, last), the count preallocates the arrays
+    :return: dictionary of column name to numpy array
+    """
+    if bin_info is None:
+        return _read_time_slice(stream_key, cols, time_bin, time_range)
+    if len(plan_time_slices(time_range, bin_info)) == 1:
+        return _read_time_slice(stream_key, cols, time_bin, time_range, size_hint=bin_info[0],
+                                consistency_level=bin_consistency(stream_key, time_bin, bin_info))
+    columns = _read_time_slices(stream_key, cols, time_bin, time_range, bin_info)
+    return concatenate_columns(cols, columns) or columns[0]
+
+
+def _read_time_slices(stream_key, cols, time_bin, time_range, bin_info, columnar=True):
+    """
+    Read the time slices of an oversized bin in parallel
+    :return: list of the result of each slice, in time order
+    """
+    slices = plan_time_slices(time_range, bin_info)
+    log.info('Reading %s bin %d in %d time slices', stream_key.as_refdes(), time_bin, len(slices))
+    size_hint = bin_info[0] / len(slices)
+    retries = engine.app.config['CASSANDRA_SLICE_RETRIES']
+    consistency_level = bin_consistency(stream_key, time_bin, bin_info)
+    last_slice = slices[-1]
+    futures = [slice_executor.submit(_read_time_slice, stream_key, cols, time_bin, time_slice,
+                                     time_slice is last_slice, size_hint, retries, columnar, consistency_level)
+               for time_slice in slices]
+    return [future.result() for future in futures]
 
 
 def _get_stream_row_count(stream_key, data_bin):
@@ -460,7 +1380,6 @@ def insert_dataset(stream_key, dataset):
     cols = key_cols + dynamic_cols
     arrays = {p.name for p in stream_key.stream.parameters
               if not p.is_function and p.parameter_type == 'array<quantity>'}
-    data_lists['bin'] = [data_bin] * size
     # id and provenance are expected to be UUIDs so convert them to uuids
     data_lists['id'] = [uuid.UUID(x) for x in dataset['id'].values]
     data_lists['provenance'] = [uuid.UUID(x) for x in dataset['provenance'].values]
@@ -481,93 +1400,279 @@ def insert_dataset(stream_key, dataset):
         log.warn("Data present in Cassandra bin %s for %s.  Overwriting old and adding new data.", data_bin,
                  stream_key.as_refdes())
 
-    # get the query to insert information
+    # get the query to insert information, all values (including the partition key) are bound
     col_names = ', '.join(cols)
-    # Take subsite, node, sensor, ?, and method
-    key_str = "'{:s}', '{:s}', '{:s}', ?, '{:s}'".format(stream_key.subsite, stream_key.node, stream_key.sensor,
-                                                         stream_key.method)
-    # and the rest as ? for thingskey_cols[:3] +['?'] + key_cols[4:] + ['?' for _ in cols]
-    data_str = ', '.join(['?' for _ in dynamic_cols])
-    full_str = '{:s}, {:s}'.format(key_str, data_str)
-    query = 'INSERT INTO {:s} ({:s}) VALUES ({:s})'.format(stream_key.stream.name, col_names, full_str)
+    values_str = ', '.join(['?' for _ in cols])
+    query = 'INSERT INTO {:s} ({:s}) VALUES ({:s})'.format(stream_key.stream.name, col_names, values_str)
     query = SessionManager.prepare(query)
 
     # make the data list
     to_insert = []
-    data_names = ['bin'] + dynamic_cols
     for i in range(size):
-        row = [data_lists[col][i] for col in data_names]
-        to_insert.append(row)
+        row = [data_lists[col][i] for col in dynamic_cols]
+        to_insert.append(_partition_args(stream_key, data_bin, *row))
+
+    # reads of this bin use the default consistency level until the grace window has passed
+    record_bin_write(stream_key, data_bin)
+    start_time = time.time()
+    if engine.app.config['SAN_ONLOAD_LWT']:
+        insert_count, update_count, written = _insert_rows_lwt(stream_key, data_bin, query, to_insert)
+    else:
+        insert_count, update_count, written = _insert_rows_batched(stream_key, data_bin, query, to_insert)
+    elapsed = time.time() - start_time
+    log.info("Wrote %d rows to Cassandra bin %d for %s in %.2f seconds (%.1f rows/sec)", len(to_insert), data_bin,
+             stream_key.as_refdes(), elapsed, len(to_insert) / elapsed if elapsed > 0 else 0)
+
+    # Index only the rows which were written into the metadata record
+    if written.any():
+        times = dataset['time'].values[written]
+        bin_meta = metadata_service_api.build_partition_metadata_record(
+            *(stream_key.as_tuple() + (data_bin, CASS_LOCATION_NAME, times.min(), times.max(), insert_count))
+        )
+        metadata_service_api.index_partition_metadata_record(bin_meta)
+        invalidate_partition_metadata(stream_key)
 
+    ret_val = 'Inserted {:d} and updated {:d} particles within Cassandra bin {:d} for {:s}.'.format(insert_count, update_count, data_bin, stream_key.as_refdes())
+    fails = written.size - numpy.count_nonzero(written)
+    if fails:
+        ret_val += ' Failed to write {:d} particles, the bin must be onloaded again.'.format(fails)
+        log.error(ret_val)
+    else:
+        log.info(ret_val)
+    return ret_val
+
+
+def _insert_rows_lwt(stream_key, data_bin, query, to_insert):
+    """
+    Create each row with a lightweight transaction to count the new rows, then write the full rows
+    :return: (inserted count, updated count, boolean array of the rows written)
+    """
     ###############################################################
     # Build & execute query to create rows and count the new rows #
     ###############################################################
     primary_key_columns = ['subsite', 'node', 'sensor', 'bin', 'method', 'time', 'deployment', 'id']
     create_rows_columns = ', '.join(primary_key_columns)
-    # Fill in (subsite, node, sensor, method) leaving (bin, time, deployment, id) to be bound
-    create_rows_values = "'{:s}', '{:s}', '{:s}', ?, '{:s}', ?, ?, ?".format(
-        stream_key.subsite, stream_key.node, stream_key.sensor, stream_key.method
-    )
+    create_rows_values = ', '.join(['?' for _ in primary_key_columns])
     create_rows_query = 'INSERT INTO {:s} ({:s}) VALUES ({:s}) IF NOT EXISTS'.format(
         stream_key.stream.name, create_rows_columns, create_rows_values
     )
     create_rows_query = SessionManager.prepare(create_rows_query)
-    # We only want (bin, time, deployment, id)
-    create_rows_data = numpy.array(to_insert)[:, :4]
+    # We only want the primary key (subsite, node, sensor, bin, method, time, deployment, id)
+    create_rows_data = [row[:len(primary_key_columns)] for row in to_insert]
     # Execute query
-    insert_count = 0
+    created = numpy.zeros(len(to_insert), dtype=bool)
     fails = 0
-    for success, result in execute_concurrent_with_args(SessionManager.session(), create_rows_query, create_rows_data, concurrency=50, raise_on_first_error=False):
+    results = SessionManager.execute_concurrent_with_args(create_rows_query, create_rows_data,
+                                                          raise_on_first_error=False)
+    for index, (success, result) in enumerate(results):
         if not success:
             fails += 1
         elif result[0][0]:
-            insert_count += 1
+            created[index] = True
     if fails > 0:
         log.warn("Failed to create %d rows within Cassandra bin %d for %s!", fails, data_bin, stream_key.as_refdes())
 
     # Update previously existing rows and new mostly empty rows
-    fails = 0
-    for success, _ in execute_concurrent_with_args(SessionManager.session(), query, to_insert, concurrency=50, raise_on_first_error=False):
-        if not success:
-            fails += 1
+    written = numpy.zeros(len(to_insert), dtype=bool)
+    for index, (success, _) in enumerate(SessionManager.execute_concurrent_with_args(query, to_insert,
+                                                                                     raise_on_first_error=False)):
+        written[index] = success
+    fails = written.size - numpy.count_nonzero(written)
     if fails > 0:
         log.warn("Failed to update %d rows within Cassandra bin %d for %s!", fails, data_bin, stream_key.as_refdes())
-    update_count = len(to_insert) - fails - insert_count
+    insert_count = int(numpy.count_nonzero(created & written))
+    update_count = int(numpy.count_nonzero(written)) - insert_count
+    return insert_count, update_count, written
 
-    # Index the new data into the metadata record
-    first = dataset['time'].min()
-    last = dataset['time'].max()
-    bin_meta = metadata_service_api.build_partition_metadata_record(
-        *(stream_key.as_tuple() + (data_bin, CASS_LOCATION_NAME, first, last, insert_count))
-    )
-    metadata_service_api.index_partition_metadata_record(bin_meta)
 
-    ret_val = 'Inserted {:d} and updated {:d} particles within Cassandra bin {:d} for {:s}.'.format(insert_count, update_count, data_bin, stream_key.as_refdes())
-    log.info(ret_val)
-    return ret_val
+def _get_primary_keys(stream_key, data_bin):
+    """
+    Read the (time, deployment, id) of every row currently stored in a bin
+    """
+    query = SessionManager.prepare("select time, deployment, id from %s where subsite=? and node=? and sensor=? "
+                                   "and bin=? and method=?" % stream_key.stream.name,
+                                   fetch_size=stream_fetch_size(stream_key, ['time', 'deployment', 'id']))
+    keys = set()
+    for page in SessionManager.execute_paged(query, _partition_args(stream_key, data_bin)):
+        keys.update(page)
+    return keys
+
+
+def _estimate_value_bytes(value):
+    if value is None:
+        return 0
+    if isinstance(value, basestring):
+        return len(value)
+    if isinstance(value, uuid.UUID):
+        return 16
+    return getattr(value, 'nbytes', 8)
+
+
+def plan_batches(rows, max_rows, max_bytes):
+    """
+    Group rows into batches of at most max_rows rows and max_bytes estimated bytes, so batches of
+    wide rows stay below the cassandra batch_size_fail_threshold. A single row larger than max_bytes
+    is written on its own.
+    :return: list of (start, stop) row index ranges
+    """
+    batches = []
+    start = 0
+    batch_bytes = 0
+    for index, row in enumerate(rows):
+        row_bytes = sum(_estimate_value_bytes(value) for value in row)
+        if index > start and (index - start >= max_rows or batch_bytes + row_bytes > max_bytes):
+            batches.append((start, index))
+            start = index
+            batch_bytes = 0
+        batch_bytes += row_bytes
+    if start < len(rows):
+        batches.append((start, len(rows)))
+    return batches
+
+
+def _insert_rows_batched(stream_key, data_bin, query, to_insert):
+    """
+    Write rows in unlogged batches. All rows belong to the same partition so each batch is applied
+    as a single mutation. New rows are counted against a read of the primary keys already in the bin.
+    :return: (inserted count, updated count, boolean array of the rows written)
+    """
+    existing = _get_primary_keys(stream_key, data_bin)
+    # rows are (subsite, node, sensor, bin, method, time, deployment, id, ...)
+    key_slice = slice(5, 8)
+    config = engine.app.config
+
+    statements = []
+    counts = []
+    batches = plan_batches(to_insert, config['SAN_ONLOAD_BATCH_SIZE'], config['SAN_ONLOAD_BATCH_BYTES'])
+    for start, stop in batches:
+        batch = BatchStatement(batch_type=BatchType.UNLOGGED)
+        rows = to_insert[start:stop]
+        for row in rows:
+            batch.add(query, row)
+        new_rows = sum(1 for row in rows if tuple(row[key_slice]) not in existing)
+        statements.append((batch, ()))
+        counts.append(new_rows)
 
+    insert_count = 0
+    update_count = 0
+    written = numpy.zeros(len(to_insert), dtype=bool)
+    results = SessionManager.execute_concurrent(statements, concurrency=config['SAN_ONLOAD_CONCURRENCY'],
+                                                raise_on_first_error=False, shape='BATCH ' + query.query_string)
+    for (start, stop), new_rows, (success, _) in izip(batches, counts, results):
+        if success:
+            insert_count += new_rows
+            update_count += stop - start - new_rows
+            written[start:stop] = True
+    fails = written.size - numpy.count_nonzero(written)
+    if fails > 0:
+        log.warn("Failed to write %d rows within Cassandra bin %d for %s!", fails, data_bin, stream_key.as_refdes())
+    return insert_count, update_count, written
 
-@log_timing(log)
-def store_qc_results(qc_results_values, pk, particle_ids, particle_bins, particle_deploys,  # TODO: remove - unused
-                     param_name, strict_range=False):
-    start_time = time.clock()
-    if engine.app.config['QC_RESULTS_STORAGE_SYSTEM'] == CASS_LOCATION_NAME:
-        log.info('Storing QC results in Cassandra.')
-        insert_results = SessionManager.prepare(
-                "insert into ooi.qc_results "
-                "(subsite, node, sensor, bin, deployment, stream, id, parameter, results) "
-                "values (?, ?, ?, ?, ?, ?, ?, ?, ?)")
 
-        batch = BatchStatement()
+class QcResultsWriter(object):
+    """
+    Writes QC results to cassandra. Rows are grouped by partition (bin and deployment) into unlogged
+    batches and at most QC_RESULTS_CONCURRENCY batches are in flight, callers block until a slot is free.
+    Batches also take a slot from the worker's concurrency_limiter.
+    Written and failed rows are counted so the owning request can report them.
+    """
+    QUERY = "insert into ooi.qc_results (subsite, node, sensor, bin, deployment, stream, id, parameter, results) " \
+            "values (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+    MAX_ERRORS = 10
+
+    def __init__(self, request_id=None):
+        self.request_id = request_id
+        self.batch_size = engine.app.config['QC_RESULTS_BATCH_SIZE']
+        self.pending = 0
+        self.written = 0
+        self.failed = 0
+        self.errors = []
+        self._slots = ThreadSemaphore(engine.app.config['QC_RESULTS_CONCURRENCY'])
+        self._condition = Condition()
+        self._query = SessionManager.prepare(self.QUERY)
+
+    def write(self, qc_results_values, pk, particle_ids, particle_bins, particle_deploys, param_name):
+        partitions = {}
         for (qc_results, particle_id, particle_bin, particle_deploy) in izip(qc_results_values, particle_ids,
                                                                              particle_bins, particle_deploys):
-            batch.add(insert_results, (pk.get('subsite'), pk.get('node'), pk.get('sensor'),
-                                       particle_bin, particle_deploy, pk.get('stream'),
-                                       uuid.UUID(particle_id), param_name, str(qc_results)))
-        SessionManager.session().execute_async(batch)
-        log.info("QC results stored in {} seconds.".format(time.clock() - start_time))
+            row = (pk.get('subsite'), pk.get('node'), pk.get('sensor'), particle_bin, particle_deploy,
+                   pk.get('stream'), uuid.UUID(particle_id), param_name, str(qc_results))
+            partitions.setdefault((particle_bin, particle_deploy), []).append(row)
+
+        for rows in partitions.itervalues():
+            for index in xrange(0, len(rows), self.batch_size):
+                self._submit(rows[index:index + self.batch_size])
+
+    def _submit(self, rows):
+        batch = BatchStatement(batch_type=BatchType.UNLOGGED)
+        for row in rows:
+            batch.add(self._query, row)
+        slot = RequestSlot(self._slots)
+        with self._condition:
+            self.pending += 1
+        try:
+            future = SessionManager.execute_async(batch, shape='BATCH ' + self.QUERY)
+        except Exception as e:
+            self._handle_failure(e, len(rows), slot)
+            return
+        future.add_callbacks(callback=self._handle_success, callback_args=(len(rows), slot),
+                             errback=self._handle_failure, errback_args=(len(rows), slot))
+
+    def _handle_success(self, _, count, slot):
+        with self._condition:
+            self.written += count
+            self.pending -= 1
+            self._condition.notify_all()
+        slot.release()
+
+    def _handle_failure(self, exc, count, slot):
+        with self._condition:
+            self.failed += count
+            self.pending -= 1
+            if len(self.errors) < self.MAX_ERRORS:
+                self.errors.append(str(exc))
+            self._condition.notify_all()
+        slot.release(exc)
+
+    def finish(self):
+        """
+        Wait for all outstanding batches
+        :return: dictionary summarizing the rows written and failed
+        """
+        with self._condition:
+            while self.pending:
+                self._condition.wait()
+        summary = {'written': self.written, 'failed': self.failed, 'errors': list(self.errors)}
+        if self.failed:
+            log.error('<%s> Failed to store %d of %d QC results: %r', self.request_id, self.failed,
+                      self.failed + self.written, self.errors)
+        else:
+            log.info('<%s> Stored %d QC results', self.request_id, self.written)
+        return summary
+
+
+@log_timing(log)
+def store_qc_results(qc_results_values, pk, particle_ids, particle_bins, particle_deploys, param_name,
+                     request_id=None, writer=None):
+    """
+    Store the QC results for one parameter in the configured QC_RESULTS_STORAGE_SYSTEM.
+    When a QcResultsWriter is supplied the rows are queued on it and the caller is responsible
+    for calling finish, otherwise the results are written before returning.
+    :return: summary of the rows written to cassandra, None if no writer was finished here
+    """
+    start_time = time.clock()
+    if engine.app.config['QC_RESULTS_STORAGE_SYSTEM'] == CASS_LOCATION_NAME:
+        log.info('<%s> Storing QC results in Cassandra.', request_id)
+        owned = writer is None
+        if owned:
+            writer = QcResultsWriter(request_id)
+        writer.write(qc_results_values, pk, particle_ids, particle_bins, particle_deploys, param_name)
+        if owned:
+            summary = writer.finish()
+            log.info("<%s> QC results stored in %s seconds.", request_id, time.clock() - start_time)
+            return summary
     elif engine.app.config['QC_RESULTS_STORAGE_SYSTEM'] == 'log':
-        log.info('Writing QC results to log file.')
+        log.info('<%s> Writing QC results to log file.', request_id)
         qc_log = logging.getLogger('qc.results')
         qc_log_string = ""
         for (qc_results, particle_id, particle_bin, particle_deploy) in izip(qc_results_values, particle_ids,
@@ -576,7 +1681,7 @@ def store_qc_results(qc_results_values, pk, particle_ids, particle_bins, particl
                 .format(pk.get('subsite'), pk.get('node'), pk.get('sensor'), particle_bin,
                         pk.get('stream'), particle_deploy, particle_id, param_name, qc_results)
         qc_log.info(qc_log_string[:-1])
-        log.info("QC results stored in {} seconds.".format(time.clock() - start_time))
+        log.info("<%s> QC results stored in %s seconds.", request_id, time.clock() - start_time)
     else:
         log.info("Configured storage system '{}' not recognized, qc results not stored.".format(
                 engine.app.config['QC_RESULTS_STORAGE_SYSTEM']))
@@ -4,18 +4,25 @@ import datetime
 import logging
 import time
 from functools import wraps
+from threading import Lock, Thread
 
 import ntplib
 import numpy
+from sqlalchemy import inspect
+from sqlalchemy.orm import object_session
 
 from engine import app
-from ooi_data.postgres.model import Stream
+from ooi_data.postgres.model import Stream, Parameter, ParameterFunction, NominalDepth
 
 log = logging.getLogger(__name__)
 
+# preload catalog, see load_preload_catalog
 stream_cache = {}
+stream_id_cache = {}
 parameter_cache = {}
+dpi_cache = {}
 function_cache = {}
+nominal_depth_cache = {}
 
 
 def isfillvalue(a):
@@ -123,7 +130,7 @@ class StreamKey(object):
         self.sensor = sensor
         self.method = method
         self.stream_name = stream
-        self.stream = Stream.query.filter(Stream.name == stream).first()
+        self.stream = get_stream(stream)
 
     def _check_node(self, prefixes):
         for prefix in prefixes:
@@ -327,6 +334,119 @@ class InvalidPathException(StreamEngineException):
     status_code = 400
 
 
+def _register(instance):
+    """
+    Add a detached preload record to the catalog, a record already in the catalog is kept so each
+    id always resolves to the same instance
+    """
+    if isinstance(instance, Stream):
+        stream_id_cache.setdefault(instance.id, stream_cache.setdefault(instance.name, instance))
+    elif isinstance(instance, Parameter):
+        parameter_cache.setdefault(instance.id, instance)
+    elif isinstance(instance, ParameterFunction):
+        function_cache.setdefault(instance.function, instance)
+
+
+def _detach(instances):
+    """
+    Fully load the preload records and everything reachable from them, then remove them from their
+    session. Catalog entries are shared between request threads, once detached they can not lazy load
+    through another thread's scoped session. Every detached stream, parameter and function is added to
+    the catalog, a later lookup of a record reached through a relationship returns the same instance.
+    """
+    seen = {}
+    pending = list(instances)
+    while pending:
+        instance = pending.pop()
+        if instance is None or id(instance) in seen:
+            continue
+        seen[id(instance)] = instance
+        mapper = inspect(instance).mapper
+        for key in mapper.column_attrs.keys():
+            getattr(instance, key)
+        for relationship in mapper.relationships:
+            value = getattr(instance, relationship.key)
+            pending.extend(value if relationship.uselist else [value])
+
+    for instance in seen.itervalues():
+        session = object_session(instance)
+        if session is not None:
+            session.expunge(instance)
+        _register(instance)
+
+
+@log_timing(log)
+def load_preload_catalog():
+    """
+    Load the preload streams, parameters and QC/derived functions into the catalog caches so the
+    request path resolves them from memory. Called once per worker, preload does not change during
+    the life of a worker. Entries are otherwise loaded from the database on first use.
+    """
+    _detach(Stream.query.all() + Parameter.query.all() + ParameterFunction.query.all())
+
+    for parameter in parameter_cache.itervalues():
+        dpi_cache.setdefault(parameter.data_product_identifier, []).append(parameter)
+    log.info('Loaded preload catalog: %d streams, %d parameters, %d functions',
+             len(stream_cache), len(parameter_cache), len(function_cache))
+
+
+def get_stream(name):
+    stream = stream_cache.get(name)
+    if stream is None:
+        stream = Stream.query.filter(Stream.name == name).first()
+        if stream is not None:
+            _detach([stream])
+            stream = stream_cache[name]
+    return stream
+
+
+def get_stream_by_id(stream_id):
+    stream = stream_id_cache.get(stream_id)
+    if stream is None:
+        stream = Stream.query.get(stream_id)
+        if stream is not None:
+            stream = get_stream(stream.name)
+    return stream
+
+
+def get_parameter(pid):
+    parameter = parameter_cache.get(pid)
+    if parameter is None:
+        parameter = Parameter.query.get(pid)
+        if parameter is not None:
+            _detach([parameter])
+            parameter = parameter_cache[pid]
+    return parameter
+
+
+def get_parameters_by_dpi(dpi):
+    parameters = dpi_cache.get(dpi)
+    if parameters is None:
+        parameters = Parameter.query.filter(Parameter.data_product_identifier == dpi).all()
+        _detach(parameters)
+        parameters = dpi_cache[dpi] = [parameter_cache[parameter.id] for parameter in parameters]
+    return parameters
+
+
+def get_parameter_function(function_name):
+    function = function_cache.get(function_name)
+    if function is None:
+        function = ParameterFunction.query.filter_by(function=function_name).first()
+        if function is not None:
+            _detach([function])
+            function = function_cache[function_name]
+    return function
+
+
+def get_nominal_depth(subsite, node, sensor):
+    key = (subsite, node, sensor)
+    if key not in nominal_depth_cache:
+        nominal_depth = NominalDepth.get_nominal_depth(subsite, node, sensor)
+        _detach([nominal_depth])
+        nominal_depth_cache[key] = nominal_depth
+    return nominal_depth_cache[key]
+
+
 def timed_cache(expire_seconds):
     """
     Simple time-based cache. Only valid for functions which have no arguments
@@ -351,6 +471,52 @@ def timed_cache(expire_seconds):
     return wrapper
 
 
+def refreshing_cache(expire_seconds):
+    """
+    Time-based cache which keeps serving the previous result while an expired result is
+    rebuilt in a background thread. Only the first call waits for the function, a failed
+    refresh is logged and retried on the next call. Only valid for functions which have no arguments
+    :param expire_seconds: time in seconds before cached result is refreshed
+    :return:
+    """
+    cache = {'cache_time': 0, 'cache_value': None, 'refreshing': False}
+    lock = Lock()
+
+    def wrapper(func):
+        def store():
+            value = func()
+            with lock:
+                cache['cache_value'] = value
+                cache['cache_time'] = time.time()
+            return value
+
+        def refresh():
+            try:
+                store()
+            except Exception:
+                log.exception('Unable to refresh %s, serving the previous result', func.__name__)
+            finally:
+                with lock:
+                    cache['refreshing'] = False
+
+        @wraps(func)
+        def inner():
+            with lock:
+                if cache['cache_time'] and cache['cache_time'] + expire_seconds < time.time() \
+                        and not cache['refreshing']:
+                    cache['refreshing'] = True
+                    thread = Thread(target=refresh, name='refresh-' + func.__name__)
+                    thread.daemon = True
+                    thread.start()
+                if cache['cache_time']:
+                    return cache['cache_value']
+            return store()
+
+        return inner
+
+    return wrapper
+
+
 def read_size_config(config):
     """
     :param config:  file containing size estimates for each stream
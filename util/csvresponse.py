@@ -1,6 +1,10 @@
 import json
 import logging
 import os
+import shutil
+
+import numpy as np
+import pandas as pd
 
 from engine import app
 from util.common import ntp_to_datestring, WriteErrorException
@@ -56,6 +60,11 @@ class CsvGenerator(object):
         return json.dumps({"code": 200, "message": str(file_paths)}, indent=2)
 
     def _create_csv(self, dataset, filehandle):
+        # Write as CSV
+        return self._to_dataframe(dataset).to_csv(path_or_buf=filehandle, sep=self.delimiter)
+
+    @staticmethod
+    def _to_dataframe(dataset):
         # Drop fields we never want to output
         drop = {'bin', 'id', 'annotations'}
         dataset = dataset.drop(drop.intersection(dataset))
@@ -64,8 +73,7 @@ class CsvGenerator(object):
         drop_prov = {k for k in dataset if 'provenance' in k}
         dataset = dataset.drop(drop_prov)
 
-        # Write as CSV
-        return dataset.to_dataframe().to_csv(path_or_buf=filehandle, sep=self.delimiter)
+        return dataset.to_dataframe()
 
     def _get_suffix(self):
         """
@@ -77,3 +85,94 @@ class CsvGenerator(object):
         else:
             log.warn('%s is not in suffix map returning using default csv', self.delimiter)
             return '.csv'
+
+
+class ChunkedCsvWriter(object):
+    """
+    Appends the primary stream of successive time-windowed stream requests
+    to a single delimited file per deployment. Rows are written to part files without a header,
+    a new part is started whenever a window's columns differ from the previous window. The header
+    is written once the union of the columns of every window is known, see finish.
+    """
+    def __init__(self, path, delimiter):
+        self.path = path
+        self.delimiter = delimiter
+        self.base_path = os.path.join(app.config['LOCAL_ASYNC_DIR'], path)
+        self.stream_key = None
+        self._files = {}
+
+    def append(self, stream_request):
+        if not os.path.isdir(self.base_path):
+            try:
+                os.makedirs(self.base_path)
+            except OSError:
+                if not os.path.isdir(self.base_path):
+                    raise WriteErrorException('Unable to create local output directory: %s' % self.path)
+
+        generator = CsvGenerator(stream_request, self.delimiter)
+        self.stream_key = stream_request.stream_key
+        stream_dataset = stream_request.datasets[self.stream_key]
+        refdes = self.stream_key.as_dashed_refdes()
+
+        for deployment, ds in stream_dataset.datasets.iteritems():
+            times = ds.time.values
+            if not times.size:
+                continue
+            entry = self._files.get(deployment)
+            # continue the obs numbering of the previous windows in this file
+            offset = entry['rows'] if entry is not None else 0
+            dataframe = generator._to_dataframe(ds.assign_coords(obs=np.arange(offset, offset + ds.obs.size)))
+            columns = list(dataframe.columns)
+
+            if entry is None:
+                entry = {'start': times[0], 'rows': 0, 'columns': [], 'parts': [],
+                         'index': dataframe.index.name}
+                self._files[deployment] = entry
+            entry['end'] = times[-1]
+            entry['rows'] += ds.obs.size
+            entry['columns'].extend(c for c in columns if c not in entry['columns'])
+
+            if not entry['parts'] or entry['parts'][-1][1] != columns:
+                part_path = os.path.join(self.base_path, 'deployment%04d_%s.part%d' %
+                                         (deployment, refdes, len(entry['parts'])))
+                entry['parts'].append((part_path, columns))
+                mode = 'w'
+            else:
+                mode = 'a'
+            with open(entry['parts'][-1][0], mode) as filehandle:
+                dataframe.to_csv(path_or_buf=filehandle, sep=self.delimiter, header=False)
+
+    def _write_file(self, entry, file_path):
+        columns = entry['columns']
+        with open(file_path, 'w') as filehandle:
+            header = pd.DataFrame(columns=columns, index=pd.Index([], name=entry['index']))
+            header.to_csv(path_or_buf=filehandle, sep=self.delimiter)
+            for part_path, part_columns in entry['parts']:
+                if part_columns == columns:
+                    with open(part_path) as part:
+                        shutil.copyfileobj(part, filehandle)
+                else:
+                    # windows missing some of the columns are written with those columns empty
+                    part = pd.read_csv(part_path, sep=self.delimiter, header=None, index_col=0,
+                                       names=[entry['index']] + part_columns)
+                    part.reindex(columns=columns).to_csv(path_or_buf=filehandle, sep=self.delimiter, header=False)
+                os.remove(part_path)
+
+    def finish(self):
+        """
+        Write the accumulated windows to their final files
+        :return: JSON status message listing the files written
+        """
+        file_paths = []
+        if self.stream_key is not None:
+            refdes = self.stream_key.as_dashed_refdes()
+            suffix = CsvGenerator(None, self.delimiter)._get_suffix()
+            for deployment in sorted(self._files):
+                entry = self._files[deployment]
+                start = ntp_to_datestring(entry['start'])
+                end = ntp_to_datestring(entry['end'])
+                filename = 'deployment%04d_%s_%s-%s%s' % (deployment, refdes, start, end, suffix)
+                file_path = os.path.join(self.base_path, filename)
+                self._write_file(entry, file_path)
+                file_paths.append(file_path)
+        return json.dumps({"code": 200, "message": str(file_paths)}, indent=2)
@@ -87,12 +87,119 @@ def add_location_data(ds, lat, lon):
     ds['lon'] = ('obs', lon_array, {'axis': 'X', 'units': 'degrees_east', 'standard_name': 'longitude'})
 
 
+class ColumnBuilder(object):
+    """
+    Accumulates pages of raw cassandra rows into preallocated numpy arrays, one per column.
+    Numeric parameters are stored directly in their value encoding, everything else
+    (strings, UUIDs and msgpack encoded arrays) is stored in object arrays.
+    """
+    def __init__(self, cols, stream_key, size_hint=0):
+        self.cols = cols
+        self.size = 0
+        self._capacity = max(int(size_hint), 0)
+        self._dtypes = get_column_dtypes(cols, stream_key)
+        self._arrays = [self._allocate(dtype, fill, self._capacity) for dtype, fill in self._dtypes]
+
+    @staticmethod
+    def _allocate(dtype, fill, size):
+        array = np.empty(size, dtype=dtype)
+        if fill is not None:
+            array.fill(fill)
+        return array
+
+    def _grow(self, needed):
+        capacity = max(needed, self._capacity * 2)
+        for index, (dtype, fill) in enumerate(self._dtypes):
+            array = self._allocate(dtype, fill, capacity)
+            array[:self.size] = self._arrays[index][:self.size]
+            self._arrays[index] = array
+        self._capacity = capacity
+
+    def add_page(self, rows):
+        """
+        Decode a page of row tuples into the column arrays
+        """
+        count = len(rows)
+        if count == 0:
+            return
+        end = self.size + count
+        if end > self._capacity:
+            self._grow(end)
+        for index, values in enumerate(zip(*rows)):
+            target = self._arrays[index][self.size:end]
+            fill = self._dtypes[index][1]
+            try:
+                target[:] = values
+            except (TypeError, ValueError):
+                if fill is None:
+                    # object column containing sequences, numpy would try to broadcast them
+                    for i, value in enumerate(values):
+                        target[i] = value
+                else:
+                    # missing values in an integer column
+                    values = np.array(values, dtype=object)
+                    values[np.equal(values, None)] = fill
+                    target[:] = values
+        self.size = end
+
+    def columns(self):
+        """
+        :return: dictionary of column name to numpy array trimmed to the number of rows received
+        """
+        return {col: self._arrays[index][:self.size] for index, col in enumerate(self.cols)}
+
+
+def get_column_dtypes(cols, stream_key):
+    """
+    Determine the numpy dtype and fill value used to hold each raw cassandra column
+    :return: list of (dtype, fill value) in the same order as cols. Fill value is None for object columns
+    """
+    params = {p.name: p for p in stream_key.stream.parameters if not p.is_function}
+    dtypes = []
+    for column in cols:
+        param = params.get(column)
+        dtype = np.dtype(object)
+        fill = None
+        if param is None or param.parameter_type != 'array<quantity>':
+            encoding = param.value_encoding if param else None
+            encoding = app.config['INTERNAL_OUTPUT_MAPPING'].get(column, encoding)
+            try:
+                candidate = np.dtype(encoding) if encoding else dtype
+            except TypeError:
+                candidate = dtype
+            if candidate.kind in 'biuf':
+                dtype = candidate
+                fill = _get_fill_value(param) if param else FILL_VALUES.get(encoding)
+        dtypes.append((dtype, fill))
+    return dtypes
+
+
+def concatenate_columns(cols, column_dicts):
+    """
+    Join a list of column dictionaries (as produced by ColumnBuilder) into a single dictionary
+    """
+    column_dicts = [d for d in column_dicts if d and len(d[cols[0]])]
+    if not column_dicts:
+        return {}
+    if len(column_dicts) == 1:
+        return column_dicts[0]
+    return {col: np.concatenate([d[col] for d in column_dicts]) for col in cols}
+
+
 def to_xray_dataset(cols, data, stream_key, request_uuid, san=False):
     """
     Make an xray dataset from the raw cassandra data
+    Data may either be a list of rows or a dictionary of column arrays from the columnar read path.
     """
-    if not data:
-        return None
+    if isinstance(data, dict):
+        if not data or not len(data[cols[0]]):
+            return None
+        columns = data
+    else:
+        if not data:
+            return None
+        dataframe = pd.DataFrame(data=data, columns=cols)
+        columns = {column: dataframe[column].values for column in dataframe.columns}
 
     attrs = _get_ds_attrs(stream_key, request_uuid)
     params = {p.name: p for p in stream_key.stream.parameters if not p.is_function}
@@ -102,9 +209,8 @@ def to_xray_dataset(cols, data, stream_key, request_uuid, san=False):
         attrs['history'] = '{:s} {:s}'.format(datetime.datetime.utcnow().isoformat(), 'generated netcdf for SAN')
 
     dataset = xr.Dataset(attrs=attrs)
-    dataframe = pd.DataFrame(data=data, columns=cols)
 
-    for column in dataframe.columns:
+    for column in cols:
         if column in app.config['INTERNAL_OUTPUT_EXCLUDE_LIST']:
             continue
 
@@ -124,7 +230,7 @@ def to_xray_dataset(cols, data, stream_key, request_uuid, san=False):
         if column in app.config['INTERNAL_OUTPUT_MAPPING']:
             encoding = app.config['INTERNAL_OUTPUT_MAPPING'][column]
 
-        data = _replace_values(dataframe[column].values, encoding, fill_val, is_array, column)
+        data = _replace_values(columns[column], encoding, fill_val, is_array, column)
         data = _force_dtype(data, encoding)
         if data is None:
             log.error('<%s> Unable to encode data NAME: %s FROM: %s TO: %s, dropping from dataset',
@@ -167,7 +273,7 @@ def to_xray_dataset(cols, data, stream_key, request_uuid, san=False):
 
 def _force_dtype(data_slice, value_encoding):
     try:
-        return data_slice.astype(value_encoding)
+        return data_slice.astype(value_encoding, copy=False)
     except ValueError:
         return None
 
@@ -0,0 +1,253 @@
+"""
+Local multi-resolution decimation pyramids used to answer limited (UI) queries.
+
+A pyramid is built once per stream key and bin. The bin is split into DECIMATION_LEVELS[-1] equal
+time buckets and the first particle of each bucket is kept. Each coarser level is stored as an index
+into those particles. Pyramids are validated against the partition metadata count and last time so
+a bin which receives new data is rebuilt.
+
+Builds are claimed with a marker file next to the pyramid so only one worker process reads a bin at a
+time. A failed build leaves a failure marker and the bin is not retried for DECIMATION_RETRY_SECONDS.
+"""
+import errno
+import logging
+import os
+import tempfile
+import time
+from threading import Lock
+
+import ntplib
+import numpy as np
+from cachetools import LRUCache
+
+from engine import app
+
+log = logging.getLogger(__name__)
+
+LEVELS = sorted(app.config['DECIMATION_LEVELS'])
+COLUMN_PREFIX = 'col_'
+LEVEL_PREFIX = 'level_'
+BUILDING_SUFFIX = '.building'
+FAILED_SUFFIX = '.failed'
+
+_pyramid_cache = LRUCache(app.config['DECIMATION_MEMORY_CACHE_SIZE'])
+_pending = set()
+_lock = Lock()
+
+
+def enabled():
+    return bool(app.config['DECIMATION_ENABLED'] and app.config['DECIMATION_CACHE_DIR'])
+
+
+class Pyramid(object):
+    def __init__(self, count, first, last, columns, levels):
+        self.count = count
+        self.first = first
+        self.last = last
+        # dictionary of column name to the particles kept at the finest level
+        self.columns = columns
+        # dictionary of bucket count to indexes into columns
+        self.levels = levels
+
+    def is_valid(self, count, last, cols):
+        return self.count == count and self.last == last and all(c in self.columns for c in cols)
+
+    def select(self, time_range, num_points, cols):
+        """
+        Select up to num_points particles within the time range, evenly spaced in time
+        :return: dictionary of column name to numpy array
+        """
+        covered = min(self.last, time_range.stop) - max(self.first, time_range.start)
+        span = self.last - self.first
+        fraction = covered / span if span > 0 and covered > 0 else 1.0
+        # choose the coarsest level which still provides enough particles within the time range
+        needed = num_points / fraction
+        level = next((n for n in sorted(self.levels) if n >= needed), max(self.levels))
+        indexes = self.levels[level]
+
+        times = self.columns['time'][indexes]
+        indexes = indexes[(times >= time_range.start) & (times <= time_range.stop)]
+        if indexes.size > num_points:
+            indexes = indexes[np.linspace(0, indexes.size - 1, num_points).astype(int)]
+        return {c: self.columns[c][indexes] for c in cols}
+
+
+def _bucket_index(times, first, last, buckets):
+    if last <= first:
+        return np.zeros(times.size, dtype=int)
+    index = ((times - first) / float(last - first) * buckets).astype(int)
+    return np.clip(index, 0, buckets - 1)
+
+
+def build_pyramid(columns, count, first, last):
+    """
+    Build a pyramid from the full contents of a bin
+    :param columns: dictionary of column name to numpy array, as returned by the columnar read path
+    :param count: partition metadata particle count
+    :param first: partition metadata first time
+    :param last: partition metadata last time
+    """
+    times = columns['time']
+    order = np.argsort(times, kind='mergesort')
+    _, keep = np.unique(_bucket_index(times[order], first, last, LEVELS[-1]), return_index=True)
+    keep = order[keep]
+    kept = {c: columns[c][keep] for c in columns}
+
+    levels = {}
+    for buckets in LEVELS:
+        _, indexes = np.unique(_bucket_index(kept['time'], first, last, buckets), return_index=True)
+        levels[buckets] = indexes
+    return Pyramid(count, first, last, kept, levels)
+
+
+def _pyramid_path(stream_key, data_bin):
+    return os.path.join(app.config['DECIMATION_CACHE_DIR'], stream_key.as_three_part_refdes(),
+                        stream_key.method, stream_key.stream_name, '{:d}.npz'.format(data_bin))
+
+
+def _load(path):
+    with np.load(path) as data:
+        columns = {}
+        levels = {}
+        for name in data.files:
+            if name.startswith(COLUMN_PREFIX):
+                columns[name[len(COLUMN_PREFIX):]] = data[name]
+            elif name.startswith(LEVEL_PREFIX):
+                levels[int(name[len(LEVEL_PREFIX):])] = data[name]
+        return Pyramid(int(data['count']), float(data['first']), float(data['last']), columns, levels)
+
+
+def get_pyramid(stream_key, data_bin, count, last, cols):
+    """
+    Return the pyramid for this bin if one exists which matches the supplied partition metadata
+    """
+    path = _pyramid_path(stream_key, data_bin)
+    with _lock:
+        pyramid = _pyramid_cache.get(path)
+    if pyramid is None:
+        if not os.path.exists(path):
+            return None
+        try:
+            pyramid = _load(path)
+        except (IOError, ValueError, KeyError) as e:
+            log.warn('Unable to read decimation pyramid %s: %s', path, e)
+            return None
+        with _lock:
+            _pyramid_cache[path] = pyramid
+    if pyramid.is_valid(count, last, cols):
+        return pyramid
+
+
+def _make_directory(directory):
+    if not os.path.exists(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+
+
+def store_pyramid(stream_key, data_bin, pyramid):
+    path = _pyramid_path(stream_key, data_bin)
+    directory = os.path.dirname(path)
+    _make_directory(directory)
+
+    arrays = {'count': pyramid.count, 'first': pyramid.first, 'last': pyramid.last}
+    for name, values in pyramid.columns.iteritems():
+        arrays[COLUMN_PREFIX + name] = values
+    for buckets, indexes in pyramid.levels.iteritems():
+        arrays[LEVEL_PREFIX + str(buckets)] = indexes
+
+    # write to a temporary file and rename so readers never see a partial pyramid
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            np.savez(fh, **arrays)
+        os.rename(temp_path, path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+    with _lock:
+        _pyramid_cache[path] = pyramid
+
+
+def is_settled(last):
+    """
+    Only bins which have not received data for DECIMATION_SETTLE_SECONDS are decimated
+    """
+    now = ntplib.system_to_ntp_time(time.time())
+    return now - last > app.config['DECIMATION_SETTLE_SECONDS']
+
+
+def _marker_age(path):
+    try:
+        return time.time() - os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+def _claim(path):
+    """
+    Create the build marker for a pyramid, a marker left by a worker which died mid-build
+    is replaced once it is older than DECIMATION_BUILD_TIMEOUT
+    :return: True if this process now owns the build
+    """
+    age = _marker_age(path)
+    if age is not None:
+        if age < app.config['DECIMATION_BUILD_TIMEOUT']:
+            return False
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    try:
+        os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            log.warn('Unable to create decimation build marker %s: %s', path, e)
+        return False
+    return True
+
+
+def start_build(stream_key, data_bin):
+    """
+    Mark a pyramid build as in progress
+    :return: False if a build for this bin is already running in any worker or recently failed
+    """
+    key = (stream_key, data_bin)
+    path = _pyramid_path(stream_key, data_bin)
+    with _lock:
+        if key in _pending:
+            return False
+        _pending.add(key)
+
+    claimed = False
+    try:
+        age = _marker_age(path + FAILED_SUFFIX)
+        if age is None or age >= app.config['DECIMATION_RETRY_SECONDS']:
+            _make_directory(os.path.dirname(path))
+            claimed = _claim(path + BUILDING_SUFFIX)
+    except OSError as e:
+        log.warn('Unable to claim decimation build %s: %s', path, e)
+    if not claimed:
+        with _lock:
+            _pending.discard(key)
+    return claimed
+
+
+def finish_build(stream_key, data_bin, failed=False):
+    """
+    Release the build marker, a failed build records a failure marker to delay the next attempt
+    """
+    path = _pyramid_path(stream_key, data_bin)
+    try:
+        if failed:
+            with open(path + FAILED_SUFFIX, 'w'):
+                pass
+        elif os.path.exists(path + FAILED_SUFFIX):
+            os.remove(path + FAILED_SUFFIX)
+        os.remove(path + BUILDING_SUFFIX)
+    except (IOError, OSError) as e:
+        log.warn('Unable to update decimation build markers %s: %s', path, e)
+    with _lock:
+        _pending.discard((stream_key, data_bin))
@@ -1,7 +1,13 @@
 import engine
 import logging
 from collections import namedtuple
-from operator import itemgetter
+from operator import attrgetter
+from threading import Lock
+
+import numpy as np
+from cachetools import TTLCache
+from concurrent.futures import ThreadPoolExecutor
+
 from util.common import log_timing
 from util.location_metadata import LocationMetadata
 from util.metadata_service import metadata_service_api
@@ -13,6 +19,95 @@ CASS_LOCATION_NAME = 'cass'
 _log = logging.getLogger(__name__)
 
 _RecordInfo = namedtuple('_RecordInfo', ['bin', 'store', 'count', 'first', 'last'])
+# Particles of one stream within a time range, bins is a list of (bin, store) and stores maps store to count
+ParticleCount = namedtuple('ParticleCount', ['count', 'bins', 'stores'])
+
+# Partition indexes by stream key, kept for PARTITION_METADATA_CACHE_SECONDS
+_partition_cache = TTLCache(engine.app.config['PARTITION_METADATA_CACHE_SIZE'],
+                            engine.app.config['PARTITION_METADATA_CACHE_SECONDS'])
+_partition_cache_lock = Lock()
+# Partition indexes used by the current request, see begin_request_scope
+_request_partitions = None
+_count_executor = ThreadPoolExecutor(max_workers=engine.app.config['PARTITION_METADATA_FETCH_WORKERS'])
+
+
+class PartitionIndex(object):
+    """
+    The partition metadata records of one stream held in sorted arrays. Records are ordered by first time
+    with a running maximum of the last times, so the records overlapping a time range are found by bisecting
+    on both ends. A second ordering by bin serves the bins preceding a time.
+    """
+    def __init__(self, records):
+        self.records = sorted((_RecordInfo(rec['bin'], rec['store'], rec['count'], rec['first'], rec['last'])
+                               for rec in records), key=attrgetter('first'))
+        self.firsts = np.array([rec.first for rec in self.records], dtype=np.float64)
+        self.max_lasts = np.maximum.accumulate(np.array([rec.last for rec in self.records], dtype=np.float64))
+        self.bin_order = sorted(xrange(len(self.records)), key=lambda i: self.records[i].bin)
+        self.bins = np.array([self.records[i].bin for i in self.bin_order], dtype=np.int64)
+
+    def overlapping(self, time_range):
+        """
+        :return: records where first < time_range.stop and last >= time_range.start
+        """
+        stop = np.searchsorted(self.firsts, time_range.stop, side='left')
+        # every record before start has a last time before the time range
+        start = np.searchsorted(self.max_lasts, time_range.start, side='left')
+        return [rec for rec in self.records[start:stop] if rec.last >= time_range.start]
+
+    def before(self, data_bin, limit):
+        """
+        :return: up to limit records with a bin <= data_bin, in descending bin order
+        """
+        stop = np.searchsorted(self.bins, data_bin, side='right')
+        return [self.records[i] for i in reversed(self.bin_order[max(stop - limit, 0):stop])]
+
+
+def begin_request_scope():
+    """
+    Keep the partition indexes used from now until end_request_scope, so a request sees one consistent
+    view of the partition metadata even if the process wide entries expire part way through
+    """
+    global _request_partitions
+    _request_partitions = {}
+
+
+def end_request_scope():
+    global _request_partitions
+    _request_partitions = None
+
+
+def invalidate_partition_metadata(stream_key):
+    """
+    Discard the cached partition records of a stream, called when new partitions are indexed
+    """
+    key = stream_key.as_tuple()
+    with _partition_cache_lock:
+        _partition_cache.pop(key, None)
+    if _request_partitions is not None:
+        _request_partitions.pop(key, None)
+
+
+def clear_partition_metadata_cache():
+    with _partition_cache_lock:
+        _partition_cache.clear()
+    if _request_partitions is not None:
+        _request_partitions.clear()
+
+
+def _get_partition_index(stream_key):
+    key = stream_key.as_tuple()
+    request_partitions = _request_partitions
+    if request_partitions is not None and key in request_partitions:
+        return request_partitions[key]
+    with _partition_cache_lock:
+        index = _partition_cache.get(key)
+    if index is None:
+        index = PartitionIndex(metadata_service_api.get_partition_metadata_records(*key))
+        with _partition_cache_lock:
+            _partition_cache[key] = index
+    if request_partitions is not None:
+        request_partitions[key] = index
+    return index
 
 
 def _get_first_possible_bin(t, stream):
@@ -46,15 +141,7 @@ def _query_partition_metadata_before(stream_key, time_start):
     ]
     """
     start_bin = _time_in_bin_units(time_start, stream_key.stream_name)
-    partition_metadata_record_list = metadata_service_api.get_partition_metadata_records(*stream_key.as_tuple())
-    partition_metadata_record_list.sort(key=itemgetter('bin'), reverse=True)
-    result = []
-    for rec in partition_metadata_record_list:
-        if rec['bin'] <= start_bin:
-            result.append(_RecordInfo(rec['bin'], rec['store'], rec['count'], rec['first'], rec['last']))
-        if len(result) == 4:
-            break
-    return result
+    return _get_partition_index(stream_key).before(start_bin, 4)
 
 
 @log_timing(_log)
@@ -74,12 +161,7 @@ def _query_partition_metadata(stream_key, time_range):
         ],
     ]
     """
-    partition_metadata_record_list = metadata_service_api.get_partition_metadata_records(*stream_key.as_tuple())
-    result = []
-    for rec in partition_metadata_record_list:
-        if rec['first'] < time_range.stop and rec['last'] >= time_range.start:
-            result.append(_RecordInfo(rec['bin'], rec['store'], rec['count'], rec['first'], rec['last']))
-    return result
+    return _get_partition_index(stream_key).overlapping(time_range)
 
 
 @log_timing(_log)
@@ -171,14 +253,11 @@ def get_location_metadata(stream_key, time_range):
     return LocationMetadata(cass_bins), LocationMetadata(san_bins), messages
 
 
-def get_particle_count(stream_key, time_range):
-    """
-    :param stream_key:
-    :param time_range:
-    :return:  number of particles in time_range for stream_key
-    """
+def _count_particles(stream_key, time_range):
     results = _query_partition_metadata(stream_key, time_range)
     particles = 0
+    bins = []
+    stores = {}
     for row in results:
         # query_partition_metadata returns bins which are out of our time range
         # only total those bins which actually match our request.
@@ -186,5 +265,33 @@ def get_particle_count(stream_key, time_range):
         # within a bin for the entire bin to be counted.
         if row.first < time_range.stop and row.last > time_range.start:
             particles += row.count
+            bins.append((row.bin, row.store))
+            stores[row.store] = stores.get(row.store, 0) + row.count
+
+    return ParticleCount(particles, bins, stores)
+
+
+def get_particle_count(stream_key, time_range):
+    """
+    :param stream_key:
+    :param time_range:
+    :return:  number of particles in time_range for stream_key
+    """
+    return _count_particles(stream_key, time_range).count
+
 
-    return particles
+@log_timing(_log)
+def get_particle_counts(stream_keys, time_range):
+    """
+    Count the particles of several streams over the same time range. The partition metadata of
+    streams which are not cached is fetched concurrently.
+    :param stream_keys:
+    :param time_range:
+    :return:  dictionary of stream_key to ParticleCount
+    """
+    stream_keys = list(set(stream_keys))
+    if len(stream_keys) < 2:
+        counts = [_count_particles(sk, time_range) for sk in stream_keys]
+    else:
+        counts = _count_executor.map(lambda sk: _count_particles(sk, time_range), stream_keys)
+    return dict(zip(stream_keys, counts))
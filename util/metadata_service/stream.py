@@ -1,31 +1,58 @@
 import engine
 import logging
 from collections import namedtuple
-from util.common import log_timing, TimeRange, timed_cache, MissingStreamMetadataException
+from util.common import log_timing, TimeRange, refreshing_cache, MissingStreamMetadataException
 from util.metadata_service import metadata_service_api
 
 _log = logging.getLogger(__name__)
 
-_RecordInfo = namedtuple('_RecordInfo', ['subsite', 'node', 'sensor', 'method', 'stream'])
+_RecordInfo = namedtuple('_RecordInfo', ['subsite', 'node', 'sensor', 'method', 'stream', 'first', 'last'])
+
+
+class StreamInventory(object):
+    """
+    Snapshot of the stream metadata records. Holds the stream dictionary, an index of
+    (method, subsite, node) to {stream: [sensors]} used to resolve external sources and
+    the available time range of each stream key.
+    """
+    def __init__(self, records):
+        self.streams = {}
+        self.designators = {}
+        self.time_ranges = {}
+        for subsite, node, sensor, method, stream, first, last in records:
+            self.streams.setdefault(stream, {}).setdefault(method, {}).setdefault(subsite, {})\
+                .setdefault(node, []).append(sensor)
+            self.designators.setdefault((method, subsite, node), {}).setdefault(stream, []).append(sensor)
+            self.time_ranges[(subsite, node, sensor, method, stream)] = TimeRange(first, last + 1)
+
+    def sensors(self, method, subsite, node, stream):
+        return self.designators.get((method, subsite, node), {}).get(stream, [])
 
 
 @log_timing(_log)
 def _get_stream_metadata():
     stream_metadata_record_list = metadata_service_api.get_stream_metadata_records()
-    return [_RecordInfo(method=rec['method'], stream=rec['stream'], **rec['referenceDesignator'])
+    return [_RecordInfo(method=rec['method'], stream=rec['stream'], first=rec['first'], last=rec['last'],
+                        **rec['referenceDesignator'])
             for rec in stream_metadata_record_list]
 
 
-@timed_cache(engine.app.config['METADATA_CACHE_SECONDS'])
+@refreshing_cache(engine.app.config['METADATA_CACHE_SECONDS'])
+def get_stream_inventory():
+    return StreamInventory(_get_stream_metadata())
+
+
 def build_stream_dictionary():
-    d = {}
-    for subsite, node, sensor, method, stream in _get_stream_metadata():
-        d.setdefault(stream, {}).setdefault(method, {}).setdefault(subsite, {}).setdefault(node, []).append(sensor)
-    return d
+    return get_stream_inventory().streams
 
 
 @log_timing(_log)
 def get_available_time_range(stream_key):
+    time_range = get_stream_inventory().time_ranges.get(stream_key.as_tuple())
+    if time_range is not None:
+        return time_range.copy()
+
+    # streams created since the inventory was last refreshed
     stream_metadata_record = metadata_service_api.get_stream_metadata_record(*stream_key.as_tuple())
     if stream_metadata_record is None:
         raise MissingStreamMetadataException('Query returned no results for primary stream')
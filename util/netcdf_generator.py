@@ -28,6 +28,15 @@ class NetcdfGenerator(object):
 
     @log_timing(log)
     def _create_raw_files(self):
+        file_paths = self.create_raw_files()
+        # build json return
+        return json.dumps({'code': 200, 'message': str(file_paths)}, indent=2)
+
+    def create_raw_files(self):
+        """
+        Write the netCDF and provenance files for this request to the local async directory
+        :return: list of the files written
+        """
         base_path = os.path.join(app.config['LOCAL_ASYNC_DIR'], self.disk_path)
         # ensure the directory structure is there
         if not os.path.isdir(base_path):
@@ -37,9 +46,7 @@ class NetcdfGenerator(object):
                 if not os.path.isdir(base_path):
                     raise WriteErrorException('Unable to create local output directory: %s' % self.disk_path)
 
-        file_paths = self._create_files(base_path)
-        # build json return
-        return json.dumps({'code': 200, 'message': str(file_paths)}, indent=2)
+        return self._create_files(base_path)
 
     @log_timing(log)
     def _create_zip(self):
@@ -5,8 +5,7 @@ import numpy as np
 
 from engine import app
 from util.xarray_overrides import xr
-from ooi_data.postgres.model import Stream, Parameter
-from util.common import MissingDataException, ntp_to_datestring, log_timing
+from util.common import MissingDataException, ntp_to_datestring, log_timing, get_stream_by_id, get_parameter
 
 
 GPS_STREAM_ID = app.config.get('GPS_STREAM_ID')
@@ -100,9 +99,9 @@ def rename_glider_lat_lon(stream_key, dataset):
     Rename INTERPOLATED glider GPS lat/lon values to lat/lon
     """
     if stream_key.is_glider:
-        gps_stream = Stream.query.get(GPS_STREAM_ID)
-        lat_param = Parameter.query.get(LATITUDE_PARAM_ID)
-        lon_param = Parameter.query.get(LONGITUDE_PARAM_ID)
+        gps_stream = get_stream_by_id(GPS_STREAM_ID)
+        lat_param = get_parameter(LATITUDE_PARAM_ID)
+        lon_param = get_parameter(LONGITUDE_PARAM_ID)
         lat_name = '-'.join((gps_stream.name, lat_param.name))
         lon_name = '-'.join((gps_stream.name, lon_param.name))
         if lat_name in dataset and lon_name in dataset:
@@ -21,6 +21,7 @@ class ProvenanceMetadataStore(object):
         self._prov_dict = {}
         self._instrument_provenance = {}
         self._query_metadata = OrderedDict()
+        self._query_statistics = []
 
     def add_messages(self, messages):
         self.messages.extend(messages)
@@ -54,6 +55,8 @@ class ProvenanceMetadataStore(object):
         self._query_metadata['include_annotations'] = stream_request.include_annotations
         self._query_metadata['strict_range'] = stream_request.strict_range
 
+    def add_query_statistics(self, statistics):
+        self._query_statistics = statistics
 
     def get_json(self):
         out = OrderedDict()
@@ -61,6 +64,8 @@ class ProvenanceMetadataStore(object):
         out['instrument_provenance'] = self.get_instrument_provenance()
         out['computed_provenance'] = self.calculated_metadata.get_dict()
         out['query_parameter_provenance'] = self._query_metadata
+        if self._query_statistics:
+            out['query_statistics'] = self._query_statistics
         out['provenance_messages'] = self.messages
         out['requestUUID'] = self.request_uuid
         return out
@@ -4,8 +4,10 @@ from collections import defaultdict
 
 import numpy as np
 
-from ooi_data.postgres.model import ParameterFunction
-from util.common import log_timing
+from engine import app
+from util.cass import QcResultsWriter, store_qc_results
+from util.common import log_timing, get_parameter_function
+from util.metadata_service import CASS_LOCATION_NAME
 
 log = logging.getLogger(__name__)
 
@@ -18,6 +20,7 @@ class QcExecutor(object):
         self.stream_request = stream_request
         self.request_id = stream_request.request_id
         self.qc_params = self._prep(qc_params)
+        self._results_writer = None
 
     def _prep(self, params):
         qc_dict = {}
@@ -47,7 +50,7 @@ class QcExecutor(object):
             qc_dict.setdefault(stream_p, {}).setdefault(qcid, {})[param] = val
         return qc_dict
 
-    def qc_check(self, parameter, dataset):
+    def qc_check(self, parameter, dataset, stream_key=None):
         qcs = self.qc_params.get(parameter.name)
         if qcs is None:
             return
@@ -85,7 +88,8 @@ class QcExecutor(object):
                 local_qc_args[function_name]['strict_validation'] = False
 
             try:
-                module = importlib.import_module(ParameterFunction.query.filter_by(function=function_name).first().owner)
+                qc_function = get_parameter_function(function_name)
+                module = importlib.import_module(qc_function.owner)
                 results = getattr(module, function_name)(**local_qc_args.get(function_name))
 
                 # Force all QC results to be 0/1 - log if non-binary results received, set all out-of-range to fail(0)
@@ -103,7 +107,6 @@ class QcExecutor(object):
                 if qc_results_name not in dataset:
                     dataset[qc_results_name] = ('obs', np.zeros_like(dataset.time.values, dtype=np.uint8), {})
 
-                qc_function = ParameterFunction.query.filter_by(function=function_name).first()
                 flag = int(qc_function.qc_flag, 2)
                 results *= flag
 
@@ -112,3 +115,36 @@ class QcExecutor(object):
 
             except (TypeError, ValueError) as e:
                 log.exception('<%s> Failed to execute QC %s %r', self.request_id, function_name, e)
+
+        if stream_key is not None:
+            self._store_results(parameter, dataset, stream_key)
+
+    def _store_results(self, parameter, dataset, stream_key):
+        storage = app.config['QC_RESULTS_STORAGE_SYSTEM']
+        qc_results_name = '%s_qc_results' % parameter.name
+        if storage not in (CASS_LOCATION_NAME, 'log') or qc_results_name not in dataset:
+            return
+
+        missing = [name for name in ('id', 'bin', 'deployment') if name not in dataset]
+        if missing:
+            log.warn('<%s> Unable to store QC results for %s, dataset has no %r',
+                     self.request_id, parameter.name, missing)
+            return
+
+        if storage == CASS_LOCATION_NAME and self._results_writer is None:
+            self._results_writer = QcResultsWriter(self.request_id)
+
+        pk = {'subsite': stream_key.subsite, 'node': stream_key.node,
+              'sensor': stream_key.sensor, 'stream': stream_key.stream_name}
+        store_qc_results(dataset[qc_results_name].values.tolist(), pk, dataset.id.values.astype('str'),
+                         dataset.bin.values.tolist(), dataset.deployment.values.tolist(), parameter.name,
+                         request_id=self.request_id, writer=self._results_writer)
+
+    def finish(self):
+        """
+        Wait for any QC results still being stored
+        :return: summary of the stored QC results or None if nothing was written to cassandra
+        """
+        writer, self._results_writer = self._results_writer, None
+        if writer is not None:
+            return writer.finish()
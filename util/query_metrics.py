@@ -0,0 +1,233 @@
+"""
+Process wide statistics for the Cassandra queries issued through SessionManager.
+
+Queries are grouped by statement shape (the CQL text, bound values are always markers) and the table
+queried, which for stream data is the stream name. Each shape records executions, errors and timeouts
+along with histograms of latency, rows returned, pages and estimated bytes. Bytes are not measured, they are
+estimated from the rows returned and the stream size estimates. Histogram buckets are fixed
+so snapshots taken on different workers can be summed. The time to the first page of recent successful
+executions is kept to derive hedged read delays.
+"""
+import bisect
+import logging
+import re
+import time
+from collections import deque
+from threading import Lock
+
+import numpy as np
+from cassandra import OperationTimedOut, Timeout, Unavailable
+from cassandra.protocol import OverloadedErrorMessage
+
+log = logging.getLogger(__name__)
+
+# upper bound of each bucket, a final bucket holds everything larger
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+PAGE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 1000)
+BYTE_BUCKETS = (1e3, 1e4, 1e5, 1e6, 1e7, 1e8, 1e9)
+# totals which are compared between snapshots for per request statistics
+TOTALS = ('executions', 'errors', 'timeouts', 'rows', 'pages', 'estimated_bytes', 'seconds', 'hedges', 'hedges_won')
+SLOW_TRACE_HISTORY = 50
+RECENT_LATENCIES = 500
+
+TABLE_PATTERN = re.compile(r'\b(?:from|into|update)\s+(?:\w+\.)?(\w+)', re.IGNORECASE)
+
+_lock = Lock()
+_statements = {}
+slow_traces = deque(maxlen=SLOW_TRACE_HISTORY)
+
+
+class Histogram(object):
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+
+    def to_dict(self):
+        bounds = [str(b) for b in self.bounds] + ['+Inf']
+        return dict(zip(bounds, self.counts))
+
+
+class StatementStats(object):
+    def __init__(self, shape, table):
+        self.shape = shape
+        self.table = table
+        self.totals = dict.fromkeys(TOTALS, 0)
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.rows = Histogram(ROW_BUCKETS)
+        self.pages = Histogram(PAGE_BUCKETS)
+        self.estimated_bytes = Histogram(BYTE_BUCKETS)
+        self.recent = deque(maxlen=RECENT_LATENCIES)
+
+    def record(self, seconds, rows, pages, estimated_bytes, error, first_page):
+        totals = self.totals
+        totals['executions'] += 1
+        totals['seconds'] += seconds
+        self.latency.add(seconds)
+        if error is not None:
+            totals['errors'] += 1
+            if is_timeout(error):
+                totals['timeouts'] += 1
+            return
+        totals['rows'] += rows
+        totals['pages'] += pages
+        totals['estimated_bytes'] += estimated_bytes
+        self.recent.append(seconds if first_page is None else first_page)
+        self.rows.add(rows)
+        self.pages.add(pages)
+        self.estimated_bytes.add(estimated_bytes)
+
+    def to_dict(self):
+        out = {'statement': self.shape, 'table': self.table}
+        out.update(self.totals)
+        out['histograms'] = {
+            'latency': self.latency.to_dict(),
+            'rows': self.rows.to_dict(),
+            'pages': self.pages.to_dict(),
+            'estimated_bytes': self.estimated_bytes.to_dict(),
+        }
+        return out
+
+
+class Observation(object):
+    """
+    Timing of a single query execution, pages are added as they arrive and the result is
+    recorded when the query finishes or fails
+    :param row_bytes: estimated bytes per row, the recorded bytes are an estimate of rows * row_bytes
+    """
+    def __init__(self, shape, table, row_bytes=0):
+        self.shape = shape
+        self.table = table
+        self.row_bytes = row_bytes
+        self.start = time.time()
+        self.rows = 0
+        self.pages = 0
+        self.first_page = None
+        self.elapsed = None
+
+    def add_page(self, num_rows):
+        if self.first_page is None:
+            self.first_page = time.time() - self.start
+        self.rows += num_rows
+        self.pages += 1
+
+    def finish(self, error=None):
+        if self.elapsed is None:
+            self.elapsed = time.time() - self.start
+            record(self.shape, self.table, self.elapsed, self.rows, self.pages,
+                   int(self.rows * self.row_bytes), error, self.first_page)
+        return self.elapsed
+
+
+def is_timeout(error):
+    return isinstance(error, (Timeout, OperationTimedOut))
+
+
+def is_overload(error):
+    """
+    Timeouts and errors indicating the cluster cannot keep up with the current request rate
+    """
+    return is_timeout(error) or isinstance(error, (Unavailable, OverloadedErrorMessage))
+
+
+def statement_shape(statement):
+    """
+    :return: (shape, table) for a CQL string, simple, prepared or bound statement
+    """
+    if isinstance(statement, basestring):
+        query = statement
+    elif hasattr(statement, 'prepared_statement'):
+        query = statement.prepared_statement.query_string
+    else:
+        query = getattr(statement, 'query_string', None) or type(statement).__name__
+    query = ' '.join(query.split())
+    match = TABLE_PATTERN.search(query)
+    return query, match.group(1) if match else ''
+
+
+def _get_stats(shape, table):
+    stats = _statements.get((table, shape))
+    if stats is None:
+        stats = _statements[(table, shape)] = StatementStats(shape, table)
+    return stats
+
+
+def record(shape, table, seconds, rows, pages, estimated_bytes, error=None, first_page=None):
+    with _lock:
+        _get_stats(shape, table).record(seconds, rows, pages, estimated_bytes, error, first_page)
+
+
+def increment(shape, table, name):
+    with _lock:
+        _get_stats(shape, table).totals[name] += 1
+
+
+def latency_percentile(shape, table, percentile, min_samples):
+    """
+    :return: percentile of the time to first page of recent successful executions,
+             None until min_samples executions have been recorded
+    """
+    with _lock:
+        stats = _statements.get((table, shape))
+        if stats is None or len(stats.recent) < min_samples:
+            return None
+        recent = list(stats.recent)
+    return float(np.percentile(recent, percentile))
+
+
+def snapshot():
+    """
+    :return: list of dictionaries, one per statement shape
+    """
+    with _lock:
+        return [stats.to_dict() for stats in _statements.itervalues()]
+
+
+def totals():
+    """
+    :return: dictionary of (table, shape) to a copy of the running totals, see difference
+    """
+    with _lock:
+        return {key: dict(stats.totals) for key, stats in _statements.iteritems()}
+
+
+def difference(before, after=None):
+    """
+    Totals accumulated since the supplied totals() result, for statement shapes which were executed
+    :return: list of dictionaries, one per statement shape
+    """
+    if after is None:
+        after = totals()
+    out = []
+    for (table, shape), current in after.iteritems():
+        previous = before.get((table, shape), {})
+        delta = {name: current[name] - previous.get(name, 0) for name in TOTALS}
+        if delta['executions']:
+            delta['statement'] = shape
+            delta['table'] = table
+            out.append(delta)
+    return out
+
+
+def add_slow_trace(shape, table, elapsed, trace):
+    events = [(str(event.source), event.source_elapsed.total_seconds() if event.source_elapsed else None,
+               event.description) for event in trace.events]
+    entry = {'statement': shape, 'table': table, 'seconds': elapsed, 'coordinator': str(trace.coordinator),
+             'duration': trace.duration.total_seconds() if trace.duration else None, 'events': events}
+    log.warn('Slow query (%.3f s) against %s: %s', elapsed, table, shape)
+    with _lock:
+        slow_traces.append(entry)
+
+
+def get_slow_traces():
+    with _lock:
+        return list(slow_traces)
+
+
+def reset():
+    with _lock:
+        _statements.clear()
+        slow_traces.clear()
@@ -1,21 +1,32 @@
+import bisect
+import fcntl
+import json
 import os
 import logging
+import tempfile
+from threading import Lock
 
 import numpy
 import xarray as xr
+from cachetools import LRUCache
 from multiprocessing.pool import ThreadPool
 
 from engine import app
-from util.cass import insert_dataset, fetch_bin
+from util.cass import insert_dataset, fetch_bin, REQUIRED_QUERY_COLUMNS
 from util.common import StreamKey, log_timing
 from util.datamodel import to_xray_dataset, compile_datasets
 from util.metadata_service import SAN_LOCATION_NAME, get_location_metadata_by_store
 
 log = logging.getLogger(__name__)
 san_threadpool = ThreadPool(10)
+# Parsed manifests by path, along with the stat of the file they were read from
+manifest_cache = LRUCache(app.config['SAN_MANIFEST_CACHE_SIZE'])
+manifest_cache_lock = Lock()
 
 DEPLOYMENT_FORMAT = 'deployment_{:04d}'
 NETCDF_ENDING_NAME = '_{:04d}.nc'
+MANIFEST_NAME = 'manifest.json'
+MANIFEST_LOCK_NAME = '.manifest.lock'
 
 
 def onload_netCDF(file_name):
@@ -97,6 +108,7 @@ def offload_bin(stream, data_bin, san_dir_string, request_id):
                  deployment, nc_file_name, len(deployment_ds['index']))
         # create netCDF file
         deployment_ds.to_netcdf(path=nc_file_name)
+    update_manifest(stream, data_bin)
     return True, ''
 
 
@@ -138,6 +150,169 @@ def get_nc_filename(stream, nc_directory, deployment):
     return base.format(index)
 
 
+def describe_file(path, ref_des_dir, deployment):
+    """
+    Build the manifest entry for an offloaded netCDF file
+    :return: dictionary of the file path relative to the reference designator directory, deployment,
+             row count, first and last time and (when the times are ordered) every Nth time
+    """
+    with xr.open_dataset(path, decode_times=False, mask_and_scale=False) as dataset:
+        times = dataset.time.values
+    entry = {
+        'path': os.path.relpath(path, ref_des_dir),
+        'deployment': deployment,
+        'count': int(times.size),
+        'first': float(times.min()) if times.size else None,
+        'last': float(times.max()) if times.size else None,
+    }
+    if times.size and numpy.all(numpy.diff(times) >= 0):
+        stride = app.config['SAN_MANIFEST_INDEX_ROWS']
+        entry['index_rows'] = stride
+        entry['index'] = times[::stride].tolist()
+    return entry
+
+
+def update_manifest(stream_key, data_bin):
+    """
+    Record every netCDF file for this bin in the reference designator manifest. Files already
+    listed are kept, files not yet listed (including those offloaded before the manifest existed)
+    are opened once to read their time bounds.
+    """
+    ref_des_dir, dir_string = get_SAN_directories(stream_key, split=True)
+    nc_directory = dir_string.format(data_bin)
+    manifest_path = os.path.join(ref_des_dir, MANIFEST_NAME)
+    # serialize updates from other workers offloading the same reference designator
+    with open(os.path.join(ref_des_dir, MANIFEST_LOCK_NAME), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        manifest = _read_manifest(manifest_path) or {'bins': {}}
+        method_bins = manifest['bins'].setdefault(stream_key.method, {})
+        entries = method_bins.get(str(data_bin), [])
+        known = {entry['path'] for entry in entries}
+        for deployment_dir in sorted(os.listdir(nc_directory)):
+            full_path = os.path.join(nc_directory, deployment_dir)
+            if not os.path.isdir(full_path) or not deployment_dir.startswith('deployment_'):
+                continue
+            deployment = int(deployment_dir.split('_')[-1])
+            for f in sorted(os.listdir(full_path)):
+                path = os.path.join(full_path, f)
+                if stream_key.stream_name in f and os.path.splitext(f)[-1] == '.nc' \
+                        and os.path.relpath(path, ref_des_dir) not in known:
+                    entries.append(describe_file(path, ref_des_dir, deployment))
+        method_bins[str(data_bin)] = entries
+
+        fd, temp_path = tempfile.mkstemp(dir=ref_des_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                json.dump(manifest, fh)
+            os.rename(temp_path, manifest_path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+
+
+def _read_manifest(manifest_path):
+    try:
+        with open(manifest_path) as fh:
+            return json.load(fh)
+    except (IOError, ValueError):
+        return None
+
+
+def get_manifest(ref_des_dir):
+    """
+    :return: the manifest for this reference designator directory or None if none has been written
+    """
+    manifest_path = os.path.join(ref_des_dir, MANIFEST_NAME)
+    try:
+        stat = os.stat(manifest_path)
+    except OSError:
+        return None
+    version = (stat.st_ino, stat.st_mtime, stat.st_size)
+    with manifest_cache_lock:
+        cached = manifest_cache.get(manifest_path)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    manifest = _read_manifest(manifest_path)
+    if manifest is not None:
+        with manifest_cache_lock:
+            manifest_cache[manifest_path] = (version, manifest)
+    return manifest
+
+
+def get_deployment_directories(stream_key, data_bin):
+    """
+    Find the deployments offloaded for a bin, from the manifest when it lists the bin, otherwise
+    by listing the bin directory
+    :return: list of (deployment directory name, deployment directory, manifest entries or None)
+    """
+    ref_des_dir, dir_string = get_SAN_directories(stream_key, split=True)
+    manifest = get_manifest(ref_des_dir)
+    entries = None
+    if manifest is not None:
+        entries = manifest['bins'].get(stream_key.method, {}).get(str(data_bin))
+    if entries is not None:
+        deployments = {}
+        for entry in entries:
+            entry = dict(entry, path=os.path.join(ref_des_dir, entry['path']))
+            deployments.setdefault(DEPLOYMENT_FORMAT.format(entry['deployment']), []).append(entry)
+        return [(name, os.path.join(dir_string.format(data_bin), name), files)
+                for name, files in sorted(deployments.iteritems())]
+
+    direct = dir_string.format(data_bin)
+    if not os.path.exists(direct):
+        return []
+    return [(name, os.path.join(direct, name), None) for name in sorted(os.listdir(direct))
+            if os.path.isdir(os.path.join(direct, name))]
+
+
+def _overlaps(entry, time_range):
+    if 'count' not in entry:
+        # not from a manifest, the file must be opened to find out
+        return True
+    if not entry['count']:
+        return False
+    return entry['first'] <= time_range.stop and entry['last'] >= time_range.start
+
+
+def _row_bounds(entry, time_range):
+    """
+    Use the coarse time index of a manifest entry to bound the rows which may fall in the time range
+    :return: (start, stop) row slice, stop is None when the file must be read to the end
+    """
+    index = entry.get('index')
+    if not index:
+        return 0, None
+    stride = entry['index_rows']
+    start = max(bisect.bisect_left(index, time_range.start) - 1, 0) * stride
+    stop = bisect.bisect_right(index, time_range.stop) * stride
+    return start, min(stop, entry['count'])
+
+
+def _needed_variables(columns):
+    """
+    :return: names of the variables to read for the columns needed by a request, None for all variables
+    """
+    if columns is None:
+        return None
+    return frozenset(REQUIRED_QUERY_COLUMNS.union(columns))
+
+
+def _read_rows(variable, selection):
+    """
+    Read the rows of a variable selected by a sorted array of row numbers. A contiguous selection
+    is read as a single slice. Otherwise the selection is grouped by storage chunk (or blocks of
+    SAN_READ_BLOCK_ROWS for contiguous storage) and each group is read as one slice.
+    :return: numpy array
+    """
+    if numpy.all(numpy.diff(selection) == 1):
+        return variable[selection[0]:selection[-1] + 1].values
+    chunks = variable.encoding.get('chunksizes')
+    block = chunks[0] if chunks else app.config['SAN_READ_BLOCK_ROWS']
+    splits = numpy.flatnonzero(numpy.diff(selection // block)) + 1
+    return numpy.concatenate([variable[rows[0]:rows[-1] + 1].values[rows - rows[0]]
+                              for rows in numpy.split(selection, splits)])
+
+
 def get_SAN_samples(num_points, location_metadata):
     data_ratio = float(location_metadata.total) / float(num_points)
     if data_ratio < app.config['UI_FULL_RETURN_RATIO']:
@@ -162,18 +337,19 @@ def get_SAN_samples(num_points, location_metadata):
 
 
 @log_timing(log)
-def fetch_nsan_data(stream_key, time_range, num_points=1000, location_metadata=None):
+def fetch_nsan_data(stream_key, time_range, num_points=1000, location_metadata=None, columns=None):
     """
     Given a time range and stream key.  Genereate evenly spaced times over the inverval using data
     from the SAN.
     :param stream_key:
     :param time_range:
     :param num_points:
+    :param columns: optional set of columns needed by the request
     :return:
     """
     if location_metadata is None:
         location_metadata = get_location_metadata_by_store(stream_key, time_range, SAN_LOCATION_NAME)
-    ref_des_dir, dir_string = get_SAN_directories(stream_key, split=True)
+    ref_des_dir = get_SAN_directories(stream_key, split=True)[0]
     if not os.path.exists(ref_des_dir):
         log.warning("Reference Designator does not exist in offloaded SAN")
         return None
@@ -185,18 +361,15 @@ def fetch_nsan_data(stream_key, time_range, num_points=1000, location_metadata=N
     next_index = 0
     futures = []
     for time_bin, num_data_points in to_sample:
-        direct = dir_string.format(time_bin)
-        if os.path.exists(direct):
+        deployments = get_deployment_directories(stream_key, time_bin)
+        if deployments:
             # get data from all of the  deployments
-            deployments = os.listdir(direct)
-
-            for deployment in deployments:
-                full_path = os.path.join(direct, deployment)
-                if os.path.isdir(full_path):
-                    futures.append(
-                            san_threadpool.apply_async(get_deployment_data,
-                                                       (full_path, stream_key.stream_name, num_data_points, time_range),
-                                                       kwds={'index_start': next_index}))
+            for _, full_path, files in deployments:
+                futures.append(
+                        san_threadpool.apply_async(get_deployment_data,
+                                                   (full_path, stream_key.stream_name, num_data_points, time_range),
+                                                   kwds={'index_start': next_index, 'files': files,
+                                                         'columns': columns}))
         else:
             missed += num_data_points
 
@@ -215,44 +388,41 @@ def fetch_nsan_data(stream_key, time_range, num_points=1000, location_metadata=N
     return compile_datasets(data)
 
 
-def fetch_full_san_data(stream_key, time_range, location_metadata=None):
+def fetch_full_san_data(stream_key, time_range, location_metadata=None, columns=None):
     """
     Given a time range and stream key.  Genereate all data in the inverval using data
     from the SAN.
     :param stream_key:
     :param time_range:
+    :param columns: optional set of columns needed by the request
     :return:
     """
     if location_metadata is None:
         location_metadata = get_location_metadata_by_store(stream_key, time_range, SAN_LOCATION_NAME)
     # get which bins we can gather data from
-    ref_des_dir, dir_string = get_SAN_directories(stream_key, split=True)
+    ref_des_dir = get_SAN_directories(stream_key, split=True)[0]
     if not os.path.exists(ref_des_dir):
         log.warning("Reference Designator does not exist in offloaded DataSAN")
         return None
     data = []
     next_index = 0
     for time_bin in location_metadata.bin_list:
-        direct = dir_string.format(time_bin)
-        if os.path.exists(direct):
-            # get data from all of the  deployments
-            deployments = os.listdir(direct)
-            for deployment in deployments:
-                full_path = os.path.join(direct, deployment)
-                if os.path.isdir(full_path):
-                    new_data = get_deployment_data(full_path, stream_key.stream_name, -1, time_range,
-                                                   index_start=next_index)
-                    if new_data is not None:
-                        data.append(new_data)
-                        # Keep track of indexes so they are unique in the final dataset
-                        next_index += len(new_data['index'])
+        # get data from all of the  deployments
+        for _, full_path, files in get_deployment_directories(stream_key, time_bin):
+            new_data = get_deployment_data(full_path, stream_key.stream_name, -1, time_range,
+                                           index_start=next_index, files=files, columns=columns)
+            if new_data is not None:
+                data.append(new_data)
+                # Keep track of indexes so they are unique in the final dataset
+                next_index += len(new_data['index'])
     if not data:
         return None
     return xr.concat(data, dim='index')
 
 
 @log_timing(log)
-def get_deployment_data(direct, stream_name, num_data_points, time_range, index_start=0, forward_slice=True):
+def get_deployment_data(direct, stream_name, num_data_points, time_range, index_start=0, forward_slice=True,
+                        files=None, columns=None):
     """
     Given a directory of NETCDF files for a deployment
     try to return num_data_points that are valid in the given time range.
@@ -262,44 +432,49 @@ def get_deployment_data(direct, stream_name, num_data_points, time_range, index_
     :param num_data_points: Number of data points to get out of the netcdf file -1 means return all valid in time range
     :param time_range: Time range of the query
     :param forward_slice: Take from the first data point onwards or take from the last data point backwards
+    :param files: manifest entries for the files of this deployment, the directory is listed if not supplied
+    :param columns: optional set of columns needed by the request, other variables are not read
     :return: dictionary of data stored in numpy arrays.
     """
-    files = os.listdir(direct)
+    needed = _needed_variables(columns)
+    if files is None:
+        files = [{'path': os.path.join(direct, f)} for f in sorted(os.listdir(direct))
+                 # only netcdf files
+                 if stream_name in f and os.path.splitext(f)[-1] == '.nc']
     # Loop until we get the data we want
-    for f in files:
-        # only netcdf files
-        if stream_name in f and os.path.splitext(f)[-1] == '.nc':
-            f = os.path.join(direct, f)
-            with xr.open_dataset(f, decode_times=False) as dataset:
-                out_ds = xr.Dataset(attrs=dataset.attrs)
-                t = dataset.time
-                t.load()
-                # get the indexes to pull out of the data
-                indexes = numpy.where(numpy.logical_and(time_range.start <= t, t <= time_range.stop))[0]
-                if indexes:
-                    # less indexes than data or request for all data ->  get everything
-                    if num_data_points < 0:
-                        selection = indexes
-                    elif num_data_points > len(indexes):
-                        selection = indexes
+    for entry in files:
+        if not _overlaps(entry, time_range):
+            continue
+        row_start, row_stop = _row_bounds(entry, time_range)
+        with xr.open_dataset(entry['path'], decode_times=False) as dataset:
+            out_ds = xr.Dataset(attrs=dataset.attrs)
+            t = dataset.time[row_start:row_stop].values
+            # get the indexes to pull out of the data
+            indexes = numpy.where(numpy.logical_and(time_range.start <= t, t <= time_range.stop))[0] + row_start
+            if indexes.size:
+                # less indexes than data or request for all data ->  get everything
+                if num_data_points < 0:
+                    selection = indexes
+                elif num_data_points > len(indexes):
+                    selection = indexes
+                else:
+                    # do a linear sampling of the data points
+                    if forward_slice:
+                        selection = numpy.floor(numpy.linspace(0, len(indexes) - 1, num_data_points)).astype(int)
                     else:
-                        # do a linear sampling of the data points
-                        if forward_slice:
-                            selection = numpy.floor(numpy.linspace(0, len(indexes) - 1, num_data_points)).astype(int)
-                        else:
-                            selection = numpy.floor(numpy.linspace(len(indexes) - 1, 0, num_data_points)).astype(int)
-                        selection = indexes[selection]
-                        selection = sorted(selection)
-                    idx = [x for x in range(index_start, index_start + len(selection))]
-                    for var_name in dataset.variables.keys():
-                        if var_name in dataset.coords:
-                            continue
-                        var = dataset[var_name][selection]
-                        out_ds.update({var_name: var})
-                    # set the index here
-                    out_ds['index'] = idx
-                    out_ds.load()
-                    return out_ds
+                        selection = numpy.floor(numpy.linspace(len(indexes) - 1, 0, num_data_points)).astype(int)
+                    selection = indexes[selection]
+                    selection = numpy.sort(selection)
+                idx = [x for x in range(index_start, index_start + len(selection))]
+                for var_name in dataset.variables.keys():
+                    if var_name in dataset.coords or (needed is not None and var_name not in needed):
+                        continue
+                    var = dataset[var_name]
+                    out_ds.update({var_name: xr.DataArray(_read_rows(var, selection), dims=var.dims,
+                                                          attrs=var.attrs)})
+                # set the index here
+                out_ds['index'] = idx
+                return out_ds
     return None
 
 
@@ -314,30 +489,32 @@ def get_sample_numbers(bins, points):
     return vals
 
 
-def get_san_lookback_dataset(stream_key, time_range, data_bin, deployments):
+def get_san_lookback_dataset(stream_key, time_range, data_bin, deployments, columns=None):
     """
     Get a length 1 dataset with the first value in the given data bin in the given time range from the SAN.
     :param stream_key:
     :param time_range:
     :param data_bin:
+    :param columns: optional set of columns needed by the request
     :return:
     """
+    if not deployments:
+        return None
     datasets = []
-    ref_des_dir, dir_string = get_SAN_directories(stream_key, split=True)
+    ref_des_dir = get_SAN_directories(stream_key, split=True)[0]
     if not os.path.exists(ref_des_dir):
         log.warning("Reference Designator does not exist in offloaded SAN")
         return None
-    direct = dir_string.format(data_bin)
-    deployment_dirs = os.listdir(direct)
+    deployment_dirs = {name: (path, files) for name, path, files in get_deployment_directories(stream_key, data_bin)}
     for deployment in deployments:
         # get the last deployment.  We are assuming that if there is more than one deployment
         # the last is the one wanted since we are padding forward.
         # get the correct deployment or return none
         dep_direct = DEPLOYMENT_FORMAT.format(deployment)
         if dep_direct in deployment_dirs:
-            dep_direct = os.path.join(direct, dep_direct)
+            dep_direct, files = deployment_dirs[dep_direct]
             datasets.append(get_deployment_data(dep_direct, stream_key.stream.name, 1, time_range, forward_slice=False,
-                                                index_start=0))
+                                                index_start=0, files=files, columns=columns))
         else:
             log.warn("Could not find deployment for lookback dataset.")
             datasets.append(None)
@@ -12,7 +12,7 @@ from util.advlogging import ParameterReport
 from util.annotation import AnnotationStore
 from util.cass import fetch_nth_data, get_full_cass_dataset, get_cass_lookback_dataset
 from util.common import (log_timing, ntp_to_datestring, ntp_to_datetime, UnknownFunctionTypeException,
-                         StreamEngineException, TimeRange, MissingDataException)
+                         StreamEngineException, TimeRange, MissingDataException, get_parameter)
 from util.datamodel import create_empty_dataset, compile_datasets, add_location_data, _get_fill_value
 from util.metadata_service import (SAN_LOCATION_NAME, CASS_LOCATION_NAME, get_first_before_metadata,
                                    get_location_metadata)
@@ -29,8 +29,10 @@ INSTRUMENT_ATTRIBUTE_MAP = app.config.get('INSTRUMENT_ATTRIBUTE_MAP')
 
 
 class StreamDataset(object):
-    def __init__(self, stream_key, uflags, external_streams, request_id):
+    def __init__(self, stream_key, uflags, external_streams, request_id, query_columns=None):
         self.stream_key = stream_key
+        # names of the parameters needed by the request, None to fetch and derive every parameter
+        self.query_columns = query_columns
         self.provenance_metadata = ProvenanceMetadataStore(request_id)
         self.annotation_store = AnnotationStore()
         self.uflags = uflags
@@ -41,10 +43,10 @@ class StreamDataset(object):
 
         self.params = {}
         self.missing = {}
-        self.external = [p for p in stream_key.stream.derived if stream_key.stream.needs_external([p])]
+        self.external = [p for p in self._needed_derived() if stream_key.stream.needs_external([p])]
 
         if self.stream_key.is_virtual:
-            self.time_param = Parameter.query.get(self.stream_key.stream.time_parameter)
+            self.time_param = get_parameter(self.stream_key.stream.time_parameter)
         else:
             self.time_param = None
 
@@ -53,6 +55,27 @@ class StreamDataset(object):
                                    should_pad, [], self.request_id)
         self._insert_dataset(dataset)
 
+    def trim_to_window(self, window):
+        """
+        Drop the particles outside the half-open TimeRange window, once derived products and QC
+        have been computed over the surrounding data
+        """
+        for deployment in list(self.datasets):
+            dataset = self.datasets[deployment]
+            times = dataset.time.values
+            keep = np.flatnonzero((times >= window.start) & (times < window.stop))
+            if keep.size == times.size:
+                continue
+            if keep.size:
+                dataset = dataset.isel(obs=keep)
+                dataset['obs'] = np.arange(dataset.obs.size)
+                self.datasets[deployment] = dataset
+            else:
+                del self.datasets[deployment]
+                self.params.pop(deployment, None)
+        if not self.datasets:
+            raise MissingDataException("No particles within %s for stream %s" % (window, self.stream_key))
+
     def _insert_dataset(self, dataset):
         """
         Insert the supplied dataset into this StreamDataset
@@ -68,11 +91,16 @@ class StreamDataset(object):
 
             for deployment, group in dataset.groupby('deployment'):
                 self.datasets[deployment] = self._prune_duplicate_times(group)
-                self.params[deployment] = [p for p in self.stream_key.stream.derived]
+                self.params[deployment] = self._needed_derived()
 
         else:
             raise MissingDataException("Query returned no results for stream %s" % self.stream_key)
 
+    def _needed_derived(self):
+        if self.query_columns is None:
+            return list(self.stream_key.stream.derived)
+        return [p for p in self.stream_key.stream.derived if p.name in self.query_columns]
+
     @staticmethod
     def _prune_duplicate_times(dataset):
         mask = np.diff(np.insert(dataset.time.values, 0, 0.0)) != 0
@@ -648,9 +676,10 @@ class StreamDataset(object):
             san_times = TimeRange(t1, t2)
             if limit:
                 datasets.append(fetch_nsan_data(self.stream_key, san_times, num_points=int(limit * san_percent),
-                                                location_metadata=san_locations))
+                                                location_metadata=san_locations, columns=self.query_columns))
             else:
-                datasets.append(fetch_full_san_data(self.stream_key, san_times, location_metadata=san_locations))
+                datasets.append(fetch_full_san_data(self.stream_key, san_times, location_metadata=san_locations,
+                                                    columns=self.query_columns))
         if cass_locations.total > 0:
             t1 = max(time_range.start, cass_locations.start_time)
             t2 = min(time_range.stop, cass_locations.end_time)
@@ -662,10 +691,12 @@ class StreamDataset(object):
             cass_times = TimeRange(t1, t2)
             if limit:
                 datasets.append(fetch_nth_data(self.stream_key, cass_times, num_points=int(limit * cass_percent),
-                                               location_metadata=cass_locations, request_id=request_id))
+                                               location_metadata=cass_locations, request_id=request_id,
+                                               columns=self.query_columns))
             else:
                 datasets.append(get_full_cass_dataset(self.stream_key, cass_times,
-                                                      location_metadata=cass_locations, request_id=request_id))
+                                                      location_metadata=cass_locations, request_id=request_id,
+                                                      columns=self.query_columns))
         return compile_datasets(datasets)
 
     @log_timing(log)
@@ -673,10 +704,11 @@ class StreamDataset(object):
         first_metadata = get_first_before_metadata(key, time_range.start)
         if CASS_LOCATION_NAME in first_metadata:
             locations = first_metadata[CASS_LOCATION_NAME]
-            return get_cass_lookback_dataset(key, time_range.start, locations.bin_list[0], deployments, request_id)
+            return get_cass_lookback_dataset(key, time_range.start, locations.bin_list[0], deployments, request_id,
+                                             columns=self.query_columns)
         elif SAN_LOCATION_NAME in first_metadata:
             locations = first_metadata[SAN_LOCATION_NAME]
             return get_san_lookback_dataset(key, TimeRange(locations.start_time, time_range.start),
-                                            locations.bin_list[0], deployments)
+                                            locations.bin_list[0], deployments, columns=self.query_columns)
         else:
             return None
@@ -4,12 +4,13 @@ import math
 import util.annotation
 import util.metadata_service
 import util.provenance_metadata_store
+import util.query_metrics
 from engine import app
-from ooi_data.postgres.model import Parameter, Stream, NominalDepth
 from util.asset_management import AssetManagement
-from util.cass import fetch_l0_provenance
-from util.common import log_timing, StreamEngineException, StreamKey, MissingDataException, read_size_config
-from util.metadata_service import build_stream_dictionary, get_available_time_range
+from util.cass import fetch_l0_provenance_many
+from util.common import (log_timing, StreamEngineException, StreamKey, MissingDataException, read_size_config,
+                         get_stream_by_id, get_parameter, get_parameters_by_dpi, get_nominal_depth)
+from util.metadata_service import get_stream_inventory, get_available_time_range
 from util.qc_executor import QcExecutor
 from util.stream_dataset import StreamDataset
 
@@ -37,7 +38,7 @@ class StreamRequest(object):
 
     def __init__(self, stream_key, parameters, time_range, uflags, qc_parameters=None,
                  limit=None, include_provenance=False, include_annotations=False, strict_range=False,
-                 request_id='', collapse_times=False, execute_dpa=True):
+                 request_id='', collapse_times=False, execute_dpa=True, window=None):
 
         if not isinstance(stream_key, StreamKey):
             raise StreamEngineException('Received no stream key', status_code=400)
@@ -54,13 +55,18 @@ class StreamRequest(object):
         self.include_annotations = include_annotations
         self.strict_range = strict_range
         self.execute_dpa = execute_dpa
+        # half-open time range the primary stream particles are limited to when processing in windows
+        self.window = window
 
         # Internals
         self.asset_management = AssetManagement(ASSET_HOST, request_id=self.request_id)
         self.stream_parameters = {}
+        self.stream_columns = {}
         self.unfulfilled = set()
         self.datasets = {}
         self.external_includes = {}
+        # Cassandra query totals at the start of this request, see util.query_metrics.difference
+        self.query_totals = util.query_metrics.totals()
 
         self._initialize()
 
@@ -109,7 +115,8 @@ class StreamRequest(object):
             should_pad = stream_key != self.stream_key
             if not stream_key.is_virtual:
                 log.debug('<%s> Fetching raw data for %s', self.request_id, stream_key.as_refdes())
-                sd = StreamDataset(stream_key, self.uflags, other_streams, self.request_id)
+                sd = StreamDataset(stream_key, self.uflags, other_streams, self.request_id,
+                                   query_columns=self.stream_columns.get(stream_key))
                 sd.events = am_events[stream_key]
                 try:
                     sd.fetch_raw_data(self.time_range, self.limit, should_pad)
@@ -178,6 +185,12 @@ class StreamRequest(object):
 
     def execute_qc(self):
         self._run_qc()
+        self._finish_qc()
+
+    def trim_to_window(self):
+        # drop the overlap margin read around this window, see calc.execute_chunked_stream_request
+        if self.window is not None and self.stream_key in self.datasets:
+            self.datasets[self.stream_key].trim_to_window(self.window)
 
     def insert_provenance(self):
         self._insert_provenance()
@@ -189,7 +202,17 @@ class StreamRequest(object):
         for sk, stream_dataset in self.datasets.iteritems():
             for param in sk.stream.parameters:
                 for dataset in stream_dataset.datasets.itervalues():
-                    self.qc_executor.qc_check(param, dataset)
+                    self.qc_executor.qc_check(param, dataset, sk)
+
+    def _finish_qc(self):
+        # wait for QC results storage and report any rows which could not be stored
+        summary = self.qc_executor.finish()
+        if summary and summary['failed'] and self.stream_key in self.datasets:
+            message = 'Failed to store %d of %d QC results: %s' % (summary['failed'],
+                                                                   summary['failed'] + summary['written'],
+                                                                   '; '.join(summary['errors']))
+            self.datasets[self.stream_key].provenance_metadata.add_messages([message])
+        return summary
 
     # noinspection PyTypeChecker
     def _insert_provenance(self):
@@ -198,6 +221,7 @@ class StreamRequest(object):
         :return:
         """
         if self.include_provenance:
+            lookups = []
             for stream_key in self.stream_parameters:
                 if stream_key in self.datasets:
                     self.datasets[stream_key].insert_instrument_attributes()
@@ -207,8 +231,18 @@ class StreamRequest(object):
                         prov_metadata.add_instrument_provenance(stream_key, self.datasets[stream_key].events.events)
                         if 'provenance' in dataset:
                             provenance = dataset.provenance.values.astype('str')
-                            prov = fetch_l0_provenance(stream_key, provenance, deployment)
-                            prov_metadata.update_provenance(prov)
+                            lookups.append((prov_metadata, (stream_key, provenance, deployment)))
+
+            # fetch the L0 provenance for all streams and deployments in a single concurrent batch
+            if lookups:
+                results = fetch_l0_provenance_many([args for _, args in lookups])
+                for (prov_metadata, _), prov in zip(lookups, results):
+                    prov_metadata.update_provenance(prov)
+
+            if app.config['QUERY_STATISTICS_IN_PROVENANCE']:
+                statistics = util.query_metrics.difference(self.query_totals)
+                for stream_key in self.datasets:
+                    self.datasets[stream_key].provenance_metadata.add_query_statistics(statistics)
 
     def _insert_annotations(self):
         """
@@ -307,13 +341,12 @@ class StreamRequest(object):
         external_to_process = set()
         if self.stream_key.is_mobile:
             dpi = PRESSURE_DPI
-            external_to_process.add((None, tuple(Parameter.query.filter(
-                    Parameter.data_product_identifier == dpi).all())))
+            external_to_process.add((None, tuple(get_parameters_by_dpi(dpi))))
 
         if self.stream_key.is_glider:
-            gps_stream = Stream.query.get(GPS_STREAM_ID)
-            external_to_process.add((gps_stream, (Parameter.query.get(LATITUDE_PARAM_ID),)))
-            external_to_process.add((gps_stream, (Parameter.query.get(LONGITUDE_PARAM_ID),)))
+            gps_stream = get_stream_by_id(GPS_STREAM_ID)
+            external_to_process.add((gps_stream, (get_parameter(LATITUDE_PARAM_ID),)))
+            external_to_process.add((gps_stream, (get_parameter(LONGITUDE_PARAM_ID),)))
         return external_to_process
 
     @log_timing(log)
@@ -357,6 +390,11 @@ class StreamRequest(object):
                 log.warn('<%s> Unable to find sources for the following params: %r',
                          self.request_id, self.unfulfilled)
 
+        # Limit each stream to the parameters needed by this request, only these are selected from the data store
+        for sk, params in self.stream_parameters.iteritems():
+            self.stream_columns[sk] = {p.name for p in params}
+        log.debug('<%s> query columns: %r', self.request_id, self.stream_columns)
+
     @log_timing(log)
     def _collapse_times(self):
         """
@@ -390,7 +428,7 @@ class StreamRequest(object):
         subsite = stream_key.subsite
         node = stream_key.node
         sensor = stream_key.sensor
-        stream_dictionary = build_stream_dictionary()
+        inventory = get_stream_inventory()
 
         param_streams = []
         for p in poss_params:
@@ -401,48 +439,48 @@ class StreamRequest(object):
 
         # First, try to find the stream on the same sensor
         for param, search_streams in param_streams:
-            sk = self._find_stream_same_sensor(stream_key, search_streams, stream_dictionary)
+            sk = self._find_stream_same_sensor(stream_key, search_streams, inventory)
             if sk:
                 return sk, param
 
         # Attempt to find an instrument at the same depth (if not mobile)
         if not stream_key.is_mobile:
-            nominal_depth = NominalDepth.get_nominal_depth(subsite, node, sensor)
+            nominal_depth = get_nominal_depth(subsite, node, sensor)
             if nominal_depth is not None:
                 co_located = nominal_depth.get_colocated_subsite()
                 for param, search_streams in param_streams:
-                    sk = self._find_stream_from_list(stream_key, search_streams, co_located, stream_dictionary)
+                    sk = self._find_stream_from_list(stream_key, search_streams, co_located, inventory)
                     if sk:
                         return sk, param
 
         # Attempt to find an instrument on the same node
         for param, search_streams in param_streams:
-            sk = self._find_stream_same_node(stream_key, search_streams, stream_dictionary)
+            sk = self._find_stream_same_node(stream_key, search_streams, inventory)
             if sk:
                 return sk, param
 
         # Not found at same depth, attempt to find nearby (if not mobile)
         if not stream_key.is_mobile:
-            nominal_depth = NominalDepth.get_nominal_depth(subsite, node, sensor)
+            nominal_depth = get_nominal_depth(subsite, node, sensor)
             if nominal_depth is not None:
                 max_depth_var = MAX_DEPTH_VARIANCE_METBK if 'METBK' in sensor else MAX_DEPTH_VARIANCE
                 nearby = nominal_depth.get_depth_within(max_depth_var)
                 for param, search_streams in param_streams:
-                    sk = self._find_stream_from_list(stream_key, search_streams, nearby, stream_dictionary)
+                    sk = self._find_stream_from_list(stream_key, search_streams, nearby, inventory)
                     if sk:
                         return sk, param
 
         return None, None
 
     @staticmethod
-    def _find_stream_same_sensor(stream_key, streams, stream_dictionary):
+    def _find_stream_same_sensor(stream_key, streams, inventory):
         """
         Given a primary source, attempt to find one of the supplied streams from the same instrument
         :param stream_key:
         :param streams:
         :return:
         """
-        log.debug('_find_stream_same_sensor(%r, %r, STREAM_DICTIONARY)', stream_key, streams)
+        log.debug('_find_stream_same_sensor(%r, %r, INVENTORY)', stream_key, streams)
         method = stream_key.method
         subsite = stream_key.subsite
         node = stream_key.node
@@ -450,8 +488,7 @@ class StreamRequest(object):
 
         # Search the same reference designator
         for stream in streams:
-            sensors = stream_dictionary.get(stream, {}).get(method, {}).get(subsite, {}).get(node, [])
-            if sensor in sensors:
+            if sensor in inventory.sensors(method, subsite, node, stream):
                 return StreamKey.from_dict({
                     "subsite": subsite,
                     "node": node,
@@ -461,28 +498,25 @@ class StreamRequest(object):
                 })
 
     @staticmethod
-    def _find_stream_from_list(stream_key, streams, sensors, stream_dictionary):
-        log.debug('_find_stream_from_list(%r, %r, %r, STREAM_DICTIONARY)', stream_key, streams, sensors)
+    def _find_stream_from_list(stream_key, streams, sensors, inventory):
+        log.debug('_find_stream_from_list(%r, %r, %r, INVENTORY)', stream_key, streams, sensors)
         method = stream_key.method
         subsite = stream_key.subsite
-        designators = [(c.subsite, c.node, c.sensor) for c in sensors]
+        designators = [(c.node, c.sensor) for c in sensors if c.subsite == subsite]
 
         for stream in streams:
-            subsite_dict = stream_dictionary.get(stream, {}).get(method, {}).get(subsite, {})
-            for _node in subsite_dict:
-                for _sensor in subsite_dict[_node]:
-                    des = (subsite, _node, _sensor)
-                    if des in designators:
-                        return StreamKey.from_dict({
-                            "subsite": subsite,
-                            "node": _node,
-                            "sensor": _sensor,
-                            "method": method,
-                            "stream": stream
-                        })
+            for _node, _sensor in designators:
+                if _sensor in inventory.sensors(method, subsite, _node, stream):
+                    return StreamKey.from_dict({
+                        "subsite": subsite,
+                        "node": _node,
+                        "sensor": _sensor,
+                        "method": method,
+                        "stream": stream
+                    })
 
     @staticmethod
-    def _find_stream_same_node(stream_key, streams, stream_dictionary):
+    def _find_stream_same_node(stream_key, streams, inventory):
         """
         Given a primary source, attempt to find one of the supplied streams from the same instrument,
         same node or same subsite
@@ -490,13 +524,13 @@ class StreamRequest(object):
         :param streams: List - list of target streams
         :return: StreamKey if found, otherwise None
         """
-        log.debug('_find_stream_same_node(%r, %r, STREAM_DICTIONARY)', stream_key, streams)
+        log.debug('_find_stream_same_node(%r, %r, INVENTORY)', stream_key, streams)
         method = stream_key.method
         subsite = stream_key.subsite
         node = stream_key.node
 
         for stream in streams:
-            sensors = stream_dictionary.get(stream, {}).get(method, {}).get(subsite, {}).get(node, [])
+            sensors = inventory.sensors(method, subsite, node, stream)
             if sensors:
                 return StreamKey.from_dict({
                     "subsite": subsite,
@@ -521,8 +555,8 @@ class StreamRequest(object):
         :return:  size estimate (in bytes) - also populates self.size_estimate
         """
         default_size = DEFAULT_PARTICLE_DENSITY  # bytes / particle
-        size_estimate = sum((size_estimates.get(stream.stream_name, default_size) *
-                             util.metadata_service.get_particle_count(stream, self.time_range)
+        particle_counts = util.metadata_service.get_particle_counts(self.stream_parameters, self.time_range)
+        size_estimate = sum((size_estimates.get(stream.stream_name, default_size) * particle_counts[stream].count
                              for stream in self.stream_parameters))
 
         return int(math.ceil(size_estimate))